@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+
+'''
+Usage:
+    atrium_bench.py --config <configfile> [--type=<msg_type>...] [--poolsize=<n>...] [options]
+
+Options:
+    --producers <n>         number of producer processes [default: 4]
+    --messages <n>          messages sent per producer, per message type [default: 1000]
+    --rate <n>              target aggregate send rate in messages/second (default: as fast as possible)
+    --arrivals <mode>       "fixed" (evenly paced) or "poisson" (open-loop, exponential gaps) [default: fixed]
+    --payload-bytes <n>     size of the filler payload in each message body [default: 256]
+    --wire-format <fmt>     "json" or "envelope" [default: json]
+    --body-type <mimetype>  body codec used by the producers [default: application/json]
+    --timeout <secs>        give up waiting for deliveries after this many seconds [default: 120]
+    --output <file>         append results (one JSON document per line) to this file [default: atrium_bench_results.jsonl]
+
+Starts atriumd against the Redis named in <configfile>, with a benchmark handler
+pool for each message type and pool size requested, drives it with N producer
+processes, and records end-to-end latency percentiles and delivered throughput.
+The switch settings (forwarding mode, transport, event loop and so on) are taken
+from <configfile>, so the same harness measures each atriumd mode.
+'''
+
+import os, sys
+import json
+import time
+import uuid
+import random
+import signal
+import tempfile
+import threading
+import datetime
+import subprocess
+from multiprocessing import Process
+import docopt
+import redis
+import yaml
+from snap import common
+from atriumd import MessageHandler
+from atrium_envelope import compose_message
+
+
+RUN_ID_ENV_VAR = 'ATRIUM_BENCH_RUN_ID'
+BENCH_HANDLER_CLASS = 'BenchmarkHandler'
+LATENCY_FLUSH_SIZE = 100
+
+
+def latency_key(run_id: str, msg_type: str) -> str:
+    return f'atrium_bench:{run_id}:{msg_type}:deliveries'
+
+
+def ready_key(run_id: str) -> str:
+    return f'atrium_bench:{run_id}:ready'
+
+
+class BenchmarkHandler(MessageHandler):
+    '''Records (send time, receive time) for every message it sees in a Redis list,
+    which the harness reads back once the run is complete.
+    '''
+
+    def __init__(self, channel_id:str, backchannel_id:str, timeout_seconds:int, **kwargs):
+        super().__init__(channel_id, backchannel_id, timeout_seconds, **kwargs)
+        self.run_id = os.getenv(RUN_ID_ENV_VAR)
+        self.deliveries = {}
+        # in asyncio mode handle_message runs on an executor thread, while flushes run on the loop
+        self.deliveries_lock = threading.Lock()
+        self.num_received = 0
+        self.num_received_at_last_report = 0
+        self.announced = False
+
+
+    def announce_ready(self):
+        # the first (forced) status report comes once the handler is subscribed to its channel
+        # (or has joined its stream's consumer group), so nothing sent after this is missed
+        if not self.announced:
+            self.redis_client.incr(ready_key(self.run_id))
+            self.announced = True
+
+
+    def handle_message(self, message, backchannel_id):
+        received_at = time.time()
+        inbound = self.read_message(message)
+        body = inbound.body()
+
+        with self.deliveries_lock:
+            deliveries = self.deliveries.setdefault(inbound.message_type, [])
+            deliveries.append(f'{body["sent_at"]} {received_at}')
+            self.num_received += 1
+            flush_due = len(deliveries) >= LATENCY_FLUSH_SIZE
+
+        if flush_due:
+            self.flush_deliveries()
+
+
+    def flush_deliveries(self):
+        with self.deliveries_lock:
+            deliveries_by_type = self.deliveries
+            self.deliveries = {}
+
+        if not deliveries_by_type:
+            return
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for msg_type, deliveries in deliveries_by_type.items():
+            if deliveries:
+                pipeline.rpush(latency_key(self.run_id, msg_type), *deliveries)
+        pipeline.execute()
+
+
+    def partial_flush_due(self, force: bool) -> bool:
+        '''Full batches are flushed by handle_message(). A partial batch is flushed with each
+        periodic status report, and as soon as nothing has arrived since the last call.
+        '''
+
+        with self.deliveries_lock:
+            idle = self.num_received == self.num_received_at_last_report
+            self.num_received_at_last_report = self.num_received
+
+        return force or idle or self.status_report_due()
+
+
+    def report_status(self, force=False):
+        if self.partial_flush_due(force):
+            self.flush_deliveries()
+        super().report_status(force)
+        self.announce_ready()
+
+
+    async def report_status_async(self, force=False):
+        if self.partial_flush_due(force):
+            self.flush_deliveries()
+        await super().report_status_async(force)
+        self.announce_ready()
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def produce(redis_params: dict, channel_id: str, msg_types: list, num_messages: int, rate: float, arrivals: str, **kwargs):
+    redis_client = redis.StrictRedis(**redis_params)
+    filler = 'x' * int(kwargs['payload_bytes'])
+    wire_format = kwargs['wire_format']
+    body_type = kwargs['body_type']
+
+    # schedule sends against the clock rather than sleeping a fixed gap after each send,
+    # so that slow publishes do not quietly lower the offered load
+    next_send_time = time.monotonic()
+    for seq in range(num_messages):
+        for msg_type in msg_types:
+            if rate:
+                gap = random.expovariate(rate) if arrivals == 'poisson' else 1.0 / rate
+                next_send_time += gap
+                delay = next_send_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            body = {
+                'seq': seq,
+                'sent_at': time.time(),
+                'payload': filler
+            }
+            redis_client.publish(channel_id, compose_message(wire_format, msg_type, body_type, body, os.getpid()))
+
+
+def generate_config(base_config: dict, msg_types: list, poolsize: int) -> dict:
+    config = dict(base_config)
+    config['globals'] = dict(base_config['globals'])
+    config['globals']['message_handler_module'] = 'atrium_bench'
+    config['message_types'] = {
+        msg_type: {
+            'handler_class': BENCH_HANDLER_CLASS,
+            'handler_poolsize': poolsize
+        } for msg_type in msg_types
+    }
+
+    return config
+
+
+def current_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty']).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(base_config: dict, msg_types: list, poolsize: int, args) -> list:
+    settings = base_config['settings']
+    redis_params = {
+        'host': settings['redis_host'],
+        'port': settings['redis_port'],
+        'db': settings['redis_db']
+    }
+    redis_client = redis.StrictRedis(**redis_params)
+
+    num_producers = int(args['--producers'])
+    num_messages = int(args['--messages'])
+    total_rate = float(args['--rate']) if args['--rate'] else None
+    producer_rate = total_rate / num_producers if total_rate else None
+    expected_per_type = num_producers * num_messages
+
+    run_id = str(uuid.uuid4())
+    os.environ[RUN_ID_ENV_VAR] = run_id
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        yaml.safe_dump(generate_config(base_config, msg_types, poolsize), f)
+        configfile_name = f.name
+
+    # atriumd runs in its own session so that it and its handler processes can be stopped together
+    atriumd = subprocess.Popen([sys.executable, 'atriumd.py', '--config', configfile_name],
+                               stdout=subprocess.DEVNULL,
+                               start_new_session=True)
+    try:
+        expected_handlers = poolsize * len(msg_types)
+        deadline = time.monotonic() + 30
+        while int(redis_client.get(ready_key(run_id)) or 0) < expected_handlers:
+            if time.monotonic() > deadline:
+                raise Exception(f'atriumd did not start {expected_handlers} benchmark handler(s) within 30 seconds.')
+            time.sleep(0.1)
+
+        # and for atriumd itself to subscribe to the channel the producers publish on
+        while redis_client.pubsub_numsub(settings['rcv_channel_id'])[0][1] < 1:
+            if time.monotonic() > deadline:
+                raise Exception(f'atriumd did not subscribe to channel {settings["rcv_channel_id"]} within 30 seconds.')
+            time.sleep(0.1)
+
+        print(f'> run {run_id}: {num_producers} producer(s) x {num_messages} message(s) x {len(msg_types)} type(s), pool size {poolsize}')
+        start_time = time.time()
+        producers = []
+        for i in range(num_producers):
+            p = Process(target=produce,
+                        args=(redis_params, settings['rcv_channel_id'], msg_types, num_messages, producer_rate, args['--arrivals']),
+                        kwargs={
+                            'payload_bytes': args['--payload-bytes'],
+                            'wire_format': args['--wire-format'],
+                            'body_type': args['--body-type']
+                        })
+            p.start()
+            producers.append(p)
+
+        for p in producers:
+            p.join()
+        send_duration = time.time() - start_time
+
+        deadline = time.monotonic() + int(args['--timeout'])
+        while time.monotonic() < deadline:
+            delivered = [redis_client.llen(latency_key(run_id, msg_type)) for msg_type in msg_types]
+            if min(delivered) >= expected_per_type:
+                break
+            time.sleep(0.5)
+
+    finally:
+        os.killpg(atriumd.pid, signal.SIGTERM)
+        atriumd.wait()
+        os.remove(configfile_name)
+
+    results = []
+    for msg_type in msg_types:
+        key = latency_key(run_id, msg_type)
+        deliveries = [entry.decode('utf-8').split(' ') for entry in redis_client.lrange(key, 0, -1)]
+        redis_client.delete(key)
+
+        latencies = sorted((float(received) - float(sent)) * 1000 for sent, received in deliveries)
+        last_received = max((float(received) for sent, received in deliveries), default=start_time)
+        elapsed = max(last_received - start_time, 1e-9)
+
+        results.append({
+            'run_id': run_id,
+            'revision': current_revision(),
+            'run_ts': datetime.datetime.now().isoformat(),
+            'message_type': msg_type,
+            'poolsize': poolsize,
+            'producers': num_producers,
+            'target_rate': total_rate,
+            'arrivals': args['--arrivals'],
+            'wire_format': args['--wire-format'],
+            'body_type': args['--body-type'],
+            'payload_bytes': int(args['--payload-bytes']),
+            'settings': {k: v for k, v in settings.items() if not k.startswith('redis_')},
+            'sent': expected_per_type,
+            'delivered': len(latencies),
+            'send_rate': expected_per_type * len(msg_types) / send_duration,
+            'throughput': len(latencies) / elapsed,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'p999': percentile(latencies, 99.9),
+                'max': latencies[-1] if latencies else None
+            }
+        })
+
+    redis_client.delete(ready_key(run_id))
+    return results
+
+
+def main(args):
+    base_config = common.read_config_file(args['<configfile>'])
+    msg_types = args['--type'] or ['bench']
+    poolsizes = [int(p) for p in args['--poolsize']] or [1]
+
+    with open(args['--output'], 'a') as f:
+        for poolsize in poolsizes:
+            for result in run_benchmark(base_config, msg_types, poolsize, args):
+                print(common.jsonpretty(result))
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+'''
+Body codecs for Atrium messages, keyed by body_data_type.
+
+A sender names the mimetype of its message body; the envelope carries that
+mimetype in its header, and the receiver decodes the body with whichever codec
+is registered under it.
+'''
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class UnsupportedBodyDataType(Exception):
+    def __init__(self, body_data_type):
+        super().__init__(self, f'No codec registered for Atrium body data type "{body_data_type}".')
+
+
+class BodyCodec(object):
+    '''binary_safe is False for codecs whose output can be embedded in a JSON document
+    as-is; bodies from any other codec can only travel in an envelope.
+    '''
+
+    mimetype = None
+    binary_safe = True
+
+    def encode(self, body) -> bytes:
+        raise NotImplementedError()
+
+    def decode(self, data: bytes):
+        raise NotImplementedError()
+
+
+class JSONCodec(BodyCodec):
+    mimetype = 'application/json'
+    binary_safe = False
+
+    def encode(self, body) -> bytes:
+        return json.dumps(body).encode('utf-8')
+
+    def decode(self, data: bytes):
+        return json.loads(data.decode('utf-8'))
+
+
+class TextCodec(BodyCodec):
+    mimetype = 'text/plain'
+    binary_safe = False
+
+    def encode(self, body) -> bytes:
+        return str(body).encode('utf-8')
+
+    def decode(self, data: bytes):
+        return data.decode('utf-8')
+
+
+class MsgpackCodec(BodyCodec):
+    mimetype = 'application/msgpack'
+
+    def encode(self, body) -> bytes:
+        if msgpack is None:
+            raise UnsupportedBodyDataType(self.mimetype)
+        return msgpack.packb(body, use_bin_type=True)
+
+    def decode(self, data: bytes):
+        if msgpack is None:
+            raise UnsupportedBodyDataType(self.mimetype)
+        return msgpack.unpackb(data, raw=False)
+
+
+class RawBytesCodec(BodyCodec):
+    mimetype = 'application/octet-stream'
+
+    def encode(self, body) -> bytes:
+        if isinstance(body, str):
+            return body.encode('utf-8')
+        return bytes(body)
+
+    def decode(self, data: bytes):
+        return bytes(data)
+
+
+CODEC_REGISTRY = {}
+
+
+def register_codec(codec: BodyCodec, *aliases):
+    CODEC_REGISTRY[codec.mimetype] = codec
+    for alias in aliases:
+        CODEC_REGISTRY[alias] = codec
+
+
+def lookup_codec(body_data_type: str) -> BodyCodec:
+    codec = CODEC_REGISTRY.get(body_data_type)
+    if codec:
+        return codec
+
+    # any text subtype we have not registered explicitly is still text
+    if body_data_type and body_data_type.startswith('text/'):
+        return CODEC_REGISTRY[TextCodec.mimetype]
+
+    raise UnsupportedBodyDataType(body_data_type)
+
+
+register_codec(JSONCodec())
+register_codec(TextCodec())
+register_codec(MsgpackCodec(), 'application/x-msgpack')
+register_codec(RawBytesCodec())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+'''
+Wire formats for Atrium IPC messages.
+
+The original format is a JSON document:
+
+    {
+        message_type: <msg_type>,
+        body_data_type: <mime_type>
+        timestamp: <creation_timestamp>,
+        sender_pid: <sender_process_id>,
+        body: <message_data>
+    }
+
+which has to be parsed in full (body included) just to learn the message type.
+The envelope format puts the routing fields in a fixed-size binary header and
+carries the body as opaque bytes:
+
+    offset  size  field
+    0       4     magic, b'ATR1'
+    4       2     length of message_type (uint16, network byte order)
+    6       2     length of body_data_type (uint16)
+    8       8     timestamp (float64, seconds since the epoch)
+    16      4     sender_pid (int32)
+    20      ...   message_type, then body_data_type (UTF-8), then the body
+
+Readers accept both formats; senders choose one with their wire_format setting.
+Bodies are encoded with the codec registered for their body_data_type (see
+atrium_codecs); bodies from binary codecs such as msgpack always travel in an envelope.
+'''
+
+import json
+import time
+import struct
+import datetime
+from collections import namedtuple
+
+from atrium_codecs import lookup_codec
+
+
+ENVELOPE_MAGIC = b'ATR1'
+ENVELOPE_HEADER = struct.Struct('!4sHHdi')
+
+WIRE_FORMAT_JSON = 'json'
+WIRE_FORMAT_ENVELOPE = 'envelope'
+
+AtriumHeader = namedtuple('AtriumHeader', 'message_type body_data_type timestamp sender_pid')
+
+
+def is_envelope(data: bytes) -> bool:
+    return data[:4] == ENVELOPE_MAGIC
+
+
+def epoch_timestamp(value) -> float:
+    '''JSON senders write the timestamp as an ISO 8601 string (local time, as from
+    datetime.now()); envelopes carry seconds since the epoch. Both read back as the latter.
+    '''
+
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_body(body, body_data_type: str) -> bytes:
+    if isinstance(body, bytes):
+        return body
+    return lookup_codec(body_data_type).encode(body)
+
+
+def pack_message(message_type: str, body_data_type: str, body, sender_pid: int=-1, timestamp: float=None) -> bytes:
+    type_bytes = message_type.encode('utf-8')
+    mimetype_bytes = body_data_type.encode('utf-8')
+    header = ENVELOPE_HEADER.pack(ENVELOPE_MAGIC,
+                                  len(type_bytes),
+                                  len(mimetype_bytes),
+                                  timestamp if timestamp is not None else time.time(),
+                                  sender_pid)
+
+    return b''.join((header, type_bytes, mimetype_bytes, encode_body(body, body_data_type)))
+
+
+def compose_message(wire_format: str, message_type: str, body_data_type: str, body, sender_pid: int=-1):
+    '''Build an outbound Atrium message in the requested wire format.
+    '''
+
+    if wire_format == WIRE_FORMAT_ENVELOPE or lookup_codec(body_data_type).binary_safe:
+        return pack_message(message_type, body_data_type, body, sender_pid)
+
+    msg_dict = {
+        'message_type': message_type,
+        'body_data_type': body_data_type,
+        'timestamp': datetime.datetime.now().isoformat(),
+        'sender_pid': sender_pid,
+        'body': body
+    }
+
+    return json.dumps(msg_dict)
+
+
+class InboundMessage(object):
+    '''Read-only view of a raw Atrium message in either wire format.
+
+    For envelopes only the fixed-size header is unpacked on construction; the body
+    is not touched until body() or body_bytes() is called. Legacy JSON messages
+    are parsed in full, as before.
+    '''
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self.data = data
+        self.json_object = None
+
+        if is_envelope(data):
+            _, type_length, mimetype_length, timestamp, sender_pid = ENVELOPE_HEADER.unpack_from(data)
+            offset = ENVELOPE_HEADER.size
+            message_type = data[offset:offset + type_length].decode('utf-8')
+            offset += type_length
+            body_data_type = data[offset:offset + mimetype_length].decode('utf-8')
+
+            self.header = AtriumHeader(message_type=message_type,
+                                       body_data_type=body_data_type,
+                                       timestamp=timestamp,
+                                       sender_pid=sender_pid)
+            self.body_offset = offset + mimetype_length
+
+        else:
+            self.json_object = json.loads(data.decode('UTF-8'))
+            self.header = AtriumHeader(message_type=self.json_object.get('message_type'),
+                                       body_data_type=self.json_object.get('body_data_type'),
+                                       timestamp=epoch_timestamp(self.json_object.get('timestamp')),
+                                       sender_pid=self.json_object.get('sender_pid'))
+            self.body_offset = None
+
+
+    @property
+    def message_type(self) -> str:
+        return self.header.message_type
+
+
+    def header_field(self, field_name: str):
+        '''Header fields read the same in either wire format (the timestamp is always seconds
+        since the epoch); other top-level fields of a JSON message are returned as sent.
+        '''
+
+        if field_name in AtriumHeader._fields:
+            return getattr(self.header, field_name)
+        if self.json_object is not None:
+            return self.json_object.get(field_name)
+        return None
+
+
+    def body_bytes(self) -> bytes:
+        if self.json_object is not None:
+            body = self.json_object.get('body')
+            if isinstance(body, str):
+                return body.encode('utf-8')
+            return encode_body(body, self.header.body_data_type)
+        return self.data[self.body_offset:]
+
+
+    def body(self):
+        '''The message body, decoded by the codec named in the header. Legacy JSON
+        bodies are returned as Python objects (including the double-encoded JSON
+        strings that older senders emit).
+        '''
+
+        if self.json_object is not None:
+            body = self.json_object.get('body')
+            if isinstance(body, str) and self.header.body_data_type == 'application/json':
+                return json.loads(body)
+            return body
+
+        return lookup_codec(self.header.body_data_type).decode(self.body_bytes())
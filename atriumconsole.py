@@ -3,17 +3,29 @@
 
 '''
 Usage:
-    atriumconsole.py --config <configfile> --channel <channel_id> --message-data=<name:value>...
-    atriumconsole.py --config <configfile> --channel <channel_id> -s
+    atriumconsole.py --config <configfile> --channel <channel_id> --message-data=<name:value>... [--codec <mimetype>]
+    atriumconsole.py --config <configfile> --channel <channel_id> -s [--codec <mimetype>]
+    atriumconsole.py --config <configfile> --channel <channel_id> --bulk [--file <msgfile>] [--batch-size <n>] [--rate <n>] [--codec <mimetype>]
+
+Options:
+    --codec <mimetype>  re-encode the message body with the named codec (e.g. application/msgpack)
+                        and send it as an Atrium envelope instead of a JSON document
+    --bulk              stream newline-delimited JSON messages (from stdin, or from --file) and 
+                        publish them through a Redis pipeline, one batch at a time
+    --file <msgfile>    read bulk messages from this file instead of stdin
+    --batch-size <n>    number of messages per pipelined batch [default: 100]
+    --rate <n>          cap the publish rate at this many messages per second
 '''
 
 import os, sys
 import json
+import time
 from multiprocessing import Process
 import docopt
 import redis
 import utils
 from snap import common
+from atrium_envelope import compose_message, WIRE_FORMAT_ENVELOPE
 from abc import ABC
 
 
@@ -35,6 +47,88 @@ def parse_cli_params(params_array):
 
 
 
+def encode_message(msg_dict: dict, codec: str):
+    if codec:
+        return compose_message(WIRE_FORMAT_ENVELOPE,
+                               msg_dict.get('message_type', 'unknown'),
+                               codec,
+                               msg_dict.get('body'),
+                               os.getpid())
+    
+    return json.dumps(msg_dict)
+
+
+def read_file_lines(filename: str):
+    with open(filename) as f:
+        for line in f:
+            yield line.strip()
+
+
+def read_jsonl(filename=None):
+    '''Yields (line_number, message_dict) for each non-blank line of newline-delimited JSON. 
+    Lines which are not valid JSON are reported and skipped.
+    '''
+
+    source = read_file_lines(filename) if filename else utils.read_stdin()
+
+    for line_number, line in enumerate(source, 1):
+        if not line:
+            continue
+        try:
+            yield (line_number, json.loads(line))
+        except ValueError as err:
+            print(f'!!! skipping line {line_number}: not valid JSON ({err}).', file=sys.stderr)
+
+
+def publish_batch(redis_client, channel_id: str, payloads: list) -> list:
+    pipeline = redis_client.pipeline(transaction=False)
+    for payload in payloads:
+        pipeline.publish(channel_id, payload)
+    return pipeline.execute()
+
+
+def bulk_publish(redis_client, channel_id: str, messages, batch_size: int, rate: float=None, codec: str=None):
+    '''Publish a stream of messages in pipelined batches. If rate is set, each batch waits
+    until the cumulative send schedule allows it, so that the average rate stays under the cap.
+    '''
+
+    start_time = time.monotonic()
+    total_sent = 0
+    batch_number = 0
+    payloads = []
+
+    def flush():
+        nonlocal total_sent, batch_number, payloads
+        if rate:
+            scheduled_time = start_time + (total_sent / rate)
+            delay = scheduled_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        batch_start = time.monotonic()
+        subscriber_counts = publish_batch(redis_client, channel_id, payloads)
+        batch_seconds = max(time.monotonic() - batch_start, 1e-9)
+
+        batch_number += 1
+        total_sent += len(payloads)
+        print(f'batch {batch_number}: {len(payloads)} message(s) in {batch_seconds * 1000:.1f} ms '
+              f'({len(payloads) / batch_seconds:.0f} msg/s); '
+              f'subscribers per message min {min(subscriber_counts)} / max {max(subscriber_counts)}; '
+              f'{sum(1 for count in subscriber_counts if not count)} unheard.')
+        payloads = []
+
+    for line_number, msg_dict in messages:
+        payloads.append(encode_message(msg_dict, codec))
+        if len(payloads) >= batch_size:
+            flush()
+
+    if payloads:
+        flush()
+
+    elapsed = max(time.monotonic() - start_time, 1e-9)
+    print(f'{total_sent} message(s) published in {batch_number} batch(es), {elapsed:.2f} s ({total_sent / elapsed:.0f} msg/s overall).')
+
+
 def main(args):
     print(common.jsonpretty(args))
 
@@ -50,6 +144,16 @@ def main(args):
 
     redis_client = redis.StrictRedis(**redis_params)
 
+    if args['--bulk']:
+        rate = float(args['--rate']) if args['--rate'] else None
+        bulk_publish(redis_client,
+                     channel_id,
+                     read_jsonl(args['--file']),
+                     int(args['--batch-size']),
+                     rate,
+                     args['--codec'])
+        return
+
     if args['-s']:
         raw_input = []
         for line in utils.read_stdin():
@@ -60,7 +164,7 @@ def main(args):
     else:
         msg_dict = parse_cli_params(msg_params)
     
-    num_subscribers = redis_client.publish(channel_id, json.dumps(msg_dict))
+    num_subscribers = redis_client.publish(channel_id, encode_message(msg_dict, args['--codec']))
     print(f'message sent to {num_subscribers} subscribers.')
 
 
@@ -7,74 +7,446 @@ Usage:
 '''
 
 import os, sys
-import json
 import uuid
-import datetime
+import time
+import itertools
+import asyncio
+import inspect
+import threading
 import traceback
 from collections import namedtuple
 from multiprocessing import Process
 import docopt
 import redis
+from redis import asyncio as aioredis
 from abc import ABC, abstractmethod
 from snap import common
 from uhashring import HashRing
+from atrium_envelope import InboundMessage, compose_message, WIRE_FORMAT_JSON
 
 
 
+STREAM_CONSUMER_GROUP = 'atrium_handlers'
+STREAM_HANDLER_CONSUMER = 'handler'
+STREAM_RECLAIM_CONSUMER = 'atriumd_reclaim'
+DEAD_LETTER_SUFFIX = ':dead'
+
+# handlers report throughput and latency to atriumd on the backchannel under this message type
+HANDLER_STATUS_MESSAGE_TYPE = 'atrium.handler_status'
+
+# sent by atriumd down a handler's own receive channel to retire it; the handler exits
+# once it has worked through everything queued ahead of the signal
+HANDLER_STOP_SIGNAL = b'{"message_type": "atrium.handler_stop"}'
+
+
 class BadMessageHeaderFormat(Exception):
     def __init__(self, field_name):
         super().__init__(self, f'Atrium message header is missing required field {field_name}.')
 
 
+class InvalidRoutingKey(Exception):
+    def __init__(self, msg_type, key_spec):
+        super().__init__(self, f'Routing key "{key_spec}" for message type "{msg_type}" must be of the form header.<field> or body.<field>.')
+
+
+class NoLiveHandlerNodes(Exception):
+    def __init__(self, msg_type):
+        super().__init__(self, f'Every handler node for message type "{msg_type}" is down or recovering.')
+
+
 class UnregisteredMessageType(Exception):
     def __init__(self, msg_type):
         super().__init__(self, f'No message of type "{msg_type}" registered with Atrium server.')
 
 
+def ensure_consumer_group(redis_client, stream_key: str):
+    try:
+        redis_client.xgroup_create(stream_key, STREAM_CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as err:
+        # BUSYGROUP means the group already exists, which is what we want
+        if 'BUSYGROUP' not in str(err):
+            raise
+
+
+async def ensure_consumer_group_async(redis_client, stream_key: str):
+    try:
+        await redis_client.xgroup_create(stream_key, STREAM_CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as err:
+        if 'BUSYGROUP' not in str(err):
+            raise
+
+
+def stream_entry_to_message(stream_key, entry_id, fields) -> dict:
+    '''Present a stream entry in the same shape as a pub/sub message, so that
+    handle_message() implementations work unchanged under either transport.
+    '''
+
+    return {
+        'type': 'message',
+        'channel': stream_key,
+        'data': fields[b'data'],
+        'id': entry_id
+    }
+
+
 class MessageHandler(ABC):
+    '''Base class for Atrium message handlers.
+
+    Subclasses may implement handle_message() either as a plain method or as a coroutine
+    (async def). Coroutine handlers can be multiplexed on a single asyncio event loop when
+    atriumd runs with event_loop: asyncio; in process mode they are driven by a private loop.
+    '''
+
     def __init__(self, channel_id:str, backchannel_id:str, timeout_seconds:int, **kwargs):
+        self.redis_params = kwargs
         self.redis_client = redis.StrictRedis(**kwargs)
-        self.redis_pubsub_interface = self.redis_client.pubsub()
-        self.redis_pubsub_interface.subscribe(channel_id)
+        self.async_redis_client = None
+        self.channel_id = channel_id
         self.backchannel_id = backchannel_id
         self.timeout_seconds = timeout_seconds
+        self.transport = 'pubsub'
+        self.stream_read_count = 1
+        self.wire_format = WIRE_FORMAT_JSON
+        self.stopped = False
+
+        self.status_interval_seconds = 5
+        self.last_status_time = time.monotonic()
+        self.messages_processed = 0
+        self.window_message_count = 0
+        self.window_latency_ms = 0.0
+        # the counters are shared with the heartbeat thread (see start_heartbeat)
+        self.status_lock = threading.Lock()
+
+
+    def use_stream_transport(self, read_count: int):
+        '''Read from the channel as a Redis stream (via the atrium consumer group) instead of
+        subscribing to it. Called by the Switch before the handler is started.
+        '''
+
+        self.transport = 'streams'
+        self.stream_read_count = read_count
 
     @abstractmethod
     def handle_message(self, message:str, backchannel_id:str):
         pass
 
 
+    def is_stop_signal(self, message: dict) -> bool:
+        return message['data'] == HANDLER_STOP_SIGNAL
+
+
+    def record_latency(self, start_time: float):
+        with self.status_lock:
+            self.messages_processed += 1
+            self.window_message_count += 1
+            self.window_latency_ms += (time.monotonic() - start_time) * 1000
+
+
+    def status_report_due(self) -> bool:
+        return time.monotonic() - self.last_status_time >= self.status_interval_seconds
+
+
+    def take_status_report(self) -> dict:
+        '''Returns the cumulative processed count and the mean handler latency since the last report.
+        '''
+
+        with self.status_lock:
+            avg_latency_ms = 0.0
+            if self.window_message_count:
+                avg_latency_ms = self.window_latency_ms / self.window_message_count
+
+            self.window_message_count = 0
+            self.window_latency_ms = 0.0
+            self.last_status_time = time.monotonic()
+
+            return {
+                'channel_id': self.channel_id,
+                'pid': os.getpid(),
+                'processed': self.messages_processed,
+                'avg_latency_ms': avg_latency_ms
+            }
+
+
+    def report_status(self, force=False):
+        '''Status reports double as heartbeats: atriumd restarts a handler that goes quiet.
+        '''
+
+        if force or self.status_report_due():
+            self.send_message(HANDLER_STATUS_MESSAGE_TYPE, 'application/json', **self.take_status_report())
+
+
+    async def report_status_async(self, force=False):
+        if force or self.status_report_due():
+            await self.send_message_async(HANDLER_STATUS_MESSAGE_TYPE, 'application/json', **self.take_status_report())
+
+
+    def start_heartbeat(self):
+        '''Status reports are also sent from a timer thread, so that a handler busy with one
+        long message keeps reporting in and is not restarted as silent.
+        '''
+
+        def heartbeat():
+            while not self.stopped:
+                time.sleep(self.status_interval_seconds)
+                self.report_status()
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+
+
+    async def heartbeat_async(self):
+        '''start_heartbeat() for handlers running on an event loop
+        '''
+
+        while not self.stopped:
+            await asyncio.sleep(self.status_interval_seconds)
+            await self.report_status_async()
+
+
+    def run_handler(self, message: dict):
+        start_time = time.monotonic()
+        self.handle_message(message, self.backchannel_id)
+        self.record_latency(start_time)
+
+
+    @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.handle_message)
+
+
+    def read_message(self, message: dict) -> InboundMessage:
+        '''Decode an inbound message (in either wire format) for use inside handle_message()
+        '''
+
+        return InboundMessage(message['data'])
+
+
+    def compose_message(self, message_type, body_mimetype, **kwargs):
+        '''The body is encoded by the codec registered for body_mimetype (see atrium_codecs).
+        '''
+
+        return compose_message(self.wire_format, message_type, body_mimetype, kwargs)
+
+
     def send_message(self, message_type, body_mimetype, **kwargs):
         '''Allows a message handler to communicate with its parent atriumd process
         by publishing to its pub/sub backchannel
         '''
 
-        msg_dict = {
-            'message_type': message_type,
-            'body_data_type': body_mimetype,
-            'timestamp': datetime.datetime.now().isoformat(),
-            'sender_pid': -1,
-            'body': json.dumps(kwargs)
-        }
+        self.redis_client.publish(self.backchannel_id, self.compose_message(message_type, body_mimetype, **kwargs))
+
+
+    async def send_message_async(self, message_type, body_mimetype, **kwargs):
+        '''Non-blocking counterpart of send_message() for use inside async handlers
+        '''
+
+        await self.async_redis_client.publish(self.backchannel_id,
+                                              self.compose_message(message_type, body_mimetype, **kwargs))
 
-        self.redis_client.publish(self.backchannel_id, json.dumps(msg_dict))
 
     def process(self):
-        while True:            
-            message = self.redis_pubsub_interface.get_message(timeout=self.timeout_seconds)
+        if self.is_async:
+            # a coroutine handler running in its own process still needs an event loop
+            asyncio.run(self.process_async())
+            return
+
+        if self.transport == 'streams':
+            self.process_stream()
+            return
+
+        # subscribe here rather than in the constructor, so that the subscribed connection
+        # belongs to the handler process and not to the atriumd parent
+        redis_pubsub_interface = self.redis_client.pubsub()
+        redis_pubsub_interface.subscribe(self.channel_id)
+        self.report_status(force=True)
+        self.start_heartbeat()
+
+        while not self.stopped:            
+            message = redis_pubsub_interface.get_message(timeout=self.timeout_seconds)
             if message:
                 if message['type'] == 'subscribe':
                     print('channel-subscription message detected at handler. Skipping.')
+                elif self.is_stop_signal(message):
+                    self.stopped = True
                 else:
-                    self.handle_message(message, self.backchannel_id)
+                    self.run_handler(message)
+
+            self.report_status()
+
+
+    def process_stream(self):
+        '''Receive loop for the Redis Streams transport. Entries are read in batches through
+        the atrium consumer group and acknowledged only after handle_message() returns, so
+        anything in flight when a handler dies stays pending and is delivered again.
+        '''
+
+        ensure_consumer_group(self.redis_client, self.channel_id)
+        self.report_status(force=True)
+        self.start_heartbeat()
+
+        # first replay whatever was delivered to this node but never acknowledged
+        # (e.g. by a previous incarnation of this handler), then switch to new entries
+        read_from = '0'
+        while not self.stopped:
+            response = self.redis_client.xreadgroup(STREAM_CONSUMER_GROUP,
+                                                    STREAM_HANDLER_CONSUMER,
+                                                    {self.channel_id: read_from},
+                                                    count=self.stream_read_count,
+                                                    block=self.timeout_seconds * 1000)
+            entries = response[0][1] if response else []
+
+            if read_from != '>':
+                if not entries:
+                    read_from = '>'
+                    continue
+                read_from = entries[-1][0]
+
+            for entry_id, fields in entries:
+                message = stream_entry_to_message(self.channel_id, entry_id, fields)
+                if self.is_stop_signal(message):
+                    self.redis_client.xack(self.channel_id, STREAM_CONSUMER_GROUP, entry_id)
+                    self.stopped = True
+                    break
+
+                try:
+                    self.run_handler(message)
+                except Exception as err:
+                    # leave the entry pending; the atriumd reclaim sweep will redeliver it
+                    print(f'!!! Error handling stream entry {entry_id} on {self.channel_id}:')
+                    print(err)
+                    traceback.print_exc()
+                    continue
+
+                self.redis_client.xack(self.channel_id, STREAM_CONSUMER_GROUP, entry_id)
+
+            self.report_status()
+
+
+    async def dispatch_async(self, message: dict):
+        '''Synchronous handle_message() implementations are pushed onto the loop's default
+        executor so that they cannot stall the other handlers sharing the loop.
+        '''
+
+        start_time = time.monotonic()
+        if self.is_async:
+            await self.handle_message(message, self.backchannel_id)
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.handle_message, message, self.backchannel_id)
+
+        self.record_latency(start_time)
+
+
+    async def process_async(self):
+        '''Receive loop for running this handler as a coroutine on an asyncio event loop.
+        '''
+
+        self.async_redis_client = aioredis.StrictRedis(**self.redis_params)
+        # cancelled along with the receive loop, so that a stopped handler does not outlive it
+        heartbeat = asyncio.create_task(self.heartbeat_async())
+        try:
+            if self.transport == 'streams':
+                await self.process_stream_async()
+            else:
+                await self.process_pubsub_async()
+        finally:
+            heartbeat.cancel()
+
+
+    async def process_pubsub_async(self):
+        redis_pubsub_interface = self.async_redis_client.pubsub()
+        await redis_pubsub_interface.subscribe(self.channel_id)
+        await self.report_status_async(force=True)
+
+        while not self.stopped:
+            message = await redis_pubsub_interface.get_message(ignore_subscribe_messages=True,
+                                                               timeout=self.timeout_seconds)
+            if message:
+                if self.is_stop_signal(message):
+                    self.stopped = True
+                    continue
+
+                try:
+                    await self.dispatch_async(message)
+
+                except Exception as err:
+                    print(f'!!! Error in async handler listening on channel {self.channel_id}:')
+                    print(err)
+                    traceback.print_exc()
+
+            await self.report_status_async()
+
+
+    async def process_stream_async(self):
+        await ensure_consumer_group_async(self.async_redis_client, self.channel_id)
+        await self.report_status_async(force=True)
+
+        read_from = '0'
+        while not self.stopped:
+            response = await self.async_redis_client.xreadgroup(STREAM_CONSUMER_GROUP,
+                                                                STREAM_HANDLER_CONSUMER,
+                                                                {self.channel_id: read_from},
+                                                                count=self.stream_read_count,
+                                                                block=self.timeout_seconds * 1000)
+            entries = response[0][1] if response else []
+
+            if read_from != '>':
+                if not entries:
+                    read_from = '>'
+                    continue
+                read_from = entries[-1][0]
+
+            for entry_id, fields in entries:
+                message = stream_entry_to_message(self.channel_id, entry_id, fields)
+                if self.is_stop_signal(message):
+                    await self.async_redis_client.xack(self.channel_id, STREAM_CONSUMER_GROUP, entry_id)
+                    self.stopped = True
+                    break
+
+                try:
+                    await self.dispatch_async(message)
+                except Exception as err:
+                    print(f'!!! Error handling stream entry {entry_id} on {self.channel_id}:')
+                    print(err)
+                    traceback.print_exc()
+                    continue
+
+                await self.async_redis_client.xack(self.channel_id, STREAM_CONSUMER_GROUP, entry_id)
+
+            await self.report_status_async()
 
 
 HandlerNode = namedtuple('HandlerNode', 'process_id receive_channel send_channel handler_class handler_instance')
 
+AutoscalePolicy = namedtuple('AutoscalePolicy', 'min_poolsize max_poolsize scale_up_queue_depth scale_up_latency_ms scale_down_queue_depth cooldown_seconds')
+
+
+class HandlerNodeStats(object):
+    '''What atriumd knows about one handler node's load: how many messages it has been sent,
+    and (from the node's own status reports) how many it has processed and how long they took.
+    '''
+
+    def __init__(self):
+        self.forwarded = 0
+        self.processed = 0
+        self.avg_latency_ms = 0.0
+        self.last_report_time = time.monotonic()
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self.forwarded - self.processed, 0)
+
+    def update(self, processed: int, avg_latency_ms: float):
+        self.processed = processed
+        self.avg_latency_ms = avg_latency_ms
+        self.last_report_time = time.monotonic()
+
+
 class Switch(object):
     def __init__(self, **kwargs):        
         self.target_map = {}
         self.dispatch_table = {}        
+        self.routing_keys = {}
+        self.message_counter = itertools.count()
         self.redis_params = {
             'host': kwargs['redis_host'],
             'port': kwargs['redis_port'],
@@ -84,63 +456,360 @@ class Switch(object):
         self.redis_client = redis.StrictRedis(**self.redis_params)
         self.atrium_backchannel = kwargs['rcv_channel_id'] # for message handlers to communicate with atriumd
 
+        # in "batch" forwarding mode, the main loop drains every pending inbound message 
+        # (up to max_batch_size, waiting at most max_linger_ms for stragglers) and
+        # forwards the whole batch through a single Redis pipeline
+        self.forwarding_mode = kwargs.get('forwarding_mode', 'single')
+        self.max_batch_size = int(kwargs.get('max_batch_size', 500))
+        self.max_linger_ms = int(kwargs.get('max_linger_ms', 5))
+
+        # with event_loop set to 'asyncio', handlers are not spawned as child processes;
+        # their receive loops run as coroutines alongside the atriumd main loop
+        self.event_loop = kwargs.get('event_loop', 'process')
+        self.local_handlers = []
+        self.async_redis_client = None
+
+        # with transport set to 'streams', each handler node reads from its own Redis stream
+        # through a consumer group instead of a pub/sub channel; entries persist until acknowledged
+        self.transport = kwargs.get('transport', 'pubsub')
+        self.stream_read_count = int(kwargs.get('stream_read_count', 100))
+        self.stream_maxlen = int(kwargs.get('stream_maxlen', 100000))
+        self.reclaim_idle_ms = int(kwargs.get('reclaim_idle_ms', 60000))
+        self.max_redeliveries = int(kwargs.get('max_redeliveries', 5))
+
+        self.handler_nodes = {}
+        # the hash rings hold receive channel names, which stay the same across restarts;
+        # this maps each name to the node currently serving that channel
+        self.nodes_by_channel = {}
+        self.node_stats = {}
+        self.handler_processes = {}
+        self.handler_tasks = None   # in asyncio mode, populated once run_async() starts the event loop
+        self.retiring_nodes = []
+        self.autoscale_policies = {}
+        self.last_scale_time = {}
+        self.handler_status_interval_seconds = int(kwargs.get('handler_status_interval_seconds', 5))
+
+        # format used by handlers for the messages they send back to atriumd ('json' or 'envelope');
+        # inbound messages in either format are always accepted
+        self.wire_format = kwargs.get('wire_format', WIRE_FORMAT_JSON)
+
+        # supervision: a node that exits or misses heartbeats for heartbeat_timeout_seconds is pulled
+        # from its ring and restarted on the same receive channel; it rejoins once it reports in
+        self.heartbeat_timeout_seconds = int(kwargs.get('heartbeat_timeout_seconds', 30))
+        self.restart_backoff_seconds = int(kwargs.get('restart_backoff_seconds', 5))
+        self.recovering_nodes = {}
+        self.last_restart_time = {}
+
+        # messages of these types are addressed to atriumd itself, not forwarded to a handler
+        self.control_handlers = {
+            HANDLER_STATUS_MESSAGE_TYPE: self.record_handler_status
+        }
+
+        self.housekeeping_interval_seconds = int(kwargs.get('housekeeping_interval_seconds', 10))
+        self.last_housekeeping_time = time.monotonic()
+
+
+    @property
+    def batch_mode(self) -> bool:
+        return self.forwarding_mode == 'batch'
+
+
+    @property
+    def asyncio_mode(self) -> bool:
+        return self.event_loop == 'asyncio'
+
+
+    @property
+    def streams_mode(self) -> bool:
+        return self.transport == 'streams'
+
+
+    def enqueue(self, client, channel_id: str, payload, redeliveries: int=0):
+        '''Hand a message payload to a handler node's receive channel using the configured
+        transport. The client may be a plain or asyncio Redis client, or a pipeline.
+        '''
+
+        if self.streams_mode:
+            return client.xadd(channel_id,
+                               {'data': payload, 'redeliveries': redeliveries},
+                               maxlen=self.stream_maxlen,
+                               approximate=True)
+
+        return client.publish(channel_id, payload)
+
 
     def generate_channel_id(self, message_type: str)->str:
         return f'{message_type}_{uuid.uuid4()}'
 
 
-    def register_message_type(self, msg_type: str, handler_class: MessageHandler):
+    def register_message_type(self, msg_type: str, handler_class: MessageHandler, routing_key: str=None):
+        '''routing_key, if given, names the message field whose value pins a message to a handler node:
+        "header.<field>" for a top-level header field such as sender_pid, or "body.<field>" for a field
+        inside the message body. Messages sharing a key value always go to the same node.
+        '''
+
         self.target_map[msg_type] = handler_class
+        if routing_key:
+            section, _, field_name = routing_key.partition('.')
+            if section not in ('header', 'body') or not field_name:
+                raise InvalidRoutingKey(msg_type, routing_key)
+            self.routing_keys[msg_type] = (section, field_name)
 
 
-    def add_dispatch_target(self, message_type: str, handler_pool_size: int):
-        '''A dispatch target consists of 1 to N handler nodes in a consistent hash ring
-        '''
+    def register_autoscale_policy(self, msg_type: str, policy: AutoscalePolicy):
+        self.autoscale_policies[msg_type] = policy
+        self.last_scale_time[msg_type] = time.monotonic()
 
-        handler_class = self.target_map.get(message_type)
 
-        if not handler_class:
-            raise Exception(f'No handler registered for message type {message_type}.')
+    def spawn_handler_node(self, message_type: str, rcv_channel: str=None) -> HandlerNode:
+        '''Start a handler for this message type. Passing an existing receive channel starts
+        a replacement for a failed node, which picks up where its predecessor left off.
+        '''
 
-        
-        ring_nodes = []
-        for i in range(handler_pool_size):
+        handler_class = self.target_map[message_type]
+        rcv_channel = rcv_channel or self.generate_channel_id(message_type)
 
-            nodename = f'message_type_handler_node_{i}'
-            rcv_channel = self.generate_channel_id(message_type)
+        # each handler node is independent and does not share data with other instances.
+        # Its poll timeout matches the status interval so that idle handlers still send heartbeats.
+        handler = handler_class(rcv_channel,
+                                self.atrium_backchannel,
+                                self.handler_status_interval_seconds,
+                                **self.redis_params)
+        handler.status_interval_seconds = self.handler_status_interval_seconds
+        handler.wire_format = self.wire_format
 
-            # we create P handler instances where P is the poolsize; each handler is independent 
-            # and does not share data with other instances
-            handler = handler_class(rcv_channel, self.atrium_backchannel, 30, **self.redis_params)
+        if self.streams_mode:
+            ensure_consumer_group(self.redis_client, rcv_channel)
+            handler.use_stream_transport(self.stream_read_count)
 
+        if self.asyncio_mode:
+            # the handler's receive loop runs on the atriumd event loop (see run_async),
+            # so the handler node lives in this process
+            self.local_handlers.append(handler)
+            if self.handler_tasks is not None:
+                self.handler_tasks[rcv_channel] = asyncio.get_running_loop().create_task(handler.process_async())
+            pid = os.getpid()
+        else:
             # spawn the message handler as a process
             p = Process(target=handler.process)
             p.start()
-            
-            node = HandlerNode(process_id=p.pid,
-                               receive_channel=rcv_channel,
-                               send_channel=self.atrium_backchannel,
-                               handler_class=handler_class,
-                               handler_instance=handler)
-            
-            print(f'+++ adding handler node (PID {p.pid}) to dispatch target for message type "{message_type}":')
-            print(f'+++ receive channel is {node.receive_channel}\n')
-            
-            ring_nodes.append(node)
+            self.handler_processes[rcv_channel] = p
+            pid = p.pid
+
+        self.node_stats[rcv_channel] = HandlerNodeStats()
+        node = HandlerNode(process_id=pid,
+                           receive_channel=rcv_channel,
+                           send_channel=self.atrium_backchannel,
+                           handler_class=handler_class,
+                           handler_instance=handler)
+        self.nodes_by_channel[rcv_channel] = node
+
+        print(f'+++ adding handler node (PID {pid}) to dispatch target for message type "{message_type}":')
+        print(f'+++ receive channel is {node.receive_channel}\n')
+        return node
+
+
+    def add_dispatch_target(self, message_type: str, handler_pool_size: int):
+        '''A dispatch target consists of 1 to N handler nodes in a consistent hash ring
+        '''
+
+        handler_class = self.target_map.get(message_type)
 
+        if not handler_class:
+            raise Exception(f'No handler registered for message type {message_type}.')
+
+        # we create P handler instances where P is the poolsize
+        ring_nodes = [self.spawn_handler_node(message_type) for i in range(handler_pool_size)]
 
         # create the hash ring and add it to the dispatch table so that we can key on message type;
         # each inbound message (if it is of a recognized type) will be handled by one of the nodes
-        # in the ring
-        hash_ring = HashRing(ring_nodes)
+        # in the ring. The ring is keyed on receive channels, so a restarted node keeps its place.
+        hash_ring = HashRing([node.receive_channel for node in ring_nodes])
 
         #print(f'{len(hash_ring.nodes)} handler(s) in pool for message type {message_type}.')
 
         self.dispatch_table[message_type] = hash_ring
+        self.handler_nodes[message_type] = ring_nodes
 
 
-    def get_atrium_message_type(self, message):
-        '''The Atrium IPC message format is:
+    def handler_is_alive(self, node: HandlerNode) -> bool:
+        if self.asyncio_mode:
+            task = (self.handler_tasks or {}).get(node.receive_channel)
+            return task is None or not task.done()
+
+        return self.handler_processes[node.receive_channel].is_alive()
+
+
+    def node_is_live(self, node: HandlerNode) -> bool:
+        '''A live node is running and has reported in within heartbeat_timeout_seconds
+        '''
+
+        stats = self.node_stats.get(node.receive_channel)
+        if not stats or time.monotonic() - stats.last_report_time >= self.heartbeat_timeout_seconds:
+            return False
+        return self.handler_is_alive(node)
+
+
+    def all_handler_nodes(self):
+        '''Every node which may still hold undelivered messages, including retiring and recovering nodes
+        '''
+
+        for nodes in self.handler_nodes.values():
+            yield from nodes
+        yield from self.retiring_nodes
+        for msg_type, node in self.recovering_nodes.values():
+            yield node
+
+
+    def stop_handler(self, node: HandlerNode):
+        if self.asyncio_mode:
+            task = self.handler_tasks.pop(node.receive_channel, None)
+            if task:
+                task.cancel()
+            self.local_handlers.remove(node.handler_instance)
+            return
+
+        process = self.handler_processes.pop(node.receive_channel)
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+    def supervise(self):
+        '''Pull dead or silent handler nodes out of their hash rings and restart them. A restarted
+        node stays out of the ring until its replacement sends its first heartbeat
+        (see record_handler_status).
+        '''
+
+        now = time.monotonic()
+        for msg_type, nodes in self.handler_nodes.items():
+            for node in list(nodes):
+                if self.node_is_live(node):
+                    continue
+
+                reason = 'has stopped sending heartbeats' if self.handler_is_alive(node) else 'has exited'
+                print(f'!!! handler node (PID {node.process_id}) on channel {node.receive_channel} {reason}. Removing it from the ring.')
+                self.dispatch_table[msg_type].remove_node(node.receive_channel)
+                nodes.remove(node)
+                self.recovering_nodes[node.receive_channel] = (msg_type, node)
+
+        for channel_id, (msg_type, node) in list(self.recovering_nodes.items()):
+            if self.node_is_live(node):
+                # the current incarnation is starting up; give it time to report in
+                continue
+
+            if now - self.last_restart_time.get(channel_id, 0) < self.restart_backoff_seconds:
+                continue
+
+            self.stop_handler(node)
+            replacement = self.spawn_handler_node(msg_type, channel_id)
+            self.recovering_nodes[channel_id] = (msg_type, replacement)
+            self.last_restart_time[channel_id] = now
+            print(f'+++ restarted handler node for message type "{msg_type}" on channel {channel_id} (PID {replacement.process_id}).')
+
+
+    def scale_up(self, message_type: str):
+        node = self.spawn_handler_node(message_type)
+        self.dispatch_table[message_type].add_node(node.receive_channel)
+        self.handler_nodes[message_type].append(node)
+        print(f'+++ scaled UP pool for message type "{message_type}" to {len(self.handler_nodes[message_type])} node(s).')
+
+
+    def scale_down(self, message_type: str):
+        nodes = self.handler_nodes[message_type]
+        node = min(nodes, key=lambda n: self.node_stats[n.receive_channel].queue_depth)
+
+        # take the node out of the ring first so that nothing new is routed to it. The stop signal
+        # then queues up behind every message already sent to the node, which it drains before exiting.
+        self.dispatch_table[message_type].remove_node(node.receive_channel)
+        nodes.remove(node)
+        self.enqueue(self.redis_client, node.receive_channel, HANDLER_STOP_SIGNAL)
+        self.retiring_nodes.append(node)
+        print(f'+++ scaled DOWN pool for message type "{message_type}" to {len(nodes)} node(s).')
+
+
+    def collect_retired_nodes(self):
+        for node in list(self.retiring_nodes):
+            if self.handler_is_alive(node):
+                continue
+
+            if self.streams_mode:
+                # anything still pending on the stream is left for the reclaim sweep to reroute
+                if self.redis_client.xpending(node.receive_channel, STREAM_CONSUMER_GROUP)['pending']:
+                    continue
+                self.redis_client.delete(node.receive_channel)
+
+            self.retiring_nodes.remove(node)
+            self.node_stats.pop(node.receive_channel, None)
+            self.nodes_by_channel.pop(node.receive_channel, None)
+            if self.asyncio_mode:
+                self.local_handlers.remove(node.handler_instance)
+                self.handler_tasks.pop(node.receive_channel, None)
+            else:
+                self.handler_processes.pop(node.receive_channel).join()
+
+            print(f'+++ retired handler node on channel {node.receive_channel}.')
+
+
+    def autoscale(self):
+        '''Grow or shrink each autoscaled pool based on its mean per-node backlog and handler latency.
+        At most one node is added or retired per message type per cooldown period.
+        '''
+
+        now = time.monotonic()
+        for msg_type, policy in self.autoscale_policies.items():
+            if now - self.last_scale_time[msg_type] < policy.cooldown_seconds:
+                continue
+
+            nodes = self.handler_nodes[msg_type]
+            if not nodes:
+                # every node is recovering; leave the pool to the supervisor for now
+                continue
+
+            stats = [self.node_stats[node.receive_channel] for node in nodes]
+            avg_queue_depth = sum(s.queue_depth for s in stats) / len(stats)
+            avg_latency_ms = sum(s.avg_latency_ms for s in stats) / len(stats)
+
+            overloaded = avg_queue_depth >= policy.scale_up_queue_depth or avg_latency_ms >= policy.scale_up_latency_ms
+            if overloaded and len(nodes) < policy.max_poolsize:
+                self.scale_up(msg_type)
+                self.last_scale_time[msg_type] = now
+
+            elif not overloaded and avg_queue_depth <= policy.scale_down_queue_depth and len(nodes) > policy.min_poolsize:
+                self.scale_down(msg_type)
+                self.last_scale_time[msg_type] = now
+
+
+    def record_handler_status(self, inbound: InboundMessage):
+        report = inbound.body()
+        channel_id = report['channel_id']
+        stats = self.node_stats.get(channel_id)
+        if stats:
+            stats.update(int(report['processed']), float(report['avg_latency_ms']))
+
+        recovering = self.recovering_nodes.get(channel_id)
+        if recovering:
+            msg_type, node = recovering
+            if node.process_id != report.get('pid'):
+                # a late report from the incarnation we replaced
+                return
+
+            del self.recovering_nodes[channel_id]
+            self.dispatch_table[msg_type].add_node(channel_id)
+            self.handler_nodes[msg_type].append(node)
+            print(f'+++ handler node on channel {channel_id} has recovered; returning it to the ring.')
+
+
+    def record_forwarded(self, channel_id: str, count: int=1):
+        stats = self.node_stats.get(channel_id)
+        if stats:
+            stats.forwarded += count
+
+
+    def decode_message(self, message) -> InboundMessage:
+        '''Reads the header of an inbound message. Messages in the envelope format 
+        (see atrium_envelope) are routed without parsing the body at all; legacy
+        JSON messages in the format
 
             {
                 message_type: <msg_type>,
@@ -150,45 +819,337 @@ class Switch(object):
                 body: <message_data>
             }
 
+        are still accepted.
         '''
         
-        msg_string = message['data'].decode('UTF-8')
-        msg_object = json.loads(msg_string)
-        msg_type = msg_object.get('message_type')
-            
-        if not msg_type:
-            raise BadMessageHeaderFormat(msg_string, 'message_type')
-        
-        return msg_type
+        inbound = InboundMessage(message['data'])
+        if not inbound.message_type:
+            raise BadMessageHeaderFormat('message_type')
+
+        return inbound
+
+
+    def get_atrium_message_type(self, message):
+        return self.decode_message(message).message_type
+
+
+    def get_routing_key(self, msg_type: str, inbound: InboundMessage):
+        '''Returns the value of the configured routing field for this message type, or None
+        if the message type is not keyed (or the message lacks the field).
+        '''
+
+        key_spec = self.routing_keys.get(msg_type)
+        if not key_spec:
+            return None
+
+        section, field_name = key_spec
+        if section == 'header':
+            return inbound.header_field(field_name)
+
+        # only body-keyed message types pay for decoding the body
+        try:
+            body = inbound.body()
+        except ValueError:
+            return None
+
+        if not isinstance(body, dict):
+            return None
+        return body.get(field_name)
+
+
+    def select_handler_node(self, message:dict, exclude: str=None) -> HandlerNode:
+        '''exclude names a receive channel which must not be selected (a failed node whose
+        entries are being rerouted); a message keyed to it goes to the next node around the ring.
+        '''
+
+        inbound = self.decode_message(message)
+        msg_type = inbound.message_type
+
+        control_handler = self.control_handlers.get(msg_type)
+        if control_handler:
+            # addressed to atriumd itself; there is no handler node to select
+            control_handler(inbound)
+            return None
+
+        hash_ring = self.dispatch_table.get(msg_type)
+        if not hash_ring:
+            raise UnregisteredMessageType(msg_type)
+
+        routing_key = self.get_routing_key(msg_type, inbound)
+        if routing_key is None:
+            # unkeyed messages have no locality to preserve; spread them across the ring
+            routing_key = next(self.message_counter)
+
+        if not self.handler_nodes[msg_type]:
+            raise NoLiveHandlerNodes(msg_type)
+
+        if exclude is None:
+            return self.nodes_by_channel[hash_ring.get_node(str(routing_key))]
+
+        for channel_id in hash_ring.iterate_nodes(str(routing_key)):
+            if channel_id != exclude:
+                return self.nodes_by_channel[channel_id]
+        raise NoLiveHandlerNodes(msg_type)
 
 
     def forward(self, message:dict):
         try:            
-            msg_type = self.get_atrium_message_type(message)
-            print(f'+++ INBOUND message of type [{msg_type}] detected.')
-            '''
-            print('Message content:')
-            print('______________________')
-            print(message)
-            print('______________________')
-            '''
-
-            hash_ring = self.dispatch_table.get(msg_type)
-            if not hash_ring:
-                raise UnregisteredMessageType(msg_type)
-
-            timestamp_string = datetime.datetime.now().isoformat()
-            handler_node = hash_ring.get_node(hash(timestamp_string))
-            print('+++ Selected handler node:')
+            handler_node = self.select_handler_node(message)
+            if not handler_node:
+                return
+
+            print('+++ Selected handler node for INBOUND message:')
             print(f'{handler_node}\n')
             
-            self.redis_client.publish(handler_node.receive_channel, message['data'])
+            self.enqueue(self.redis_client, handler_node.receive_channel, message['data'])
+            self.record_forwarded(handler_node.receive_channel)
 
         except BadMessageHeaderFormat as err:
-            print('!!! inbound message either badly formatted (not JSON) or missing the message_type field.')
+            print('!!! inbound message either badly formatted (not JSON or envelope) or missing the message_type field.')
             raise
 
 
+    def forward_batch(self, messages:list) -> int:
+        '''Route a batch of inbound messages, grouping them by target handler node,
+        and publish the entire batch in a single pipelined round trip.
+
+        Messages which cannot be routed are reported and skipped, so that one bad
+        message does not cost us the rest of the batch. Returns the number of
+        messages forwarded.
+        '''
+
+        node_queues = {}
+        for message in messages:
+            try:
+                handler_node = self.select_handler_node(message)
+                if handler_node:
+                    node_queues.setdefault(handler_node.receive_channel, []).append(message['data'])
+
+            except Exception as err:
+                print('!!! Error routing inbound message: %s' % message)
+                print(err)
+
+        if not node_queues:
+            return 0
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        num_forwarded = 0
+        for channel_id, payloads in node_queues.items():
+            for payload in payloads:
+                self.enqueue(pipeline, channel_id, payload)
+            self.record_forwarded(channel_id, len(payloads))
+            num_forwarded += len(payloads)
+
+        pipeline.execute()
+        print(f'+++ forwarded batch of {num_forwarded} message(s) to {len(node_queues)} handler node(s).\n')
+        return num_forwarded
+
+
+    def reclaim_pending_entries(self) -> int:
+        '''Sweep each handler stream for entries that were delivered but not acknowledged within
+        reclaim_idle_ms (typically because the handler process died mid-batch) and route them
+        through the hash ring again, to any node but the one they were sent to. An entry that has
+        already been redelivered max_redeliveries times is parked on the node's dead-letter stream
+        instead. Returns the number of entries moved.
+
+        Nodes which are still live are left alone: a slow node will acknowledge its batch itself,
+        and a restarted node replays what its predecessor left pending.
+        '''
+
+        num_reclaimed = 0
+        for node in list(self.all_handler_nodes()):
+            if self.node_is_live(node):
+                continue
+
+            stream_key = node.receive_channel
+            pending = self.redis_client.xpending_range(stream_key,
+                                                       STREAM_CONSUMER_GROUP,
+                                                       min='-',
+                                                       max='+',
+                                                       count=self.stream_read_count,
+                                                       idle=self.reclaim_idle_ms)
+            if not pending:
+                continue
+
+            entry_ids = [entry['message_id'] for entry in pending]
+            claimed = self.redis_client.xclaim(stream_key,
+                                               STREAM_CONSUMER_GROUP,
+                                               STREAM_RECLAIM_CONSUMER,
+                                               self.reclaim_idle_ms,
+                                               entry_ids)
+
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for entry_id, fields in claimed:
+                # fields are empty if the entry was trimmed from the stream while pending;
+                # a stop signal is never rerouted, since it was meant only for this node
+                if fields and fields[b'data'] != HANDLER_STOP_SIGNAL:
+                    payload = fields[b'data']
+                    redeliveries = int(fields.get(b'redeliveries', 0)) + 1
+                    if redeliveries > self.max_redeliveries:
+                        pipeline.xadd(f'{stream_key}{DEAD_LETTER_SUFFIX}',
+                                      {'data': payload, 'redeliveries': redeliveries})
+                    else:
+                        try:
+                            target_node = self.select_handler_node({'data': payload}, exclude=stream_key)
+                        except NoLiveHandlerNodes as err:
+                            # the pool may be restarting; leave the entry pending for the next sweep
+                            print(f'!!! Not reclaiming stream entry {entry_id} yet: {err}')
+                            continue
+                        except Exception as err:
+                            # it can never be routed (its type is no longer registered, or it cannot be decoded)
+                            print(f'!!! Cannot reroute stream entry {entry_id}; moving it to the dead-letter stream: {err}')
+                            pipeline.xadd(f'{stream_key}{DEAD_LETTER_SUFFIX}',
+                                          {'data': payload, 'redeliveries': redeliveries})
+                            target_node = None
+
+                        if target_node:
+                            self.enqueue(pipeline, target_node.receive_channel, payload, redeliveries)
+                            self.record_forwarded(target_node.receive_channel)
+
+                pipeline.xack(stream_key, STREAM_CONSUMER_GROUP, entry_id)
+                num_reclaimed += 1
+
+            pipeline.execute()
+
+        return num_reclaimed
+
+
+    def reclaim(self):
+        num_reclaimed = self.reclaim_pending_entries()
+        if num_reclaimed:
+            print(f'+++ reclaimed {num_reclaimed} unacknowledged stream entries.')
+
+
+    def housekeeping(self):
+        '''Periodic maintenance, invoked from the receive loops between messages. A step that
+        fails (on a transient Redis error, say) is logged and tried again on the next pass,
+        without stopping the other steps or the receive loop.
+        '''
+
+        if not self.housekeeping_due():
+            return
+
+        for task in self.housekeeping_tasks():
+            self.run_housekeeping_task(task)
+
+
+    async def housekeeping_async(self):
+        '''housekeeping() for asyncio mode. The Redis sweeps run on a worker thread so that they
+        do not stall the handlers sharing the event loop; the steps which start or stop handler
+        tasks stay on the loop, and make at most one Redis call per node they start or stop.
+        '''
+
+        if not self.housekeeping_due():
+            return
+
+        for task in self.housekeeping_tasks():
+            if task in (self.reclaim, self.collect_retired_nodes):
+                await asyncio.to_thread(self.run_housekeeping_task, task)
+            else:
+                self.run_housekeeping_task(task)
+
+
+    def housekeeping_due(self) -> bool:
+        now = time.monotonic()
+        if now - self.last_housekeeping_time < self.housekeeping_interval_seconds:
+            return False
+        self.last_housekeeping_time = now
+        return True
+
+
+    def housekeeping_tasks(self) -> list:
+        tasks = [self.supervise, self.collect_retired_nodes, self.autoscale]
+        if self.streams_mode:
+            tasks.insert(0, self.reclaim)
+        return tasks
+
+
+    def run_housekeeping_task(self, task):
+        try:
+            task()
+        except Exception as err:
+            print(f'!!! Error during housekeeping ({task.__name__}):')
+            print(err)
+            traceback.print_exc()
+
+
+    async def forward_async(self, message:dict):
+        handler_node = self.select_handler_node(message)
+        if handler_node:
+            await self.enqueue(self.async_redis_client, handler_node.receive_channel, message['data'])
+            self.record_forwarded(handler_node.receive_channel)
+
+
+    async def forward_batch_async(self, messages:list) -> int:
+        node_queues = {}
+        for message in messages:
+            try:
+                handler_node = self.select_handler_node(message)
+                if handler_node:
+                    node_queues.setdefault(handler_node.receive_channel, []).append(message['data'])
+
+            except Exception as err:
+                print('!!! Error routing inbound message: %s' % message)
+                print(err)
+
+        if not node_queues:
+            return 0
+
+        num_forwarded = 0
+        async with self.async_redis_client.pipeline(transaction=False) as pipeline:
+            for channel_id, payloads in node_queues.items():
+                for payload in payloads:
+                    self.enqueue(pipeline, channel_id, payload)
+                self.record_forwarded(channel_id, len(payloads))
+                num_forwarded += len(payloads)
+
+            await pipeline.execute()
+
+        return num_forwarded
+
+
+    async def run_async(self, rcv_channel_id: str):
+        '''Main receive loop for asyncio mode. Every locally-hosted handler runs as a task
+        on the same event loop as this coroutine.
+        '''
+
+        self.async_redis_client = aioredis.StrictRedis(**self.redis_params)
+        self.handler_tasks = {handler.channel_id: asyncio.create_task(handler.process_async()) for handler in self.local_handlers}
+        print(f'> atriumd (asyncio mode) multiplexing {len(self.handler_tasks)} handler(s) on one event loop.')
+
+        redis_pubsub_interface = self.async_redis_client.pubsub()
+        await redis_pubsub_interface.subscribe(rcv_channel_id)
+
+        while True:
+            message = await redis_pubsub_interface.get_message(ignore_subscribe_messages=True,
+                                                               timeout=self.housekeeping_interval_seconds)
+            await self.housekeeping_async()
+            if not message:
+                continue
+
+            try:
+                if not self.batch_mode:
+                    await self.forward_async(message)
+                    continue
+
+                batch = [message]
+                deadline = time.monotonic() + (self.max_linger_ms / 1000.0)
+                while len(batch) < self.max_batch_size:
+                    remaining_seconds = max(deadline - time.monotonic(), 0)
+                    message = await redis_pubsub_interface.get_message(ignore_subscribe_messages=True,
+                                                                       timeout=remaining_seconds)
+                    if not message:
+                        break
+                    batch.append(message)
+
+                await self.forward_batch_async(batch)
+
+            except Exception as err:
+                print('!!! Error processing inbound message: %s' % message)
+                print(err)
+                traceback.print_exc()
+
+
 class SwitchBuilder(object):
     
     @staticmethod
@@ -201,14 +1162,75 @@ class SwitchBuilder(object):
             
             handler_classname = handler_config['handler_class']
             handler_class = common.load_class(handler_classname, handler_module_name)
-            switch.register_message_type(msg_type, handler_class)
+            switch.register_message_type(msg_type, handler_class, handler_config.get('routing_key'))
             handler_pool_size = int(handler_config.get('handler_poolsize', 1))
+
+            autoscale_config = handler_config.get('autoscale')
+            if autoscale_config:
+                policy = AutoscalePolicy(min_poolsize=int(autoscale_config.get('min_poolsize', 1)),
+                                         max_poolsize=int(autoscale_config.get('max_poolsize', handler_pool_size)),
+                                         scale_up_queue_depth=int(autoscale_config.get('scale_up_queue_depth', 100)),
+                                         scale_up_latency_ms=float(autoscale_config.get('scale_up_latency_ms', 1000)),
+                                         scale_down_queue_depth=int(autoscale_config.get('scale_down_queue_depth', 0)),
+                                         cooldown_seconds=int(autoscale_config.get('cooldown_seconds', 30)))
+
+                switch.register_autoscale_policy(msg_type, policy)
+                handler_pool_size = min(max(handler_pool_size, policy.min_poolsize), policy.max_poolsize)
             
             switch.add_dispatch_target(msg_type, handler_pool_size)
 
         return switch
 
 
+def drain_pending_messages(redis_pubsub_interface, max_batch_size: int, max_linger_ms: int, poll_timeout: int=60) -> list:
+    '''Block (for up to poll_timeout seconds) until at least one message arrives, then keep pulling
+    whatever is already pending (waiting no longer than max_linger_ms in total) until the batch is full.
+    '''
+
+    batch = []
+    message = redis_pubsub_interface.get_message(timeout=poll_timeout)
+    if not message:
+        return batch
+
+    deadline = time.monotonic() + (max_linger_ms / 1000.0)
+    while message:
+        if message['type'] == 'message':
+            batch.append(message)
+
+        if len(batch) >= max_batch_size:
+            break
+
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            # out of linger time; take only what is already sitting in the socket buffer
+            message = redis_pubsub_interface.get_message(timeout=0)
+        else:
+            message = redis_pubsub_interface.get_message(timeout=remaining_seconds)
+
+    return batch
+
+
+def batched_receive_loop(switch: Switch, redis_pubsub_interface, rcv_channel_id: str):
+    while True:
+        print(f'> atriumd (batch mode) waiting for messages on channel "{rcv_channel_id}"...')
+
+        batch = drain_pending_messages(redis_pubsub_interface,
+                                       switch.max_batch_size,
+                                       switch.max_linger_ms,
+                                       switch.housekeeping_interval_seconds)
+        switch.housekeeping()
+        if not batch:
+            continue
+
+        print(f'> {len(batch)} message(s) received. Invoking batch dispatch...')
+        try:
+            switch.forward_batch(batch)
+        except Exception as err:
+            print('!!! Error forwarding batch of %d inbound messages.' % len(batch))
+            print(err)
+            traceback.print_exc()
+
+
 def main(args):
 
     configfile_name = args['<configfile>']
@@ -220,6 +1242,10 @@ def main(args):
 
     switch = SwitchBuilder.build(yaml_config)
 
+    if switch.asyncio_mode:
+        asyncio.run(switch.run_async(rcv_channel_id))
+        return
+
     redis_client = redis.StrictRedis(host=atrium_settings['redis_host'],
                                      port=atrium_settings['redis_port'],
                                      db=atrium_settings['redis_db'])
@@ -228,10 +1254,15 @@ def main(args):
     redis_pubsub_interface.subscribe(rcv_channel_id)
 
 
+    if switch.batch_mode:
+        batched_receive_loop(switch, redis_pubsub_interface, rcv_channel_id)
+        return
+
     while True:
         print(f'> atriumd waiting for messages on channel "{rcv_channel_id}"...')
         
-        message = redis_pubsub_interface.get_message(timeout=60)
+        message = redis_pubsub_interface.get_message(timeout=switch.housekeeping_interval_seconds)
+        switch.housekeeping()
         if message:
 
             if message['type'] == 'subscribe':
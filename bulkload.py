@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+'''
+Batched loading of provisioning data (users, groups, group memberships) into the Pulse DB.
+
+Records are streamed from a CSV file (with a header row) or a JSONL file, converted to
+table rows, and inserted in batches with one executemany per batch over a
+PostgreSQLService.connect() connection. A batch the database refuses is retried one row
+at a time, so that only the offending rows are rejected; rejected rows go to a side file
+(one JSON document per line) along with the reason, and the load carries on.
+'''
+
+import os, sys
+import csv
+import json
+import time
+import datetime
+
+
+class RejectedRow(Exception):
+    def __init__(self, reason, record=None):
+        super().__init__(self, reason)
+        self.reason = reason
+        self.record = record
+
+
+def read_records(filename: str):
+    '''yields (line number, record dict) for each record in a .csv or .jsonl file. A line that
+    is not a JSON object is yielded as (line number, RejectedRow), so that the load can carry on.
+    '''
+
+    extension = os.path.splitext(filename)[1].lower()
+    with open(filename, newline='') as f:
+        if extension == '.csv':
+            # line 1 is the header
+            for line_number, record in enumerate(csv.DictReader(f), 2):
+                yield (line_number, {key: value for key, value in record.items() if value != ''})
+
+        elif extension in ('.jsonl', '.json'):
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as err:
+                    yield (line_number, RejectedRow(f'malformed JSON: {err}', line))
+                    continue
+
+                if not isinstance(record, dict):
+                    yield (line_number, RejectedRow('record is not a JSON object', record))
+                    continue
+                yield (line_number, record)
+
+        else:
+            raise Exception('Unsupported data file type "%s". Provisioning data must be .csv or .jsonl.' % extension)
+
+
+def now():
+    return datetime.datetime.now()
+
+
+class BulkLoader(object):
+    def __init__(self, db_svc, table_name: str, **kwargs):
+        self.db_svc = db_svc
+        self.table = getattr(db_svc.Base.classes, table_name).__table__
+        self.batch_size = int(kwargs.get('batch_size') or 5000)
+        self.rejects_filename = kwargs.get('rejects_file') or '%s_rejects.jsonl' % table_name
+        self.rejects_file = None
+
+        self.loaded = 0
+        self.rejected = 0
+        self.start_time = None
+
+
+    def reject(self, line_number, record, reason):
+        if self.rejects_file is None:
+            self.rejects_file = open(self.rejects_filename, 'a')
+
+        self.rejects_file.write(json.dumps({
+            'table': self.table.name,
+            'line': line_number,
+            'reason': reason,
+            'record': record
+        }, default=str) + '\n')
+        self.rejected += 1
+
+
+    def insert_batch(self, batch: list):
+        '''batch is a list of (line number, record, row) tuples
+        '''
+
+        rows = [row for _, _, row in batch]
+        try:
+            with self.db_svc.connect() as connection:
+                with connection.begin():
+                    connection.execute(self.table.insert(), rows)
+            self.loaded += len(rows)
+            return
+
+        except Exception as err:
+            if len(batch) == 1:
+                line_number, record, _ = batch[0]
+                self.reject(line_number, record, str(getattr(err, 'orig', err)).strip())
+                return
+
+        # something in the batch was refused; find out which rows, keeping the rest
+        with self.db_svc.connect() as connection:
+            with connection.begin():
+                for line_number, record, row in batch:
+                    savepoint = connection.begin_nested()
+                    try:
+                        connection.execute(self.table.insert(), [row])
+                        savepoint.commit()
+                        self.loaded += 1
+                    except Exception as err:
+                        savepoint.rollback()
+                        self.reject(line_number, record, str(getattr(err, 'orig', err)).strip())
+
+
+    def report_progress(self, final=False):
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        print('%s %s: %d row(s) loaded, %d rejected, %.1f rows/sec' % ('###' if final else '...',
+                                                                      self.table.name,
+                                                                      self.loaded,
+                                                                      self.rejected,
+                                                                      self.loaded / elapsed),
+              file=sys.stderr)
+
+
+    def load(self, records, prepare_row, on_batch_loaded=None) -> dict:
+        '''prepare_row(record) returns the table row (a dict) for a record, or raises RejectedRow.
+        on_batch_loaded, if given, is called with each list of rows sent to the database.
+        '''
+
+        self.start_time = time.monotonic()
+        batch = []
+
+        try:
+            for line_number, record in records:
+                if isinstance(record, RejectedRow):
+                    self.reject(line_number, record.record, record.reason)
+                    continue
+
+                try:
+                    batch.append((line_number, record, prepare_row(record)))
+                except RejectedRow as err:
+                    self.reject(line_number, record, err.reason)
+                    continue
+
+                if len(batch) >= self.batch_size:
+                    self.insert_batch(batch)
+                    if on_batch_loaded:
+                        on_batch_loaded([row for _, _, row in batch])
+                    batch = []
+                    self.report_progress()
+
+            if batch:
+                self.insert_batch(batch)
+                if on_batch_loaded:
+                    on_batch_loaded([row for _, _, row in batch])
+
+        finally:
+            if self.rejects_file is not None:
+                self.rejects_file.close()
+
+        self.report_progress(final=True)
+        if self.rejected:
+            print('### rejected rows were written to %s' % self.rejects_filename, file=sys.stderr)
+
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        return {
+            'table': self.table.name,
+            'loaded': self.loaded,
+            'rejected': self.rejected,
+            'seconds': elapsed,
+            'rows_per_second': self.loaded / elapsed
+        }
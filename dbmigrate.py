@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+
+'''
+Usage:
+    dbmigrate --dbconfig <configfile> [--target <version>] [--dir <migration_dir>]
+    dbmigrate --dbconfig <configfile> --status [--dir <migration_dir>]
+
+Options:
+    --target <version>      apply pending migrations up to and including this version (default: all)
+    --dir <migration_dir>   where the migration files live [default: sql/migrations]
+    --status                list the migrations and whether each has been applied
+
+Applies the versioned SQL migrations in <migration_dir> to the Pulse DB, in order.
+Migration files are named <version>_<name>.sql (for example 0002_role_assignments_entity_index.sql).
+Each runs in its own transaction, together with its entry in the schema_migrations
+table, so a migration that fails leaves the schema as it was and can be re-run.
+'''
+
+
+import os, sys
+import re
+import json
+import time
+from collections import namedtuple
+from snap import snap, common
+import docopt
+
+
+MIGRATION_FILE_RX = re.compile(r'^([0-9]+)_([A-Za-z0-9_]+)\.sql$')
+
+SCHEMA_MIGRATIONS_DDL = '''
+CREATE TABLE IF NOT EXISTS "schema_migrations" (
+  "version" int4 NOT NULL,
+  "name" varchar(255) NOT NULL,
+  "applied_ts" timestamptz NOT NULL DEFAULT now(),
+  PRIMARY KEY ("version")
+)
+'''
+
+Migration = namedtuple('Migration', 'version name filename')
+
+
+def execute_script(connection, script_sql: str):
+    '''runs SQL written for psql, without parameters. Otherwise the driver would read each
+    "%" in the script (format() patterns, RAISE messages, the modulo operator) as a placeholder.
+    '''
+
+    return connection.exec_driver_sql(script_sql, execution_options={'no_parameters': True})
+
+
+def load_migrations(migration_dir: str) -> list:
+    migrations = []
+    for filename in os.listdir(migration_dir):
+        match = MIGRATION_FILE_RX.match(filename)
+        if match:
+            migrations.append(Migration(version=int(match.group(1)),
+                                        name=match.group(2),
+                                        filename=os.path.join(migration_dir, filename)))
+
+    migrations.sort(key=lambda m: m.version)
+    for previous, migration in zip(migrations, migrations[1:]):
+        if previous.version == migration.version:
+            raise Exception('Migrations %s and %s have the same version number.' % (previous.filename, migration.filename))
+
+    return migrations
+
+
+def applied_versions(connection) -> set:
+    with connection.begin():
+        connection.exec_driver_sql(SCHEMA_MIGRATIONS_DDL)
+        return {row[0] for row in connection.exec_driver_sql('SELECT "version" FROM "schema_migrations"')}
+
+
+def apply_migrations(connection, migrations: list, target_version: int=None) -> list:
+    '''applies (in order) each migration not yet recorded in schema_migrations, up to
+    target_version if given, and returns the ones applied
+    '''
+
+    applied = applied_versions(connection)
+    completed = []
+    for migration in migrations:
+        if migration.version in applied:
+            continue
+        if target_version is not None and migration.version > target_version:
+            break
+
+        with open(migration.filename) as f:
+            migration_sql = f.read()
+
+        start_time = time.monotonic()
+        with connection.begin():
+            execute_script(connection, migration_sql)
+            connection.exec_driver_sql('INSERT INTO "schema_migrations" ("version", "name") VALUES (%(version)s, %(name)s)',
+                                       {'version': migration.version, 'name': migration.name})
+
+        print('### applied migration %04d %s in %.2f seconds' % (migration.version, migration.name, time.monotonic() - start_time),
+              file=sys.stderr)
+        completed.append(migration)
+
+    return completed
+
+
+def main(args):
+
+    configfile = args['<configfile>']
+    yaml_config = common.read_config_file(configfile)
+    service_registry = common.ServiceObjectRegistry(snap.initialize_services(yaml_config))
+
+    db_svc = service_registry.lookup('postgres')
+    migrations = load_migrations(args['--dir'])
+
+    with db_svc.connect() as connection:
+        if args['--status']:
+            applied = applied_versions(connection)
+            for migration in migrations:
+                print('%04d %-48s %s' % (migration.version, migration.name, 'applied' if migration.version in applied else 'pending'))
+            return
+
+        target_version = int(args['--target']) if args['--target'] else None
+        completed = apply_migrations(connection, migrations, target_version)
+
+    if not completed:
+        print('### schema is up to date', file=sys.stderr)
+    print(json.dumps([migration._asdict() for migration in completed]))
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
@@ -2,23 +2,136 @@
 
 
 '''
+Usage:
+    mkgroup --dbconfig <configfile> --name <groupname> [--desc <description>]
+    mkgroup --dbconfig <configfile> --bulk <datafile> [--batch-size <n>] [--rejects <rejects_file>]
+    mkgroup --dbconfig <configfile> --members <datafile> [--batch-size <n>] [--rejects <rejects_file>]
 
+Options:
+    --bulk <datafile>           load groups from a .csv (with a header row) or .jsonl file, with the fields
+                                name and (optionally) id, description, is_active
+    --members <datafile>        load group memberships, each naming the user (user_id or username)
+                                and the group (group_id or group)
+    --batch-size <n>            rows per insert batch [default: 5000]
+    --rejects <rejects_file>    where rows that cannot be loaded are written
 '''
 
 
 import os, sys
 import json
-from snap import common
+import uuid
+import datetime
+from snap import snap, common
 import docopt
+from bulkload import BulkLoader, RejectedRow, read_records
+
+
+def generate_uuid():
+    newid = uuid.uuid4()
+    return str(newid)
+
+
+def now():
+    return datetime.datetime.now()
+
+
+def is_true(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ('true', '1', 'yes', 't', 'y')
+
+
+def prepare_group_row(record: dict) -> dict:
+    if not record.get('name'):
+        raise RejectedRow('missing required field "name"')
+
+    return {
+        'id': record.get('id') or generate_uuid(),
+        'name': record['name'],
+        'description': record.get('description'),
+        'is_active': is_true(record.get('is_active', True)),
+        'created_ts': now()
+    }
+
+
+class MembershipResolver(object):
+    '''Resolves usernames and group names to IDs. Each lookup table is read in one query,
+    the first time a record names a user or group instead of giving its ID.
+    '''
+
+    def __init__(self, db_svc):
+        self.db_svc = db_svc
+        self.user_ids = None
+        self.group_ids = None
+
+    def read_ids(self, table_name: str, key_column: str) -> dict:
+        table = getattr(self.db_svc.Base.classes, table_name).__table__
+        query = table.select().with_only_columns(table.c[key_column], table.c.id).where(table.c.deleted_ts == None)
+        with self.db_svc.connect() as connection:
+            return {key: str(id) for key, id in connection.execute(query)}
+
+    def user_id(self, record: dict) -> str:
+        if record.get('user_id'):
+            return record['user_id']
+        if not record.get('username'):
+            raise RejectedRow('a membership needs a user_id or a username')
+
+        if self.user_ids is None:
+            self.user_ids = self.read_ids('users', 'username')
+        user_id = self.user_ids.get(record['username'])
+        if not user_id:
+            raise RejectedRow(f'no such user "{record["username"]}"')
+        return user_id
+
+    def group_id(self, record: dict) -> str:
+        if record.get('group_id'):
+            return record['group_id']
+        if not record.get('group'):
+            raise RejectedRow('a membership needs a group_id or a group')
+
+        if self.group_ids is None:
+            self.group_ids = self.read_ids('groups', 'name')
+        group_id = self.group_ids.get(record['group'])
+        if not group_id:
+            raise RejectedRow(f'no such group "{record["group"]}"')
+        return group_id
+
+    def prepare_membership_row(self, record: dict) -> dict:
+        return {
+            'user_id': self.user_id(record),
+            'group_id': self.group_id(record)
+        }
 
 
 def main(args):
-    pass
+
+    configfile = args['<configfile>']
+    yaml_config = common.read_config_file(configfile)
+    service_registry = common.ServiceObjectRegistry(snap.initialize_services(yaml_config))
+
+    db_svc = service_registry.lookup('postgres')
+
+    if args['--bulk']:
+        loader = BulkLoader(db_svc, 'groups', batch_size=args['--batch-size'], rejects_file=args['--rejects'])
+        print(json.dumps(loader.load(read_records(args['--bulk']), prepare_group_row)))
+        return
+
+    if args['--members']:
+        resolver = MembershipResolver(db_svc)
+        loader = BulkLoader(db_svc, 'group_memberships', batch_size=args['--batch-size'], rejects_file=args['--rejects'])
+        print(json.dumps(loader.load(read_records(args['--members']), resolver.prepare_membership_row)))
+        return
+
+    with db_svc.txn_scope() as session:
+        Group = db_svc.Base.classes.groups
+        session.add(Group(**prepare_group_row({
+            'name': args['<groupname>'],
+            'description': args['<description>']
+        })))
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     main(args)
 
-    
 
@@ -4,6 +4,14 @@
 '''
 Usage:
     mkuser --dbconfig <configfile> --name <username> --email <email> --pk-uri <public_key_uri> [--params=<name:value>...]
+    mkuser --dbconfig <configfile> --bulk <datafile> [--batch-size <n>] [--rejects <rejects_file>]
+
+Options:
+    --bulk <datafile>           load users from a .csv (with a header row) or .jsonl file, with the fields
+                                username, email, sms_phone_number and (optionally) id, password,
+                                sms_country_code, public_key_uri, status
+    --batch-size <n>            rows per insert batch [default: 5000]
+    --rejects <rejects_file>    where rows that cannot be loaded are written [default: users_rejects.jsonl]
 '''
 
 
@@ -13,6 +21,8 @@ import uuid
 import datetime
 from snap import snap, common
 import docopt
+from pulse_services import invalidate_user_identity, normalize_mobile_number
+from bulkload import BulkLoader, RejectedRow, read_records
 
 def generate_temp_password():
     return 'ch4ng3-me-1st'
@@ -34,17 +44,79 @@ def now():
     return datetime.datetime.now()
 
 
+def prepare_user_row(record: dict) -> dict:
+    for field in ['username', 'email']:
+        if not record.get(field):
+            raise RejectedRow(f'missing required field "{field}"')
+
+    sms_phone_number = None
+    if record.get('sms_phone_number'):
+        sms_phone_number = normalize_mobile_number(str(record['sms_phone_number']))
+        if not sms_phone_number.isdigit():
+            raise RejectedRow(f'invalid SMS phone number "{record["sms_phone_number"]}"')
+
+    try:
+        status = int(record.get('status') or 1)
+    except (TypeError, ValueError):
+        raise RejectedRow(f'invalid status "{record["status"]}"; status must be an integer')
+
+    return {
+        'id': record.get('id') or generate_uuid(),
+        'username': record['username'],
+        'password': record.get('password') or generate_temp_password(),
+        'email': record['email'],
+        'sms_country_code': str(record.get('sms_country_code') or '1'),
+        'sms_phone_number': sms_phone_number,
+        'public_key_uri': record.get('public_key_uri'),
+        'status': status,
+        'created_ts': now()
+    }
+
+
+def atrium_redis_client(service_registry):
+    try:
+        return service_registry.lookup('atrium').redis_client
+    except common.UnregisteredServiceObjectException:
+        print('No atrium service configured; running Pulse processes will see new users once their cached entries for these numbers expire.', file=sys.stderr)
+        return None
+
+
+def bulk_load_users(args, db_svc, service_registry):
+    redis_client = atrium_redis_client(service_registry)
+
+    def invalidate_batch(rows):
+        if redis_client is None:
+            return
+        # the numbers may be negatively cached from before the users existed
+        pipeline = redis_client.pipeline(transaction=False)
+        for row in rows:
+            if row['sms_phone_number']:
+                invalidate_user_identity(pipeline, row['sms_phone_number'])
+        pipeline.execute()
+
+    loader = BulkLoader(db_svc, 'users', batch_size=args['--batch-size'], rejects_file=args['--rejects'])
+    results = loader.load(read_records(args['--bulk']), prepare_user_row, on_batch_loaded=invalidate_batch)
+    print(json.dumps(results))
+
+
 def main(args):
 
     configfile = args['<configfile>']
     yaml_config = common.read_config_file(configfile)
     service_registry = common.ServiceObjectRegistry(snap.initialize_services(yaml_config))
 
+    db_svc = service_registry.lookup('postgres')
+
+    if args['--bulk']:
+        bulk_load_users(args, db_svc, service_registry)
+        return
+
     username = args['<username>']
     email_addr = args['<email>']
     temp_password = generate_temp_password()
 
-    db_svc = service_registry.lookup('postgres')
+    sms_phone_number = '9174176968'
+
     with db_svc.txn_scope() as session:
         new_user = ObjectFactory.create_pulse_user(db_svc, **{
             'id': generate_uuid(),
@@ -52,17 +124,21 @@ def main(args):
             'password': temp_password,
             'email': email_addr,
             'sms_country_code': '1',
-            'sms_phone_number': '9174176968',
+            'sms_phone_number': sms_phone_number,
             'status': 1,
             'created_ts': now()
         })
 
         session.add(new_user)
 
+    # the number may be negatively cached from before the user existed
+    redis_client = atrium_redis_client(service_registry)
+    if redis_client is not None:
+        invalidate_user_identity(redis_client, sms_phone_number)
+
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     main(args)
 
-    
 
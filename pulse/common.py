@@ -1,7 +1,191 @@
 #!/usr/bin/env python
 
+import sys
 import re
+from functools import lru_cache
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from snap import common
+from pulse_services import sms_segment_count
+
+
+POS_INTEGER_RX = re.compile(r'^[0-9]+$')
+NEG_INTEGER_RX = re.compile(r'^-[0-9]+$')
+RANGE_RX = re.compile(r'^[0-9]+\-[0-9]+$')
+PAGE_RX = re.compile(r'^p[0-9]+$')
+
+PAGE_PREFIX = 'p'
+# a page of listing output is at most this many SMS segments long
+DEFAULT_PAGE_SEGMENTS = 3
+PAGE_BREAK = '\n\n'
+
+SELECT_ALL = 'all'
+SELECT_INDEX = 'index'
+SELECT_NEGATIVE_INDEX = 'negative_index'
+SELECT_RANGE = 'range'
+SELECT_PAGE = 'page'
+SELECT_UNKNOWN = 'unknown'
+
+# the parsed form of a listing command such as my?foo.3:
+# filter_expression is '*' when there is no filter; start and end are the (1-based, inclusive)
+# bounds of an index or range selector, a negative offset for a negative index, or the page number
+# for a page selector (my.p2, the continuation token appended to a paged listing).
+# base_command is the command string up to the specifier, used to build continuation tokens.
+ListSelector = namedtuple('ListSelector', 'filter_expression selector_type start end base_command')
+
+
+@lru_cache(maxsize=None)
+def filter_patterns(filterchar: str, specifier: str):
+    '''The filter-expression regexes for one (filterchar, specifier) pair, compiled once
+    '''
+
+    fchar_seq = re.escape(filterchar)
+    filter_expr_at_end_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+$'.format(fchar=fchar_seq))
+    filter_expr_with_ext_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+.'.format(fchar=fchar_seq))
+    return (filter_expr_at_end_rx, filter_expr_with_ext_rx)
+
+
+def extract_filter_expression(command_string: str, filterchar: str, specifier: str) -> str:
+    '''
+    <cmd><filter_char><exp>.<selector>
+
+    or
+
+    <cmd><filter_char><exp>
+    '''
+
+    filter_expr_at_end_rx, filter_expr_with_ext_rx = filter_patterns(filterchar, specifier)
+
+    #
+    # the filter expression is the part of the command string between the filter character and:
+    # -- end of string if there is no specifier char; or
+    # -- the specifier char.
+    #
+    #
+
+    match = filter_expr_at_end_rx.search(command_string)
+    if match:
+        start_index = match.span()[0]
+        extent = match.span()[1]
+        return command_string[start_index:extent].lstrip(filterchar)
+
+    match = filter_expr_with_ext_rx.search(command_string)
+    if match:
+        start_index = match.span()[0]
+        extent = match.span()[1]
+        return command_string[start_index:extent].lstrip(filterchar).rstrip(specifier)
+
+    return '*'  # if no match, filter expression is wildcard
+
+
+@lru_cache(maxsize=1024)
+def parse_list_selector(command_string: str, filterchar: str, specifier: str) -> ListSelector:
+    '''Parse a listing command string once; repeated commands (my, my.1, my?foo.3)
+    come straight out of the LRU cache without any regex work.
+    '''
+
+    filter_expression = extract_filter_expression(command_string, filterchar, specifier)
+
+    # we will either receive a plain command string,
+    # or a command string followed immediately by specifier
+    # and an extension (for lists, usually a numerical selector)
+    #
+    tokens = command_string.split(specifier)
+    base_command = tokens[0]
+    if len(tokens) == 1:
+        return ListSelector(filter_expression, SELECT_ALL, None, None, base_command)
+
+    # the "extension" is the part of the command string immediately
+    # following the specifier character.
+    ext = tokens[1]
+    if POS_INTEGER_RX.match(ext):
+        return ListSelector(filter_expression, SELECT_INDEX, int(ext), int(ext), base_command)
+
+    if NEG_INTEGER_RX.match(ext):
+        return ListSelector(filter_expression, SELECT_NEGATIVE_INDEX, int(ext), int(ext), base_command)
+
+    if RANGE_RX.match(ext):
+        range_tokens = ext.split('-')
+        return ListSelector(filter_expression, SELECT_RANGE, int(range_tokens[0]), int(range_tokens[1]), base_command)
+
+    if PAGE_RX.match(ext):
+        page_number = int(ext[len(PAGE_PREFIX):])
+        return ListSelector(filter_expression, SELECT_PAGE, page_number, page_number, base_command)
+
+    return ListSelector(filter_expression, SELECT_UNKNOWN, None, None, base_command)
+
+
+class PagedRecordSource(object):
+    '''A record source that is read a page at a time, so that a listing command only
+    pulls the records it is going to show.
+
+    fetch_function(offset, limit) must return a list of at most <limit> records
+    starting at <offset> (for a SQL source, a query with OFFSET and LIMIT).
+    '''
+
+    def __init__(self, fetch_function, **kwargs):
+        self.fetch_function = fetch_function
+        self.fetch_size = int(kwargs.get('fetch_size', 50))
+
+    def __iter__(self):
+        offset = 0
+        while True:
+            page = self.fetch_function(offset, self.fetch_size)
+            for record in page:
+                yield record
+            if len(page) < self.fetch_size:
+                return
+            offset += len(page)
+
+    def slice(self, start, stop):
+        '''records [start, stop), zero-based, fetched directly without reading the records before them
+        '''
+
+        if stop <= start:
+            return []
+        return list(self.fetch_function(start, stop - start))
+
+
+def select_records(records, filter_function, filter_expression):
+    '''Lazily apply the filter expression (if any) to any iterable of records
+    '''
+
+    if filter_expression == '*':
+        return records
+    return (record for record in records if filter_function(record, filter_expression))
+
+
+def slice_records(records, start: int, stop: int):
+    '''Returns (records [start, stop), zero-based; total), where total is the number of records
+    in the source if it ran out before <stop>, and None otherwise.
+
+    Only a PagedRecordSource can skip ahead without reading the records before <start>;
+    any other iterable is consumed up to <stop>.
+    '''
+
+    if isinstance(records, PagedRecordSource):
+        found = records.slice(start, stop)
+        if len(found) == stop - start:
+            return (found, None)
+        if found:
+            return (found, start + len(found))
+        # nothing at or past <start>, so the only way to learn the size is to read the source
+        return (found, sum(1 for _ in records))
+
+    if isinstance(records, (list, tuple)):
+        found = list(records[start:stop])
+        return (found, None if len(found) == stop - start else len(records))
+
+    found = []
+    count = 0
+    for record in records:
+        if count >= start:
+            found.append(record)
+        count += 1
+        if count >= stop:
+            return (found, None)
+
+    return (found, count)
 
 
 class ListOutputResponder(object):
@@ -10,9 +194,20 @@ class ListOutputResponder(object):
         self.command_parse_func = command_parse_function
         self.singular_item_noun = kwargs.get('single_item_noun', 'object')
         self.plural_item_noun = kwargs.get('plural_item_noun', 'objects')
-        self.pos_integer_rx = re.compile(r'^[0-9]+$')
-        self.neg_integer_rx = re.compile(r'^-[0-9]+$')
-        self.range_rx = re.compile(r'^[0-9]+\-[0-9]+$')
+        self.pos_integer_rx = POS_INTEGER_RX
+        self.neg_integer_rx = NEG_INTEGER_RX
+        self.range_rx = RANGE_RX
+        self.page_segments = int(kwargs.get('page_segments', DEFAULT_PAGE_SEGMENTS))
+
+        # chained commands over a range (my.1-20+<modifiers>) run one after another unless
+        # chain_concurrency > 1, in which case they fan out over a thread pool and the whole
+        # range gets chain_timeout_seconds to finish
+        self.chain_concurrency = int(kwargs.get('chain_concurrency', 1))
+        self.chain_timeout_seconds = kwargs.get('chain_timeout_seconds')
+        self.chain_executor = None
+        if self.chain_concurrency > 1:
+            self.chain_executor = ThreadPoolExecutor(max_workers=self.chain_concurrency,
+                                                     thread_name_prefix='list_chain')
 
     def extension_is_positive_num(self, ext_string):
         if self.pos_integer_rx.match(ext_string):
@@ -37,42 +232,131 @@ class ListOutputResponder(object):
 
         <cmd><filter_char><exp>
         '''
-        CHARS_TO_ESCAPE = ['?', '+']
 
-        command_string = cmd_object.cmd_string
-        fchar = cmd_object.cmdspec.filterchar
-        spec = cmd_object.cmdspec.specifier
+        return self.parse_selector(cmd_object).filter_expression
 
-        if fchar in CHARS_TO_ESCAPE:
-            fchar_seq = "\\" + fchar
-        else:
-            fchar_seq = fchar
+    def parse_selector(self, cmd_object) -> ListSelector:
+        return parse_list_selector(cmd_object.cmd_string,
+                                   cmd_object.cmdspec.filterchar,
+                                   cmd_object.cmdspec.specifier)
 
-        filter_expr_at_end_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+$'.format(fchar=fchar_seq))
-        filter_expr_with_ext_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+.'.format(fchar=fchar_seq))
+    def continuation_token(self, cmd_object, selector, page_number):
+        return '%s%s%s%d' % (selector.base_command, cmd_object.cmdspec.specifier, PAGE_PREFIX, page_number)
 
-        #
-        # the filter expression is the part of the command string between the filter character and:
-        # -- end of string if there is no specifier char; or
-        # -- the specifier char.
-        #
-        #
+    def range_token(self, cmd_object, selector, min_index, max_index):
+        return '%s%s%d-%d' % (selector.base_command, cmd_object.cmdspec.specifier, min_index, max_index)
+
+    def more_footer(self, token):
+        return 'Reply %s for more.' % token
+
+    def paginate(self, lines, footer_allowance: str):
+        '''Groups rendered lines into pages of at most page_segments SMS segments, leaving room on
+        every page but the last for footer_allowance (the longest footer it could carry).
+        Yields (page lines, whether another page follows); lines are rendered only as far as
+        the pages asked for.
+        '''
+
+        current = []
+        page_text = None
+        for line in lines:
+            candidate = line if page_text is None else page_text + PAGE_BREAK + line
+            if page_text is None or sms_segment_count(candidate + PAGE_BREAK + footer_allowance) <= self.page_segments:
+                current.append(line)
+                page_text = candidate
+                continue
+
+            yield (current, True)
+            current = [line]
+            page_text = line
+
+        if current:
+            yield (current, False)
+
+    def render_page(self, cmd_object, selector, items, render_callback, page_number):
+        '''Pages are cut by rendered length, so finding page N renders the items before it.
+        '''
+
+        if page_number == 0:
+            return "There is no page 0. Pages are numbered from 1."
+
+        lines = (render_callback(index, item) for index, item in enumerate(items, 1))
+        footer_allowance = self.more_footer(self.continuation_token(cmd_object, selector, 99))
 
-        match = filter_expr_at_end_rx.search(command_string)
-        if match:
-            start_index = match.span()[0]
-            extent = match.span()[1]
-            return command_string[start_index:extent].lstrip(fchar)
+        for number, (page_lines, has_next_page) in enumerate(self.paginate(lines, footer_allowance), 1):
+            if number < page_number:
+                continue
 
-        match = filter_expr_with_ext_rx.search(command_string)
-        if match:
-            start_index = match.span()[0]
-            extent = match.span()[1]
-            return command_string[start_index:extent].lstrip(fchar).rstrip(spec)
+            if has_next_page:
+                page_lines.append(self.more_footer(self.continuation_token(cmd_object, selector, page_number + 1)))
+            return PAGE_BREAK.join(page_lines)
 
-        return '*'  # if no match, filter expression is wildcard
+        if page_number == 1:
+            return "There are no %s in this list." % self.plural_item_noun
+        return "There are no %s on page %d of this list." % (self.plural_item_noun, page_number)
+
+    def render_range(self, cmd_object, selector, range_items, render_callback, min_index, max_index):
+        '''The first page of a range; the rest of it is offered as a range of its own
+        '''
+
+        lines = (render_callback(index, item) for index, item in zip(range(min_index, max_index + 1), range_items))
+        footer_allowance = self.more_footer(self.range_token(cmd_object, selector, max_index, max_index))
+
+        page_lines, has_next_page = next(self.paginate(lines, footer_allowance))
+        if has_next_page:
+            next_index = min_index + len(page_lines)
+            page_lines.append(self.more_footer(self.range_token(cmd_object, selector, next_index, max_index)))
+        return PAGE_BREAK.join(page_lines)
+
+    def reply_chained_command(self, command_string, chained_command, dlg_engine, dlg_context, lexicon, service_registry) -> str:
+        try:
+            return dlg_engine.reply_command(chained_command, dlg_context, lexicon, service_registry)
+        except Exception as err:
+            # one failed command costs only its own line of the reply
+            print('!!! error replying to chained command "%s": %s' % (command_string, err), file=sys.stderr)
+            return '(could not run "%s")' % command_string
+
+    def reply_chained_commands(self, chained_commands, dlg_engine, dlg_context, lexicon, service_registry) -> list:
+        '''Replies to each chained command, in the order given. chained_commands is a list of
+        (command string, parsed command) pairs.
+        '''
+
+        if self.chain_executor is None:
+            return [self.reply_chained_command(command_string, cmd, dlg_engine, dlg_context, lexicon, service_registry)
+                    for command_string, cmd in chained_commands]
+
+        futures = [self.chain_executor.submit(self.reply_chained_command,
+                                              command_string, cmd, dlg_engine, dlg_context, lexicon, service_registry)
+                   for command_string, cmd in chained_commands]
+
+        timeout = float(self.chain_timeout_seconds) if self.chain_timeout_seconds is not None else None
+        _, not_done = wait(futures, timeout=timeout)
+
+        replies = []
+        abandoned = []
+        for (command_string, _), future in zip(chained_commands, futures):
+            if future in not_done:
+                # this only stops commands that have not started; those already running are
+                # left to finish on their pool thread, and their replies are dropped
+                future.cancel()
+                abandoned.append(command_string)
+                replies.append('(no reply to "%s" within %s seconds)' % (command_string, self.chain_timeout_seconds))
+            else:
+                replies.append(future.result())
+
+        if abandoned:
+            print('### abandoned %d chained command(s) after %s seconds: %s' % (len(abandoned), self.chain_timeout_seconds, abandoned),
+                  file=sys.stderr)
+
+        return replies
 
     def generate(self, **kwargs):
+        '''Render a listing command against record_list, which may be a list, any iterable
+        (consumed lazily, and only as far as the selector requires), or a PagedRecordSource.
+
+        A plain listing returns the first page (at most page_segments SMS segments), followed by
+        a continuation token (<cmd>.p2) if there are more. A range too long for one page is
+        continued the same way, with the rest of the range (<cmd>.8-20) as the token.
+        '''
 
         kwreader = common.KeywordArgReader('command_object',
                                            'record_list',
@@ -80,6 +364,7 @@ class ListOutputResponder(object):
                                            'filter_callback',
                                            'dialog_context',
                                            'dialog_engine',
+                                           'lexicon',
                                            'service_registry')
         kwreader.read(**kwargs)
 
@@ -89,140 +374,126 @@ class ListOutputResponder(object):
         filter_function = kwargs['filter_callback']
         dlg_context = kwargs['dialog_context']
         dlg_engine = kwargs['dialog_engine']
+        lexicon = kwargs['lexicon']
         service_registry = kwargs['service_registry']
 
-        filter_expression = self.detect_filter_expression(cmd_object)
-        if filter_expression == '*':
-            items = rec_list
-        else:
-            items = [item for item in rec_list if filter_function(item, filter_expression)]
+        selector = self.parse_selector(cmd_object)
+        items = select_records(rec_list, filter_function, selector.filter_expression)
 
         # we will either receive a plain command string,
         # or a command string followed immediately by specifier
         # and an extesion (for lists, usually a numerical selector)
         #
-        tokens = cmd_object.cmd_string.split(cmd_object.cmdspec.specifier)
-        if len(tokens) == 1:
-            lines = []
-            index = 1
-
+        if selector.selector_type == SELECT_ALL:
             # if no specifier is present in the command string,
-            # return the entire list (with indices)
-            # TODO: segment output for very long lists
+            # return the first page of the list (with indices)
+            return self.render_page(cmd_object, selector, items, render_callback, 1)
 
-            for item in items:
-                lines.append(render_callback(index, item))
-                index += 1
+        elif selector.selector_type == SELECT_PAGE:
+            return self.render_page(cmd_object, selector, items, render_callback, selector.start)
 
-            return '\n\n'.join(lines)
+        # if we receive <cmd><specifier>N where N is an integer,
+        # return the Nth item in the list
+        #
+        elif selector.selector_type == SELECT_INDEX:
+            list_index = selector.start
 
-        else:
-            ext = tokens[1]
-            # the "extension" is the part of the command string immediately
-            # following the specifier character.
-            #
-            # if we receive <cmd><specifier>N where N is an integer,
-            # return the Nth item in the list
+            if list_index == 0:
+                return "You may not request the 0th element of a list. (Nice try, C programmers.)"
+
+            found, num_items = slice_records(items, list_index - 1, list_index)
+            if not found:
+                return ("You requested open job # %d, but there are only %d %s in this list."
+                        % (list_index, num_items, self.plural_item_noun))
+
+            list_element = found[0]
+
+            # if the user is extracting a single list element (by using an integer extension), we do 
+            # one of two things. If there were no command modifiers specified, we simply return the element:
             #
-            if self.extension_is_positive_num(ext):
-                list_index = int(ext)
+            if not len(cmd_object.modifiers):
+                return render_callback(1, list_element)
+            else:
+                # ...but if there were modifiers, then we construct a new command by chaining 
+                # the output of this command with the modifiers passed to us.
+                #
+                command_tokens = [render_callback(0, list_element)]
+                command_tokens.extend(cmd_object.modifiers)
 
-                if list_index > len(items):
-                    return ("You requested open job # %d, but there are only %d %s in this list."
-                            % (list_index, len(items), self.plural_item_noun))
+                # parse function reads urlquoted strings, so sub + for spaces
+                command_string = '+'.join(command_tokens)
+                chained_command = self.command_parse_func(command_string)
 
-                if list_index == 0:
-                    return "You may not request the 0th element of a list. (Nice try, C programmers.)"
+                print('command: ' + str(chained_command))                                       
+                return dlg_engine.reply_command(chained_command, dlg_context, lexicon, service_registry)
 
-                list_element = items[list_index-1]
+        elif selector.selector_type == SELECT_NEGATIVE_INDEX:
+            neg_index = selector.start
+            if neg_index == 0:
+                return '-0 is not a valid negative index. Use -1 to specify the last %s in the list.' % self.singular_item_noun
 
-                # if the user is extracting a single list element (by using an integer extension), we do 
-                # one of two things. If there were no command modifiers specified, we simply return the element:
-                #
-                if not len(cmd_object.modifiers):
-                    return render_callback(1, list_element)
-                else:
-                    # ...but if there were modifiers, then we construct a new command by chaining 
-                    # the output of this command with the modifiers passed to us.
-                    #
-                    command_tokens = [render_callback(0, list_element)]
-                    command_tokens.extend(cmd_object.modifiers)
+            # a negative index has to see the whole list, but we only ever hold the last N records
+            tail = deque(maxlen=-neg_index)
+            num_items = 0
+            for item in items:
+                tail.append(item)
+                num_items += 1
 
-                    # parse function reads urlquoted strings, so sub + for spaces
-                    command_string = '+'.join(command_tokens)
-                    chained_command = self.command_parse_func(command_string)
+            if num_items + neg_index < 0:
+                return ('You specified a negative list offset (%d), but there are only %d %s in the list.' 
+                        % (neg_index, num_items, self.plural_item_noun))
 
-                    print('command: ' + str(chained_command))                                       
-                    return dlg_engine.reply_command(chained_command, dlg_context, service_registry)
+            list_element = tail[0]
+
+            if not len(cmd_object.modifiers):
+                return list_element
+            else:
+                # ...but if there were modifiers, then we construct a new command 
+                # by chaining the output of this command with the modifier array.
+                command_tokens = [list_element]
+                command_tokens.extend(cmd_object.modifiers)
+
+                # TODO: instead of splitting on this char, urldecode the damn thing from the beginning
+                command_string = '+'.join(command_tokens)
+                chained_command = self.command_parse_func(command_string)
 
-            elif self.extension_is_negative_num(ext):
-                neg_index = int(ext)
-                if neg_index == 0:
-                    return '-0 is not a valid negative index. Use -1 to specify the last %s in the list.' % self.singular_item_noun
+                print('command: ' + str(chained_command))                                       
+                return dlg_engine.reply_command(chained_command, dlg_context, lexicon, service_registry)
 
-                zero_list_index = len(items) + neg_index
+        elif selector.selector_type == SELECT_RANGE:
+            # if we receive <cmd><specifier>N-M where N and M are both integers, return the Nth through the Mth items
+            min_index = selector.start
+            max_index = selector.end
 
-                if zero_list_index < 0:
-                    return ('You specified a negative list offset (%d), but there are only %d %s in the list.' 
-                            % (neg_index, len(items), self.plural_item_noun))
+            if min_index > max_index:
+                return 'The first number in your range specification A-B must be less than or equal to the second number.'
 
-                list_element = items[zero_list_index]
+            if min_index == 0:
+                return "You may not request the 0th element of a list. (This stack was written in Python, but the UI is in English.)"
 
-                if not len(cmd_object.modifiers):
-                    return list_element
-                else:
-                    # ...but if there were modifiers, then we construct a new command 
-                    # by chaining the output of this command with the modifier array.
-                    command_tokens = [list_element]
+            range_items, num_items = slice_records(items, min_index - 1, max_index)
+            if num_items is not None:
+                return "There are only %d %s open." % (num_items, self.plural_item_noun)
+
+            if not len(cmd_object.modifiers):
+                return self.render_range(cmd_object, selector, range_items, render_callback, min_index, max_index)
+            else:
+                # ...but if there were modifiers, then for each element in the filtered list...
+                #
+                chained_commands = []
+                for item in range_items:
+                    # ...we construct a new command by chaining the current element
+                    # with the modifier array
+
+                    command_tokens = [item]
                     command_tokens.extend(cmd_object.modifiers)
 
-                    # TODO: instead of splitting on this char, urldecode the damn thing from the beginning
+                    # sub + for spaces
                     command_string = '+'.join(command_tokens)
                     chained_command = self.command_parse_func(command_string)
 
                     print('command: ' + str(chained_command))                                       
-                    return dlg_engine.reply_command(chained_command, dlg_context, service_registry)
-
-            elif self.extension_is_range(ext):
-                # if we receive <cmd><specifier>N-M where N and M are both integers, return the Nth through the Mth items
-                tokens = ext.split('-')
-                if len(tokens) != 2:
-                    return 'The range extension for this command must be formatted as A-B where A and B are integers.'
-
-                min_index = int(tokens[0])
-                max_index = int(tokens[1])
-                
-                if min_index > max_index:
-                    return 'The first number in your range specification A-B must be less than or equal to the second number.'
-
-                if max_index > len(items):
-                    return "There are only %d %s open." % (len(items), self.plural_item_noun)
-
-                if min_index == 0:
-                    return "You may not request the 0th element of a list. (This stack was written in Python, but the UI is in English.)"
-
-                if not len(cmd_object.modifiers):
-                    lines = []
-                    for index in range(min_index, max_index+1):
-                        lines.append(render_callback(index, items[index-1]))
-
-                    return '\n\n'.join(lines)
-                else:
-                    # ...but if there were modifiers, then for each element in the filtered list...
-                    #
-                    lines = []
-                    for index in range(min_index, max_index+1):
-                        # ...we construct a new command by chaining the current element
-                        # with the modifier array
-
-                        command_tokens = [items[index-1]]
-                        command_tokens.extend(cmd_object.modifiers)
-
-                        # sub + for spaces
-                        command_string = '+'.join(command_tokens)
-                        chained_command = self.command_parse_func(command_string)
-
-                        print('command: ' + str(chained_command))                                       
-                        lines.append(dlg_engine.reply_command(chained_command, dlg_context, service_registry))
-
-                    return '\n\n'.join(lines)
+                    chained_commands.append((command_string, chained_command))
+
+                lines = self.reply_chained_commands(chained_commands, dlg_engine, dlg_context, lexicon, service_registry)
+                return '\n\n'.join(lines)
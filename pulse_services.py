@@ -5,11 +5,24 @@ import sys
 import time
 import urllib
 import json
-from collections import namedtuple
+import math
+import atexit
+import asyncio
+import pickle
+import hashlib
+import tempfile
+import queue
+import random
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future
 from contextlib import contextmanager
 from sqlalchemy import MetaData
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from contextlib import asynccontextmanager
 
 import datetime
 
@@ -21,6 +34,9 @@ import sqlalchemy as sqla
 import uuid
 
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+
+from atrium_envelope import compose_message, WIRE_FORMAT_JSON
 
 
 POSTGRESQL_SVC_PARAM_NAMES = [
@@ -64,18 +80,14 @@ class CommandContext(object):
 class MessageContext(object):
     def __init__(self, atrium_channel, **kwargs):
         self.atrium_channel = atrium_channel
+        self.redis_client = kwargs['redis_client']
+        self.wire_format = kwargs.get('wire_format', WIRE_FORMAT_JSON)
 
 
     def send(self, message_type, **kwargs):
-        msg_dict = {
-            "message_type": message_type,
-            "body_data_type": "application/json",
-            "timestamp": self.current_timestamp(),
-            "sender_pid": os.getpid(),
-            "body": kwargs
-        }
+        message = compose_message(self.wire_format, message_type, 'application/json', kwargs, os.getpid())
 
-        num_subscribers = self.redis_client.publish(self.atrium_channel, json.dumps(msg_dict))
+        num_subscribers = self.redis_client.publish(self.atrium_channel, message)
         if num_subscribers:
             return True
         
@@ -83,8 +95,258 @@ class MessageContext(object):
 
 
 class UserSession(object):
-    def __init__(self):
-        pass
+    '''An SMS session. Expiry slides: a session lapses ttl_seconds after it was last active.
+    '''
+
+    def __init__(self, **kwargs):
+        now = time.time()
+        self.session_id = kwargs.get('session_id') or str(uuid.uuid4())
+        self.user_id = kwargs.get('user_id')
+        self.username = kwargs.get('username')
+        self.sms_number = kwargs.get('sms_number')
+        self.session_type_id = kwargs.get('session_type_id')
+        self.session_profile_id = kwargs.get('session_profile_id')
+        self.ttl_seconds = int(kwargs.get('ttl_seconds') or DEFAULT_SESSION_TTL_SECONDS)
+        self.created_at = float(kwargs.get('created_at') or now)
+        self.last_active_at = float(kwargs.get('last_active_at') or now)
+
+    @property
+    def expires_at(self) -> float:
+        return self.last_active_at + self.ttl_seconds
+
+    def is_expired(self, now: float=None) -> bool:
+        return (now or time.time()) >= self.expires_at
+
+    def to_dict(self) -> dict:
+        return {
+            'session_id': self.session_id,
+            'user_id': self.user_id,
+            'username': self.username,
+            'sms_number': self.sms_number,
+            'session_type_id': self.session_type_id,
+            'session_profile_id': self.session_profile_id,
+            'ttl_seconds': self.ttl_seconds,
+            'created_at': self.created_at,
+            'last_active_at': self.last_active_at
+        }
+
+
+DEFAULT_SESSION_TTL_SECONDS = 1800
+SMS_SESSION_KEY_PREFIX = 'pulse:sms_session'
+SMS_SESSION_EXPIRY_KEY = 'pulse:sms_session_expiry'
+
+# (session ID, expiry time) of a session that lapsed without being closed
+ExpiredSession = namedtuple('ExpiredSession', 'session_id expired_at')
+
+
+class InMemorySessionStore(object):
+    '''Sessions held by this process only. Suitable for a single SMS listener.
+    '''
+
+    def __init__(self, **kwargs):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def save(self, session: UserSession):
+        with self.lock:
+            self.sessions[session.sms_number] = session
+
+    def load(self, sms_number: str) -> UserSession:
+        with self.lock:
+            session = self.sessions.get(sms_number)
+        if session is None or session.is_expired():
+            return None
+        return session
+
+    def touch(self, session: UserSession):
+        session.last_active_at = time.time()
+        self.save(session)
+
+    def delete(self, sms_number: str) -> UserSession:
+        with self.lock:
+            return self.sessions.pop(sms_number, None)
+
+    def reap_expired(self) -> list:
+        now = time.time()
+        with self.lock:
+            expired = [session for session in self.sessions.values() if session.is_expired(now)]
+            for session in expired:
+                del self.sessions[session.sms_number]
+
+        return [ExpiredSession(session_id=session.session_id, expired_at=session.expires_at) for session in expired]
+
+
+class RedisSessionStore(object):
+    '''Sessions shared by every SMS listener process through Redis. Each session is a key that
+    Redis expires at the session TTL; a sorted set of session expiry times lets whichever process
+    reaps first record the expiry (exactly once) in active_sessions.
+    '''
+
+    def __init__(self, **kwargs):
+        self.redis_client = kwargs['redis_client']
+
+    def session_key(self, sms_number: str) -> str:
+        return '%s:%s' % (SMS_SESSION_KEY_PREFIX, sms_number)
+
+    def save(self, session: UserSession):
+        ttl = max(int(math.ceil(session.expires_at - time.time())), 1)
+        pipeline = self.redis_client.pipeline()
+        pipeline.setex(self.session_key(session.sms_number), ttl, json.dumps(session.to_dict()))
+        pipeline.zadd(SMS_SESSION_EXPIRY_KEY, {session.session_id: session.expires_at})
+        pipeline.execute()
+
+    def load(self, sms_number: str) -> UserSession:
+        data = self.redis_client.get(self.session_key(sms_number))
+        if data is None:
+            return None
+
+        session = UserSession(**json.loads(data))
+        if session.is_expired():
+            return None
+        return session
+
+    def touch(self, session: UserSession):
+        session.last_active_at = time.time()
+        self.save(session)
+
+    def delete(self, sms_number: str) -> UserSession:
+        key = self.session_key(sms_number)
+        pipeline = self.redis_client.pipeline()
+        pipeline.get(key)
+        pipeline.delete(key)
+        data, _ = pipeline.execute()
+        if data is None:
+            return None
+
+        session = UserSession(**json.loads(data))
+        self.redis_client.zrem(SMS_SESSION_EXPIRY_KEY, session.session_id)
+        return session
+
+    def reap_expired(self) -> list:
+        expired = []
+        for session_id, expired_at in self.redis_client.zrangebyscore(SMS_SESSION_EXPIRY_KEY, '-inf', time.time(), withscores=True):
+            # only the process whose ZREM succeeds records this expiry
+            if self.redis_client.zrem(SMS_SESSION_EXPIRY_KEY, session_id):
+                if isinstance(session_id, bytes):
+                    session_id = session_id.decode('utf-8')
+                expired.append(ExpiredSession(session_id=session_id, expired_at=expired_at))
+
+        return expired
+
+
+SESSION_STORES = {
+    'memory': InMemorySessionStore,
+    'redis': RedisSessionStore
+}
+
+
+class SessionWriteBehind(object):
+    '''Records session opens and closes in the active_sessions table from a background thread,
+    in batches, so that opening or closing a session never waits on Postgres. A batch that fails
+    is retried with backoff; whatever is still queued when the process exits is written first.
+    '''
+
+    def __init__(self, db_svc, **kwargs):
+        self.db_svc = db_svc
+        self.batch_size = int(kwargs.get('batch_size') or 100)
+        self.flush_interval_seconds = float(kwargs.get('flush_interval_seconds') or 1.0)
+        self.max_write_retries = int(kwargs.get('max_write_retries') or 5)
+        self.retry_backoff_seconds = float(kwargs.get('retry_backoff_seconds') or 1.0)
+        self.drain_timeout_seconds = float(kwargs.get('drain_timeout_seconds') or 10.0)
+        self.pending = queue.Queue()
+
+        self.writer = threading.Thread(target=self.write_loop, name='session_write_behind', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def record_open(self, session: UserSession):
+        self.pending.put(('open', session.to_dict()))
+
+    def record_close(self, session_id: str, closed_at: float):
+        self.pending.put(('close', (session_id, closed_at)))
+
+    def close(self):
+        '''Write everything already recorded, then stop the writer thread
+        '''
+
+        if not self.writer.is_alive():
+            return
+        self.pending.put(None)
+        self.writer.join(self.drain_timeout_seconds)
+        if self.writer.is_alive():
+            print('### session write-behind did not drain within %s seconds; %d change(s) not recorded in active_sessions.'
+                  % (self.drain_timeout_seconds, self.pending.qsize()), file=sys.stderr)
+
+    def write_loop(self):
+        stopping = False
+        while not stopping:
+            operations = [self.pending.get()]
+            deadline = time.monotonic() + self.flush_interval_seconds
+            while len(operations) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    operations.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if None in operations:
+                # close() was called; what was queued before it is still written
+                stopping = True
+                operations = [op for op in operations if op is not None]
+                while True:
+                    try:
+                        operation = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if operation is not None:
+                        operations.append(operation)
+
+            if operations:
+                self.write_with_retries(operations)
+
+    def write_with_retries(self, operations: list):
+        attempt = 0
+        while True:
+            try:
+                self.write(operations)
+                return
+            except Exception as err:
+                if attempt >= self.max_write_retries:
+                    # the batch goes to the log, so that it can be replayed by hand
+                    print('### giving up on recording %d session change(s) in active_sessions: %s' % (len(operations), err), file=sys.stderr)
+                    print(json.dumps(operations, default=str), file=sys.stderr)
+                    return
+
+                delay = self.retry_backoff_seconds * (2 ** attempt)
+                print('### error recording %d session change(s) in active_sessions (%s); retrying in %.1f seconds.'
+                      % (len(operations), err, delay), file=sys.stderr)
+                attempt += 1
+                time.sleep(delay)
+
+    def write(self, operations: list):
+        ActiveSession = self.db_svc.Base.classes.active_sessions
+
+        opened = [{
+            'id': data['session_id'],
+            'user_id': data['user_id'],
+            'session_type_ref_id': data['session_type_id'],
+            'session_profile_ref_id': data['session_profile_id'],
+            'created_ts': datetime.datetime.fromtimestamp(data['created_at'], datetime.timezone.utc)
+        } for op, data in operations if op == 'open']
+
+        closed = [data for op, data in operations if op == 'close']
+
+        with self.db_svc.txn_scope() as session:
+            if opened:
+                session.bulk_insert_mappings(ActiveSession, opened)
+                # opens must reach the table before closes of the same session are applied
+                session.flush()
+
+            for session_id, closed_at in closed:
+                session.query(ActiveSession).filter(ActiveSession.id == session_id).filter(ActiveSession.expired_ts == None).update(
+                    {'expired_ts': datetime.datetime.fromtimestamp(closed_at, datetime.timezone.utc)}, synchronize_session=False)
 
 
 class StreamContext(object):
@@ -93,6 +355,135 @@ class StreamContext(object):
 
 
 
+def normalize_mobile_number(number_string):
+    return number_string.lstrip('+').lstrip('1').replace('(', '').replace(')', '').replace('-', '').replace('.', '').replace(' ', '')
+
+
+UserIdentity = namedtuple('UserIdentity', 'user_id username sms_phone_number')
+
+USER_IDENTITY_KEY_PREFIX = 'pulse:user_identity'
+USER_IDENTITY_INVALIDATION_CHANNEL = 'pulse:user_identity:invalidate'
+
+# what the Redis tier stores for a number with no live user
+UNKNOWN_USER_MARKER = ''
+
+
+def user_identity_key(sms_number: str) -> str:
+    return '%s:%s' % (USER_IDENTITY_KEY_PREFIX, normalize_mobile_number(sms_number))
+
+
+def invalidate_user_identity(redis_client, sms_number: str):
+    '''Drop a number from the shared Redis tier and tell every process holding it in memory to
+    drop it as well. Call this whenever a user is created, or their deleted_ts or number changes.
+    '''
+
+    number = normalize_mobile_number(sms_number)
+    redis_client.delete(user_identity_key(number))
+    redis_client.publish(USER_IDENTITY_INVALIDATION_CHANNEL, number)
+
+
+class UserIdentityCache(object):
+    '''User identities keyed by normalized mobile number.
+
+    An in-process LRU sits in front of an optional Redis tier shared by every Pulse process.
+    Numbers with no live user are cached too (for negative_ttl_seconds), so that unknown senders
+    do not reach Postgres on every message.
+    '''
+
+    MISS = object()
+
+    def __init__(self, **kwargs):
+        self.ttl_seconds = float(kwargs.get('ttl_seconds') or 300)
+        self.negative_ttl_seconds = float(kwargs.get('negative_ttl_seconds') or 60)
+        self.max_entries = int(kwargs.get('max_entries') or 10000)
+        self.redis_client = kwargs.get('redis_client')
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'redis_hits': 0,
+            'misses': 0,
+            'invalidations': 0
+        }
+
+        self.invalidation_listener = None
+        if self.redis_client is not None:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{USER_IDENTITY_INVALIDATION_CHANNEL: self.handle_invalidation})
+            self.invalidation_listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def handle_invalidation(self, message):
+        data = message['data']
+        self.evict(data.decode('utf-8') if isinstance(data, bytes) else data)
+
+    def evict(self, sms_number: str):
+        with self.lock:
+            if self.entries.pop(normalize_mobile_number(sms_number), None) is not None:
+                self.stats['invalidations'] += 1
+
+    def get(self, sms_number: str):
+        '''Returns the cached UserIdentity, None for a number known to have no user,
+        or UserIdentityCache.MISS.
+        '''
+
+        number = normalize_mobile_number(sms_number)
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(number)
+            if entry is not None:
+                identity, expires_at = entry
+                if expires_at > now:
+                    self.entries.move_to_end(number)
+                    self.stats['hits'] += 1
+                    return identity
+                del self.entries[number]
+
+        if self.redis_client is not None:
+            cached = self.redis_client.get(user_identity_key(number))
+            if cached is not None:
+                cached = cached.decode('utf-8')
+                identity = UserIdentity(**json.loads(cached)) if cached != UNKNOWN_USER_MARKER else None
+                self.store_local(number, identity)
+                with self.lock:
+                    self.stats['redis_hits'] += 1
+                return identity
+
+        with self.lock:
+            self.stats['misses'] += 1
+        return self.MISS
+
+    def ttl_for(self, identity) -> float:
+        return self.ttl_seconds if identity is not None else self.negative_ttl_seconds
+
+    def store_local(self, number: str, identity):
+        with self.lock:
+            self.entries[number] = (identity, time.monotonic() + self.ttl_for(identity))
+            self.entries.move_to_end(number)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, sms_number: str, identity):
+        number = normalize_mobile_number(sms_number)
+        self.store_local(number, identity)
+
+        if self.redis_client is not None:
+            value = json.dumps(identity._asdict()) if identity is not None else UNKNOWN_USER_MARKER
+            self.redis_client.setex(user_identity_key(number), int(math.ceil(self.ttl_for(identity))), value)
+
+    def invalidate(self, sms_number: str):
+        self.evict(sms_number)
+        if self.redis_client is not None:
+            invalidate_user_identity(self.redis_client, sms_number)
+
+    def cache_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.entries)
+        return stats
+
+
 class AtriumClient(object):
     def __init__(self, **kwargs):
         self.atrium_channel = kwargs['atrium_channel']
@@ -103,7 +494,38 @@ class AtriumClient(object):
         }
         self.redis_client = redis.StrictRedis(**redis_params)
 
-        self.user_sms_sessions = {}
+        # 'json' or 'envelope' (see atrium_envelope); atriumd accepts both
+        self.wire_format = kwargs.get('wire_format', WIRE_FORMAT_JSON)
+
+        # SMS sessions live in a session store: "memory" (this process only) or "redis"
+        # (shared by every SMS listener). Session TTLs come from ref_session_profiles.
+        store_name = kwargs.get('session_store') or 'memory'
+        store_class = SESSION_STORES.get(store_name)
+        if not store_class:
+            raise Exception('Unsupported session store "%s". Supported stores are: %s' % (store_name, list(SESSION_STORES.keys())))
+
+        self.session_store = store_class(redis_client=self.redis_client)
+        self.sms_session_type_id = int(kwargs.get('sms_session_type_id') or 1)
+        self.sms_session_profile_id = kwargs.get('sms_session_profile_id')
+        self.default_session_ttl_seconds = int(kwargs.get('default_session_ttl_seconds') or DEFAULT_SESSION_TTL_SECONDS)
+        self.session_profile_ttls = {}
+
+        # sliding expiry rewrites a session at most this often, not on every message
+        self.session_touch_interval_seconds = float(kwargs.get('session_touch_interval_seconds') or 30)
+        self.session_reap_interval_seconds = float(kwargs.get('session_reap_interval_seconds') or 60)
+        self.last_session_reap = 0
+
+        self.session_write_behind_enabled = str(kwargs.get('session_write_behind', False)).lower() in ('true', '1', 'yes')
+        self.session_write_batch_size = kwargs.get('session_write_batch_size')
+        self.session_flush_interval_seconds = kwargs.get('session_flush_interval_seconds')
+        self.session_writer = None
+
+        # user_cache_shared puts a Redis tier (on the Atrium Redis) behind the in-process cache
+        shared_cache = str(kwargs.get('user_cache_shared', False)).lower() in ('true', '1', 'yes')
+        self.user_cache = UserIdentityCache(ttl_seconds=kwargs.get('user_cache_ttl_seconds'),
+                                            negative_ttl_seconds=kwargs.get('user_cache_negative_ttl_seconds'),
+                                            max_entries=kwargs.get('user_cache_size'),
+                                            redis_client=self.redis_client if shared_cache else None)
 
 
     def current_timestamp(self):
@@ -124,30 +546,57 @@ class AtriumClient(object):
         pass
         
     
+    def lookup_user_identity(self, user_sms_number: str, db_svc, session=None) -> UserIdentity:
+        '''The live user registered under this number, or None. Answered from the identity cache
+        where possible; only a cache miss queries the users table.
+        '''
+
+        identity = self.user_cache.get(user_sms_number)
+        if identity is not UserIdentityCache.MISS:
+            return identity
+
+        if session is None:
+            with db_svc.txn_scope() as session:
+                identity = self.query_user_identity(user_sms_number, session, db_svc)
+        else:
+            identity = self.query_user_identity(user_sms_number, session, db_svc)
+
+        self.user_cache.put(user_sms_number, identity)
+        return identity
+
+
+    def query_user_identity(self, user_sms_number: str, session, db_svc) -> UserIdentity:
+        User = db_svc.Base.classes.users
+        query = session.query(User).filter(User.sms_phone_number == normalize_mobile_number(user_sms_number)).filter(User.deleted_ts == None)
+        record = query.one_or_none()
+        if record is None:
+            return None
+
+        return UserIdentity(user_id=str(record.id), username=record.username, sms_phone_number=record.sms_phone_number)
+
+
+    def invalidate_user(self, user_sms_number: str):
+        self.user_cache.invalidate(user_sms_number)
+
+
     def lookup_username_by_mobile_number(self, user_sms_number: str, session, db_svc) -> str:
         
-        User = db_svc.Base.classes.users
-        query = session.query(User).filter(User.sms_phone_number == user_sms_number).filter(User.deleted_ts == None)
-        record = query.one()
+        identity = self.lookup_user_identity(user_sms_number, db_svc, session)
+        if identity is None:
+            raise NoResultFound(f'No user registered under SMS number {user_sms_number}')
                     
-        return record.username
+        return identity.username
 
 
     def message_context(self):
         # send a data signal (a message) to Atrium
-        pass
+        return MessageContext(self.atrium_channel, redis_client=self.redis_client, wire_format=self.wire_format)
 
 
     def connect_user_stream(self, userid, **kwargs):
-        msg_dict = {
-            "message_type": "test",
-            "body_data_type": "text/plain",
-            "timestamp": self.current_timestamp(),
-            "sender_pid": os.getpid(),
-            "body": f"connecting to user {userid}"
-        }
+        message = compose_message(self.wire_format, 'test', 'text/plain', f'connecting to user {userid}', os.getpid())
 
-        num_subscribers = self.redis_client.publish(self.atrium_channel, json.dumps(msg_dict))
+        num_subscribers = self.redis_client.publish(self.atrium_channel, message)
 
     def create_topic_for_user_id(self, user_id: str):
         pass
@@ -157,33 +606,100 @@ class AtriumClient(object):
         pass
 
 
+    def session_ttl_seconds(self, profile_id, db_svc) -> int:
+        '''session_ttl_seconds from ref_session_profiles, read once per profile
+        '''
+
+        if profile_id is None or db_svc is None:
+            return self.default_session_ttl_seconds
+
+        profile_id = int(profile_id)
+        ttl = self.session_profile_ttls.get(profile_id)
+        if ttl is None:
+            SessionProfile = db_svc.Base.classes.ref_session_profiles
+            with db_svc.txn_scope() as session:
+                profile = session.query(SessionProfile).filter(SessionProfile.id == profile_id).one_or_none()
+                ttl = profile.session_ttl_seconds if profile else self.default_session_ttl_seconds
+            self.session_profile_ttls[profile_id] = ttl
+
+        return ttl
+
+
+    def session_writer_for(self, db_svc) -> SessionWriteBehind:
+        if not self.session_write_behind_enabled or db_svc is None:
+            return None
+
+        if self.session_writer is None:
+            self.session_writer = SessionWriteBehind(db_svc,
+                                                     batch_size=self.session_write_batch_size,
+                                                     flush_interval_seconds=self.session_flush_interval_seconds)
+        return self.session_writer
+
+
+    def reap_expired_sessions(self, force=False):
+        # reaping removes the expiry entries, so a process that cannot record the closes in
+        # active_sessions (no writer yet; one is built by the first open or close given a userdb)
+        # leaves them for one that can
+        if self.session_write_behind_enabled and self.session_writer is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self.last_session_reap < self.session_reap_interval_seconds:
+            return
+        self.last_session_reap = now
+
+        expired = self.session_store.reap_expired()
+        if expired and self.session_writer is not None:
+            for lapsed in expired:
+                self.session_writer.record_close(lapsed.session_id, lapsed.expired_at)
+
+
     def open_user_session_sms(self, sms_number: str, user_id: str, **kwargs) -> UserSession:
-        
-        #db_service = kwargs.get('userdb')
-        #db_service.lookup_user_account_sms(user_id, sms_number)
+        '''Pass userdb=<PostgreSQLService> to take the TTL from the session profile and, with
+        session_write_behind on, to record the session in active_sessions.
+        '''
 
-        session = UserSession()
-        self.user_sms_sessions[sms_number] = session
+        db_service = kwargs.get('userdb')
+        profile_id = kwargs.get('session_profile_id', self.sms_session_profile_id)
+
+        session = UserSession(user_id=user_id,
+                              username=kwargs.get('username'),
+                              sms_number=sms_number,
+                              session_type_id=self.sms_session_type_id,
+                              session_profile_id=profile_id,
+                              ttl_seconds=self.session_ttl_seconds(profile_id, db_service))
+
+        # a new session replaces any existing one for this number
+        self.close_session_sms(sms_number)
+        self.session_store.save(session)
+
+        writer = self.session_writer_for(db_service)
+        if writer:
+            writer.record_open(session)
+
+        self.reap_expired_sessions()
         return session
 
 
     def get_user_session_sms(self, sms_number: str) -> UserSession:
         
-        session = self.user_sms_sessions.get(sms_number)
+        session = self.session_store.load(sms_number)
         if not session:
-            raise Exception(f'No user session for {sms_number}')
-        
-        #if self.session_is_expired(session):
-        #    raise Exception(f'User session for {sms_number} is expired.')
+            raise Exception(f'No active user session for {sms_number}')
+
+        if time.time() - session.last_active_at >= self.session_touch_interval_seconds:
+            self.session_store.touch(session)
 
+        self.reap_expired_sessions()
         return session
 
 
-    def close_session_sms(self, sms_number: str):
+    def close_session_sms(self, sms_number: str, **kwargs):
         
-        session = self.find_user_session_sms(sms_number)
-        if session:
-            self.delete_user_session_sms(session)
+        session = self.session_store.delete(sms_number)
+        writer = self.session_writer_for(kwargs.get('userdb')) or self.session_writer
+        if session and writer is not None:
+            writer.record_close(session.session_id, min(time.time(), session.expires_at))
         # if we can't find the session, do nothing
     
 
@@ -202,34 +718,578 @@ class AtriumClient(object):
 
 
 
-class SMSService(object):
-    def __init__(self, **kwargs):
-        account_sid = kwargs['account_sid']
-        auth_token = kwargs['auth_token']
-        self.source_number = kwargs['source_mobile_number']
+class TwilioSMSTransport(object):
+    '''Sends through the Twilio REST API. All sends go through one pooled HTTP session.
+    '''
 
+    def __init__(self, account_sid, auth_token):
         if not account_sid:
             raise Exception('Missing Twilio account SID var.')
 
         if not auth_token:
             raise Exception('Missing Twilio auth token var.')
 
-        self.client = Client(account_sid, auth_token)
-
-    def send_sms(self, mobile_number, message):
-        print('### sending message body via SMS from [%s] to [%s] :' % (self.source_number, mobile_number))
-        print(message)
+        self.client = Client(account_sid, auth_token, http_client=TwilioHttpClient(pool_connections=True))
 
+    def send(self, source_number, mobile_number, message) -> str:
         message = self.client.messages.create(
             to='+1%s' % mobile_number,
-            from_='+1%s' % self.source_number,
+            from_='+1%s' % source_number,
             body=message
         )
 
         return message.sid
 
 
-class PostgreSQLService(object):
+class FakeSMSTransport(object):
+    '''Stands in for Twilio in local and test setups: keeps every message it is asked to send,
+    optionally after a simulated round trip.
+    '''
+
+    def __init__(self, **kwargs):
+        self.latency_seconds = float(kwargs.get('latency_seconds') or 0)
+        self.sent_messages = []
+        self.lock = threading.Lock()
+
+    def send(self, source_number, mobile_number, message) -> str:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+        sid = 'FAKE%s' % uuid.uuid4().hex
+        with self.lock:
+            self.sent_messages.append({
+                'sid': sid,
+                'from': source_number,
+                'to': mobile_number,
+                'body': message
+            })
+
+        return sid
+
+
+SMS_TRANSPORTS = {
+    'twilio': lambda **kwargs: TwilioSMSTransport(kwargs['account_sid'], kwargs['auth_token']),
+    'fake': lambda **kwargs: FakeSMSTransport(latency_seconds=kwargs.get('fake_latency_seconds'))
+}
+
+# one queued reply (possibly several coalesced replies) to a single number, and the futures of
+# every send_sms() call whose text it carries
+OutboundSMS = namedtuple('OutboundSMS', 'mobile_number message futures enqueued_at')
+PendingReplies = namedtuple('PendingReplies', 'messages futures')
+
+GSM7_BASIC_CHARS = frozenset('@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+                             '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+# these take two septets (an escape, then the character)
+GSM7_EXTENDED_CHARS = frozenset('^{}\\[~]|€\f')
+
+SMS_ENCODING_GSM7 = 'gsm7'
+SMS_ENCODING_UCS2 = 'ucs2'
+
+# (units in a single-segment message, units per segment of a concatenated message)
+SMS_SEGMENT_CAPACITY = {
+    SMS_ENCODING_GSM7: (160, 153),
+    SMS_ENCODING_UCS2: (70, 67)
+}
+
+PARAGRAPH_BREAK = '\n\n'
+
+
+def sms_encoding(text: str) -> str:
+    for char in text:
+        if char not in GSM7_BASIC_CHARS and char not in GSM7_EXTENDED_CHARS:
+            return SMS_ENCODING_UCS2
+    return SMS_ENCODING_GSM7
+
+
+def sms_char_units(char: str, encoding: str) -> int:
+    if encoding == SMS_ENCODING_GSM7:
+        return 2 if char in GSM7_EXTENDED_CHARS else 1
+    # UCS-2 segments are counted in UTF-16 code units, so characters outside the BMP take two
+    return 2 if ord(char) > 0xFFFF else 1
+
+
+def sms_segment_count(text: str) -> int:
+    encoding = sms_encoding(text)
+    length = sum(sms_char_units(char, encoding) for char in text)
+    single_capacity, multi_capacity = SMS_SEGMENT_CAPACITY[encoding]
+    if length <= single_capacity:
+        return 1
+    return math.ceil(length / multi_capacity)
+
+
+def split_sms_text(text: str, max_segments: int, separators=(PARAGRAPH_BREAK, '\n', ' ')) -> list:
+    '''Split text into messages of at most max_segments carrier segments each, breaking
+    at paragraphs where possible, then at lines, then at words. Each message is measured
+    in its own encoding, so one non-GSM character only forces UCS-2 on the message
+    that contains it.
+    '''
+
+    if sms_segment_count(text) <= max_segments:
+        return [text]
+
+    if not separators:
+        # a single word too long for a message: cut it at the capacity of the message encoding
+        encoding = sms_encoding(text)
+        capacity = max_segments * SMS_SEGMENT_CAPACITY[encoding][1]
+        chunks = []
+        current = []
+        units = 0
+        for char in text:
+            char_units = sms_char_units(char, encoding)
+            if units + char_units > capacity:
+                chunks.append(''.join(current))
+                current = []
+                units = 0
+            current.append(char)
+            units += char_units
+        chunks.append(''.join(current))
+        return chunks
+
+    separator = separators[0]
+    chunks = []
+    current = None
+    for piece in text.split(separator):
+        candidate = piece if current is None else current + separator + piece
+        if sms_segment_count(candidate) <= max_segments:
+            current = candidate
+            continue
+
+        if current is not None:
+            chunks.append(current)
+
+        pieces = split_sms_text(piece, max_segments, separators[1:])
+        chunks.extend(pieces[:-1])
+        current = pieces[-1]
+
+    if current is not None:
+        chunks.append(current)
+
+    return chunks
+
+
+def sms_error_is_retryable(err) -> bool:
+    # Twilio API errors carry the HTTP status; connection failures and timeouts do not
+    status = getattr(err, 'status', None)
+    if status is None:
+        return True
+    return status == 429 or status >= 500
+
+
+class SendRateLimiter(object):
+    '''Token bucket shared by all sender workers, so that the account-wide send rate is honoured
+    however many workers there are.
+    '''
+
+    def __init__(self, sends_per_second: float, burst: int=1):
+        self.rate = float(sends_per_second)
+        self.capacity = max(int(burst), 1)
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class SMSService(object):
+    '''Outbound SMS.
+
+    Text longer than max_segments_per_send carrier segments is split at paragraph breaks into
+    several sends. send_sms() returns the message SID, or a list of SIDs if the text was split.
+
+    With sender_workers set to 0 (the default), send_sms() sends inline.
+    Otherwise send_sms() puts the message on an in-process queue and returns a Future for its SID(s);
+    the queue is drained by that many worker threads, which retry transient failures with exponential
+    backoff and share a per-account rate limit (max_sends_per_second). With coalesce_window_ms set,
+    queued replies to the same number that arrive within that window go out together, as one text
+    with the replies separated by blank lines.
+
+    The transport init_param selects "twilio" (the default) or "fake", which records messages locally.
+    '''
+
+    def __init__(self, **kwargs):
+        self.source_number = kwargs['source_mobile_number']
+
+        transport_name = kwargs.get('transport') or 'twilio'
+        transport_factory = SMS_TRANSPORTS.get(transport_name)
+        if not transport_factory:
+            raise Exception('Unsupported SMS transport "%s". Supported transports are: %s' % (transport_name, list(SMS_TRANSPORTS.keys())))
+
+        self.transport = transport_factory(**kwargs)
+
+        self.num_workers = int(kwargs.get('sender_workers') or 0)
+        self.max_retries = int(kwargs.get('max_send_retries') or 3)
+        self.retry_backoff_seconds = float(kwargs.get('send_retry_backoff_seconds') or 0.5)
+        self.max_queue_size = int(kwargs.get('max_send_queue_size') or 0)
+        self.max_segments_per_send = int(kwargs.get('max_segments_per_send') or 10)
+        self.coalesce_window_seconds = float(kwargs.get('coalesce_window_ms') or 0) / 1000.0
+
+        self.pending_replies = {}
+        self.pending_lock = threading.Lock()
+
+        self.rate_limiter = None
+        if kwargs.get('max_sends_per_second'):
+            self.rate_limiter = SendRateLimiter(kwargs['max_sends_per_second'], kwargs.get('send_burst') or 1)
+
+        self.send_queue = queue.Queue(maxsize=self.max_queue_size)
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            'enqueued': 0,
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+            'coalesced': 0,
+            'split': 0,
+            'segments': 0,
+            'max_queue_depth': 0,
+            'max_queue_wait_seconds': 0.0
+        }
+
+        self.workers = []
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self.sender_loop, name='sms_sender_%d' % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        if self.workers:
+            # the workers are daemon threads; without this, whatever is still queued at exit is lost
+            atexit.register(self.shutdown)
+
+    def queue_depth(self) -> int:
+        return self.send_queue.qsize()
+
+    def send_stats(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.queue_depth()
+        stats['workers'] = self.num_workers
+        return stats
+
+    def record_stat(self, name, increment=1):
+        with self.stats_lock:
+            self.stats[name] += increment
+
+    def deliver(self, mobile_number, message) -> str:
+        print('### sending message body via SMS from [%s] to [%s] :' % (self.source_number, mobile_number))
+        print(message)
+
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        sid = self.transport.send(self.source_number, mobile_number, message)
+        self.record_stat('segments', sms_segment_count(message))
+        return sid
+
+    def split_message(self, message) -> list:
+        chunks = split_sms_text(message, self.max_segments_per_send)
+        if len(chunks) > 1:
+            self.record_stat('split')
+        return chunks
+
+    def deliver_with_retries(self, mobile_number, message) -> str:
+        attempt = 0
+        while True:
+            try:
+                return self.deliver(mobile_number, message)
+            except Exception as err:
+                if attempt >= self.max_retries or not sms_error_is_retryable(err):
+                    raise
+
+                delay = self.retry_backoff_seconds * (2 ** attempt)
+                delay += random.uniform(0, delay / 2)
+                print('### SMS send to [%s] failed (%s); retrying in %.2f seconds.' % (mobile_number, err, delay))
+                self.record_stat('retried')
+                attempt += 1
+                time.sleep(delay)
+
+    def sender_loop(self):
+        while True:
+            outbound = self.send_queue.get()
+            try:
+                if outbound is None:
+                    return
+
+                wait_seconds = time.monotonic() - outbound.enqueued_at
+                with self.stats_lock:
+                    self.stats['max_queue_wait_seconds'] = max(self.stats['max_queue_wait_seconds'], wait_seconds)
+
+                try:
+                    sids = [self.deliver_with_retries(outbound.mobile_number, chunk)
+                            for chunk in self.split_message(outbound.message)]
+                    self.record_stat('sent')
+                    for future in outbound.futures:
+                        future.set_result(sids[0] if len(sids) == 1 else sids)
+                except Exception as err:
+                    print('### giving up on SMS send to [%s]: %s' % (outbound.mobile_number, err))
+                    self.record_stat('failed')
+                    for future in outbound.futures:
+                        future.set_exception(err)
+            finally:
+                self.send_queue.task_done()
+
+    def enqueue(self, mobile_number, messages, futures):
+        self.send_queue.put(OutboundSMS(mobile_number=mobile_number,
+                                        message=PARAGRAPH_BREAK.join(messages),
+                                        futures=futures,
+                                        enqueued_at=time.monotonic()))
+        with self.stats_lock:
+            self.stats['enqueued'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.send_queue.qsize())
+
+    def flush_pending_replies(self, mobile_number):
+        with self.pending_lock:
+            pending = self.pending_replies.pop(mobile_number, None)
+
+        if pending:
+            self.record_stat('coalesced', len(pending.messages) - 1)
+            self.enqueue(mobile_number, pending.messages, pending.futures)
+
+    def send_sms(self, mobile_number, message):
+        if not self.workers:
+            sids = [self.deliver(mobile_number, chunk) for chunk in self.split_message(message)]
+            self.record_stat('sent')
+            return sids[0] if len(sids) == 1 else sids
+
+        future = Future()
+        if not self.coalesce_window_seconds:
+            self.enqueue(mobile_number, [message], [future])
+            return future
+
+        # the first reply to a number opens its window; anything else for that number
+        # before the window closes rides along with it
+        with self.pending_lock:
+            pending = self.pending_replies.get(mobile_number)
+            if pending is None:
+                pending = PendingReplies(messages=[], futures=[])
+                self.pending_replies[mobile_number] = pending
+
+                timer = threading.Timer(self.coalesce_window_seconds, self.flush_pending_replies, args=(mobile_number,))
+                timer.daemon = True
+                timer.start()
+
+            pending.messages.append(message)
+            pending.futures.append(future)
+
+        return future
+
+    def shutdown(self, wait=True):
+        '''Stop the sender workers once everything already queued has been sent (and retried).
+        Registered to run at exit; calling it earlier is harmless.
+        '''
+
+        if not self.workers:
+            return
+
+        for mobile_number in list(self.pending_replies.keys()):
+            self.flush_pending_replies(mobile_number)
+
+        for _ in self.workers:
+            self.send_queue.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+        self.workers = []
+
+
+SCHEMA_REFLECTION_EAGER = 'eager'
+SCHEMA_REFLECTION_CACHED = 'cached'
+SCHEMA_REFLECTION_LAZY = 'lazy'
+
+# one cheap query that changes whenever a column, key or foreign key in the schema does
+SCHEMA_FINGERPRINT_SQL = '''
+SELECT md5(
+    coalesce((SELECT string_agg(c.table_name || '.' || c.column_name || ':' || c.data_type || ':' || c.is_nullable || ':' ||
+                                coalesce(c.column_default, ''), ',' ORDER BY c.table_name, c.ordinal_position)
+              FROM information_schema.columns c
+              WHERE c.table_schema = :schema), '')
+    || '|' ||
+    coalesce((SELECT string_agg(tc.table_name || '.' || tc.constraint_name || ':' || tc.constraint_type || ':' || kcu.column_name,
+                                ',' ORDER BY tc.table_name, tc.constraint_name, kcu.ordinal_position)
+              FROM information_schema.table_constraints tc
+              JOIN information_schema.key_column_usage kcu
+                ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name
+              WHERE tc.table_schema = :schema), '')
+)
+'''
+
+
+class LazyMappedClasses(object):
+    def __init__(self, lazy_base):
+        self.lazy_base = lazy_base
+
+    def __getattr__(self, table_name):
+        if table_name.startswith('_'):
+            raise AttributeError(table_name)
+        return self.lazy_base.map_table(table_name)
+
+
+class LazyReflectedBase(object):
+    '''Stands in for an automap base, reflecting and mapping each table (and the tables its
+    foreign keys point to) the first time Base.classes.<table> is used.
+    '''
+
+    def __init__(self, engine, metadata):
+        self.engine = engine
+        self.automap = automap_base(metadata=metadata)
+        self.classes = LazyMappedClasses(self)
+        self.lock = threading.Lock()
+
+    def map_table(self, table_name):
+        with self.lock:
+            if table_name not in self.automap.classes:
+                self.automap.prepare(autoload_with=self.engine, reflection_options={'only': [table_name]})
+        return getattr(self.automap.classes, table_name)
+
+
+class PoolWaitStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, wait_seconds: float, timed_out: bool=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.timeouts,
+                'avg_checkout_wait_ms': (self.total_wait_seconds / attempts * 1000) if attempts else 0.0,
+                'max_checkout_wait_ms': self.max_wait_seconds * 1000
+            }
+
+
+class CheckoutTimingPool(object):
+    '''Mixed into a pool class to time how long each checkout waits for a connection.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except sqla.exc.TimeoutError:
+            self.wait_stats.record(time.monotonic() - start, timed_out=True)
+            raise
+
+        self.wait_stats.record(time.monotonic() - start)
+        return connection
+
+    def recreate(self):
+        # the pool is replaced when the engine is disposed or its connections invalidated;
+        # keep counting into the same stats
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+
+class InstrumentedQueuePool(CheckoutTimingPool, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(CheckoutTimingPool, AsyncAdaptedQueuePool):
+    pass
+
+
+class ReflectedSchemaCache(object):
+    '''Reads and writes the reflected-schema cache file for a service with engine, schema
+    and schema_cache_dir attributes.
+    '''
+
+    def schema_cache_file(self) -> str:
+        url = self.engine.url.render_as_string(hide_password=True)
+        cache_key = hashlib.sha1(('%s|%s' % (url, self.schema)).encode('utf-8')).hexdigest()
+        return os.path.join(self.schema_cache_dir, 'pulse_schema_%s.pickle' % cache_key)
+
+    def load_cached_metadata(self, fingerprint: str) -> MetaData:
+        try:
+            with open(self.schema_cache_file(), 'rb') as f:
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            print('### ignoring unreadable schema cache file: %s' % err, file=sys.stderr)
+            return None
+
+        if cached.get('fingerprint') != fingerprint or cached.get('sqlalchemy_version') != sqla.__version__:
+            return None
+        return cached['metadata']
+
+    def save_cached_metadata(self, fingerprint: str, metadata: MetaData):
+        cache_file = self.schema_cache_file()
+        try:
+            os.makedirs(self.schema_cache_dir, exist_ok=True)
+            # write then rename, so that a concurrent startup never reads a partial file
+            with tempfile.NamedTemporaryFile('wb', dir=self.schema_cache_dir, delete=False) as f:
+                pickle.dump({
+                    'fingerprint': fingerprint,
+                    'sqlalchemy_version': sqla.__version__,
+                    'metadata': metadata
+                }, f)
+            os.replace(f.name, cache_file)
+        except Exception as err:
+            print('### unable to write schema cache file %s: %s' % (cache_file, err), file=sys.stderr)
+
+
+def pool_settings(svc, kwargs):
+    '''Reads the pool init_params shared by the sync and asyncio PostgreSQL services onto svc
+    '''
+
+    svc.pool_size = int(kwargs.get('pool_size') or 5)
+    svc.max_overflow = int(kwargs.get('max_overflow') if kwargs.get('max_overflow') is not None else 10)
+    svc.pool_timeout = float(kwargs.get('pool_timeout') or 30)
+    svc.pool_recycle = int(kwargs.get('pool_recycle') or -1)
+    svc.pool_pre_ping = str(kwargs.get('pool_pre_ping', True)).lower() in ('true', '1', 'yes')
+    svc.statement_timeout_ms = kwargs.get('statement_timeout_ms')
+    svc.application_name = kwargs.get('application_name') or os.path.basename(sys.argv[0]) or 'pulse'
+
+
+def pool_stats(svc, pool) -> dict:
+    stats = {
+        'pool_size': pool.size(),
+        'max_overflow': svc.max_overflow,
+        'in_use': pool.checkedout(),
+        'idle': pool.checkedin(),
+        'overflow': pool.overflow()
+    }
+    stats.update(pool.wait_stats.snapshot())
+    return stats
+
+
+class PostgreSQLService(ReflectedSchemaCache):
+    '''Connection pooling is set by the pool_size, max_overflow, pool_timeout (seconds to wait
+    for a connection), pool_recycle (seconds) and pool_pre_ping init_params; statement_timeout_ms
+    and application_name are set on every connection. pool_stats() reports pool usage.
+
+    schema_reflection selects how the table mappings in Base.classes are built:
+
+    eager (the default): reflect the whole schema at startup.
+    cached: reflect once, then load the reflected schema from a file in schema_cache_dir for
+            as long as the database schema fingerprint is unchanged.
+    lazy: reflect each table the first time it is used.
+    '''
+
     def __init__(self, **kwargs):
         kwreader = common.KeywordArgReader(*POSTGRESQL_SVC_PARAM_NAMES)
         kwreader.read(**kwargs)
@@ -247,7 +1307,18 @@ class PostgreSQLService(object):
         self.Base = None
         self.url = None
 
-        url_template = '{db_type}://{user}:{passwd}@{host}/{database}'
+        self.schema_reflection = kwargs.get('schema_reflection') or SCHEMA_REFLECTION_EAGER
+        if self.schema_reflection not in (SCHEMA_REFLECTION_EAGER, SCHEMA_REFLECTION_CACHED, SCHEMA_REFLECTION_LAZY):
+            raise Exception('Unsupported schema_reflection mode "%s".' % self.schema_reflection)
+        self.schema_cache_dir = os.path.expanduser(kwargs.get('schema_cache_dir') or os.path.join('~', '.cache', 'pulse'))
+
+        pool_settings(self, kwargs)
+
+        connect_args = {'application_name': self.application_name}
+        if self.statement_timeout_ms:
+            connect_args['options'] = '-c statement_timeout=%d' % int(self.statement_timeout_ms)
+
+        url_template = '{db_type}://{user}:{passwd}@{host}:{port}/{database}'
         db_url = url_template.format(db_type='postgresql+psycopg2',
                                      user=self.username,
                                      passwd=self.password,
@@ -259,11 +1330,16 @@ class PostgreSQLService(object):
         connected = False
         while not connected and retries < self.max_connect_retries:
             try:
-                self.engine = sqla.create_engine(db_url, echo=False)
-                self.metadata = MetaData(schema=self.schema)
-                self.Base = automap_base(bind=self.engine, metadata=self.metadata)
-                self.Base.prepare(self.engine, reflect=True)
-                self.metadata.reflect(bind=self.engine)
+                self.engine = sqla.create_engine(db_url,
+                                                 echo=False,
+                                                 poolclass=InstrumentedQueuePool,
+                                                 pool_size=self.pool_size,
+                                                 max_overflow=self.max_overflow,
+                                                 pool_timeout=self.pool_timeout,
+                                                 pool_recycle=self.pool_recycle,
+                                                 pool_pre_ping=self.pool_pre_ping,
+                                                 connect_args=connect_args)
+                self.map_schema()
                 self.session_factory = sessionmaker(bind=self.engine, autoflush=False, autocommit=False)
 
                 # this is required. See comment in SimpleRedshiftService 
@@ -284,6 +1360,35 @@ class PostgreSQLService(object):
             raise Exception('!!! Unable to connect to PostgreSQL db on host %s at port %s.' % 
                             (self.host, self.port))
 
+    def map_schema(self):
+        if self.schema_reflection == SCHEMA_REFLECTION_LAZY:
+            self.metadata = MetaData(schema=self.schema)
+            self.Base = LazyReflectedBase(self.engine, self.metadata)
+            return
+
+        if self.schema_reflection == SCHEMA_REFLECTION_CACHED:
+            fingerprint = self.schema_fingerprint()
+            self.metadata = self.load_cached_metadata(fingerprint)
+            if self.metadata is not None:
+                self.Base = automap_base(metadata=self.metadata)
+                self.Base.prepare()
+                print('### Loaded PostgreSQL schema from reflection cache.', file=sys.stderr)
+                return
+
+        self.metadata = MetaData(schema=self.schema)
+        self.Base = automap_base(metadata=self.metadata)
+        self.Base.prepare(autoload_with=self.engine)
+
+        if self.schema_reflection == SCHEMA_REFLECTION_CACHED:
+            self.save_cached_metadata(fingerprint, self.metadata)
+
+    def schema_fingerprint(self) -> str:
+        with self.engine.connect() as connection:
+            return connection.execute(sqla.text(SCHEMA_FINGERPRINT_SQL), {'schema': self.schema}).scalar()
+
+    def pool_stats(self) -> dict:
+        return pool_stats(self, self.engine.pool)
+
     @contextmanager
     def txn_scope(self):
         session = self.session_factory()
@@ -305,6 +1410,156 @@ class PostgreSQLService(object):
             connection.close()
 
 
+class AsyncPostgreSQLService(ReflectedSchemaCache):
+    '''The asyncio counterpart of PostgreSQLService (SQLAlchemy's asyncio engine over asyncpg),
+    taking the same init_params:
+
+        async with db_svc.txn_scope() as session:
+            User = db_svc.Base.classes.users
+            result = await session.execute(select(User).where(...))
+
+    Nothing connects until the first txn_scope() or connect(), which also maps the schema
+    (or call "await db_svc.initialize()" at startup). schema_reflection may be eager or cached.
+    '''
+
+    def __init__(self, **kwargs):
+        kwreader = common.KeywordArgReader(*POSTGRESQL_SVC_PARAM_NAMES)
+        kwreader.read(**kwargs)
+
+        self.db_name = kwargs['database']
+        self.host = kwargs['host']
+        self.port = int(kwargs.get('port', 5432))
+        self.username = kwargs['username']
+        self.password = kwargs['password']
+        self.schema = kwargs['schema']
+        self.max_connect_retries = int(kwargs.get('max_connect_retries') or 3)
+        self.metadata = None
+        self.Base = None
+
+        self.schema_reflection = kwargs.get('schema_reflection') or SCHEMA_REFLECTION_EAGER
+        if self.schema_reflection not in (SCHEMA_REFLECTION_EAGER, SCHEMA_REFLECTION_CACHED):
+            raise Exception('Unsupported schema_reflection mode "%s" for AsyncPostgreSQLService.' % self.schema_reflection)
+        self.schema_cache_dir = os.path.expanduser(kwargs.get('schema_cache_dir') or os.path.join('~', '.cache', 'pulse'))
+
+        pool_settings(self, kwargs)
+
+        url_template = '{db_type}://{user}:{passwd}@{host}:{port}/{database}'
+        self.url = url_template.format(db_type='postgresql+asyncpg',
+                                       user=self.username,
+                                       passwd=self.password,
+                                       host=self.host,
+                                       port=self.port,
+                                       database=self.db_name)
+
+        # the engine is built on first use, so that loading a config which declares this service
+        # does not require asyncpg (or greenlet) in processes that never use it
+        self.engine = None
+        self.session_factory = None
+        # created on first use, so that it belongs to the loop the service runs on
+        self.init_lock = None
+
+    def build_engine(self):
+        from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+        server_settings = {'application_name': self.application_name}
+        if self.statement_timeout_ms:
+            server_settings['statement_timeout'] = str(int(self.statement_timeout_ms))
+
+        self.engine = create_async_engine(self.url,
+                                          echo=False,
+                                          poolclass=InstrumentedAsyncQueuePool,
+                                          pool_size=self.pool_size,
+                                          max_overflow=self.max_overflow,
+                                          pool_timeout=self.pool_timeout,
+                                          pool_recycle=self.pool_recycle,
+                                          pool_pre_ping=self.pool_pre_ping,
+                                          connect_args={'server_settings': server_settings})
+
+        self.session_factory = sessionmaker(bind=self.engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    async def initialize(self):
+        if self.Base is not None:
+            return
+
+        if self.init_lock is None:
+            self.init_lock = asyncio.Lock()
+
+        async with self.init_lock:
+            if self.Base is not None:
+                return
+
+            if self.engine is None:
+                self.build_engine()
+
+            retries = 0
+            while True:
+                try:
+                    async with self.engine.connect() as connection:
+                        await connection.run_sync(self.map_schema)
+                    print('### Connected to PostgreSQL DB (asyncio).', file=sys.stderr)
+                    return
+
+                except Exception as err:
+                    print(err, file=sys.stderr)
+                    print(err.__class__.__name__, file=sys.stderr)
+                    retries += 1
+                    if retries >= self.max_connect_retries:
+                        raise Exception('!!! Unable to connect to PostgreSQL db on host %s at port %s.' %
+                                        (self.host, self.port))
+                    await asyncio.sleep(1)
+
+    def map_schema(self, sync_connection):
+        # reflection is synchronous; this runs under AsyncConnection.run_sync()
+        if self.schema_reflection == SCHEMA_REFLECTION_CACHED:
+            fingerprint = sync_connection.execute(sqla.text(SCHEMA_FINGERPRINT_SQL), {'schema': self.schema}).scalar()
+            metadata = self.load_cached_metadata(fingerprint)
+            if metadata is not None:
+                base = automap_base(metadata=metadata)
+                base.prepare()
+                self.metadata = metadata
+                self.Base = base
+                print('### Loaded PostgreSQL schema from reflection cache.', file=sys.stderr)
+                return
+
+        metadata = MetaData(schema=self.schema)
+        base = automap_base(metadata=metadata)
+        base.prepare(autoload_with=sync_connection)
+
+        if self.schema_reflection == SCHEMA_REFLECTION_CACHED:
+            self.save_cached_metadata(fingerprint, metadata)
+
+        self.metadata = metadata
+        self.Base = base
+
+    def pool_stats(self) -> dict:
+        if self.engine is None:
+            self.build_engine()
+        return pool_stats(self, self.engine.sync_engine.pool)
+
+    @asynccontextmanager
+    async def txn_scope(self):
+        await self.initialize()
+        session = self.session_factory()
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
+    @asynccontextmanager
+    async def connect(self):
+        await self.initialize()
+        async with self.engine.connect() as connection:
+            yield connection
+
+    async def dispose(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+
+
 class S3Key(object):
     def __init__(self, bucket_name, s3_object_path):
         self.bucket = bucket_name
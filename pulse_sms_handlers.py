@@ -45,9 +45,15 @@ def handle_user_online(cmd_object: SystemCommand, dlg_context: SMSDialogContext,
         user_sms_number = dlg_context.source_number
         pulse_sms_session = None # TODO first see if a valid pulse sms session exists
 
-        with db_svc.txn_scope() as dbsession:    
-            username = atrium_client_svc.lookup_username_by_mobile_number(user_sms_number, dbsession, db_svc)
-            pulse_sms_session = atrium_client_svc.open_user_session_sms(user_sms_number, username, hold_until_verified=False)
+        identity = atrium_client_svc.lookup_user_identity(user_sms_number, db_svc)
+        if identity is None:
+            raise orm.exc.NoResultFound()
+
+        pulse_sms_session = atrium_client_svc.open_user_session_sms(user_sms_number,
+                                                                    identity.user_id,
+                                                                    username=identity.username,
+                                                                    userdb=db_svc,
+                                                                    hold_until_verified=False)
 
     except orm.exc.NoResultFound as err:
         return f'no user registered under the SMS number of this terminal.'
@@ -65,7 +71,7 @@ def handle_user_offline(cmd_object, dlg_context, lexicon, service_registry, **kw
     atrium_svc = service_registry.lookup('atrium')
     
     user_sms_number = dlg_context.source_number
-    atrium_svc.close_session_sms(user_sms_number) # may return more than one?
+    atrium_svc.close_session_sms(user_sms_number, userdb=service_registry.lookup('postgres')) # may return more than one?
 
     return 'User offline.'
 
@@ -245,15 +251,23 @@ def register_remote_pulse_server(cmd_object, dlg_context, lexicon, service_regis
 
 def display_help_prompts(cmd_object, dlg_context, lexicon, service_registry, **kwargs) -> str:
     if len(cmd_object.modifiers):
-        # calling "help" and passing a command string gives the help string for that command only
         help_target = cmd_object.modifiers[0]        
-        cmdspec = lexicon.match_sys_command(help_target)
-        if not cmdspec:
+
+        # calling "help" with a number gives that page of the help text
+        if help_target.isdigit():
+            help_page = lexicon.help_page(int(help_target))
+            if not help_page:
+                return f'there is no help page {help_target}; help runs from page 1 to {len(lexicon.help_pages)}.'
+            return help_page
+
+        # calling "help" and passing a command string gives the help string for that command only
+        help_string = lexicon.lookup_help(help_target)
+        if not help_string:
             return f'no such command "{help_target}".'
-        return f'command "{help_target}": {cmdspec.definition}'
+        return help_string
     
-    # calling "help" by itself gives you the help strings for all commands
-    return lexicon.compile_help_string()
+    # calling "help" by itself gives you the first page of help strings for all commands
+    return lexicon.help_page(1)
 
 
 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+
+'''
+Usage:
+    schema_bench.py --dbconfig <configfile> [options]
+
+Options:
+    --users <n>             users to generate [default: 100000]
+    --sessions <n>          active_sessions rows to generate [default: 1000000]
+    --history-days <n>      spread session start times over this many days [default: 180]
+    --lookups <n>           times each query is run per phase [default: 50]
+    --schema <name>         scratch schema the dataset is built in (dropped afterwards) [default: pulse_bench]
+    --dir <migration_dir>   where the migration files live [default: sql/migrations]
+    --output <file>         append results (one JSON document per line) to this file [default: schema_bench_results.jsonl]
+
+Builds the core schema (sql/core_ddl.sql) in a scratch schema, fills it with a generated
+dataset, and times the lookups the SMS path makes -- user by mobile number, a user's open
+sessions, an entity's role assignments -- first against the bare schema and then again
+after applying the migrations in <migration_dir>. For each query it records the plan
+EXPLAIN ANALYZE chose (the scan type and the index used, if any) and the execution time.
+'''
+
+import os, sys
+import json
+import time
+import datetime
+from snap import snap, common
+import docopt
+from dbmigrate import load_migrations, apply_migrations, execute_script
+from atrium_bench import percentile, current_revision
+
+
+CORE_DDL_FILE = os.path.join('sql', 'core_ddl.sql')
+
+# placeholders are filled in with integers only
+DATASET_SQL = '''
+INSERT INTO "ref_session_init_types" VALUES (1, 'auto');
+INSERT INTO "ref_session_types" VALUES (1, 'sms');
+INSERT INTO "ref_session_profiles" VALUES (1, 'default', 1800, 1);
+INSERT INTO "ref_entity_types" VALUES (1, 'user', 'users', 'id');
+
+INSERT INTO "users" ("id", "username", "password", "email", "sms_country_code", "sms_phone_number", "status", "created_ts", "deleted_ts")
+SELECT md5('user' || i)::uuid, 'user' || i, 'x', 'user' || i || '@example.com', '1', (2120000000 + i)::text, 1,
+       now() - (i % 365) * interval '1 day',
+       CASE WHEN i % 20 = 0 THEN now() ELSE NULL END
+FROM generate_series(1, {users}) i;
+
+INSERT INTO "active_sessions" ("id", "user_id", "session_type_ref_id", "session_profile_ref_id", "created_ts", "expired_ts")
+SELECT md5('session' || i)::uuid, md5('user' || (1 + i % {users}))::uuid, 1, 1, started_ts,
+       CASE WHEN i % 100 = 0 THEN NULL ELSE started_ts + interval '30 minutes' END
+FROM (SELECT i, now() - random() * {history_days} * interval '1 day' AS started_ts
+      FROM generate_series(1, {sessions}) i) s;
+
+INSERT INTO "role_assignments" ("id", "entity_type_ref_id", "entity_id", "role_id", "created_ts")
+SELECT md5('role_assignment' || i)::uuid, 1, md5('user' || (1 + i % {users}))::uuid, md5('role' || (i % 50))::uuid, now()
+FROM generate_series(1, {users} * 3) i;
+
+ANALYZE;
+'''
+
+# each query takes the generated user number n
+BENCH_QUERIES = {
+    'user_by_mobile_number': '''SELECT "id", "username" FROM "users"
+                                WHERE "sms_phone_number" = ({n} + 2120000000)::text AND "deleted_ts" IS NULL''',
+    'open_sessions_by_user': '''SELECT "id", "created_ts" FROM "active_sessions"
+                                WHERE "user_id" = md5('user' || {n})::uuid AND "expired_ts" IS NULL''',
+    'role_assignments_by_entity': '''SELECT "role_id" FROM "role_assignments"
+                                     WHERE "entity_id" = md5('user' || {n})::uuid AND "deleted_ts" IS NULL'''
+}
+
+
+def plan_summary(plan: dict) -> dict:
+    '''the node types and indexes used anywhere in an EXPLAIN (FORMAT JSON) plan tree
+    '''
+
+    node_types = []
+    indexes = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        node_types.append(node['Node Type'])
+        if node.get('Index Name'):
+            indexes.append(node['Index Name'])
+        nodes.extend(node.get('Plans', []))
+
+    return {
+        'node_types': sorted(set(node_types)),
+        'indexes': sorted(set(indexes))
+    }
+
+
+def run_queries(connection, num_users: int, num_lookups: int) -> dict:
+    results = {}
+    for query_name, query_template in BENCH_QUERIES.items():
+        timings = []
+        plan = None
+        for lookup in range(num_lookups):
+            # spread the lookups over the generated users; skip the soft-deleted ones (every 20th)
+            n = 1 + (lookup * 7919) % num_users
+            if n % 20 == 0:
+                n += 1
+            explain = execute_script(connection, 'EXPLAIN (ANALYZE, FORMAT JSON) ' + query_template.format(n=n)).scalar()
+            if isinstance(explain, str):
+                explain = json.loads(explain)
+            timings.append(explain[0]['Execution Time'])
+            plan = explain[0]['Plan']
+
+        timings.sort()
+        results[query_name] = {
+            'plan': plan_summary(plan),
+            'execution_ms': {
+                'p50': percentile(timings, 50),
+                'p99': percentile(timings, 99),
+                'max': timings[-1]
+            }
+        }
+
+    return results
+
+
+def main(args):
+    configfile = args['<configfile>']
+    yaml_config = common.read_config_file(configfile)
+    service_registry = common.ServiceObjectRegistry(snap.initialize_services(yaml_config))
+    db_svc = service_registry.lookup('postgres')
+
+    schema = args['--schema']
+    num_users = int(args['--users'])
+    num_lookups = int(args['--lookups'])
+    migrations = load_migrations(args['--dir'])
+
+    with open(CORE_DDL_FILE) as f:
+        core_ddl = f.read()
+
+    with db_svc.connect() as connection:
+        with connection.begin():
+            connection.exec_driver_sql(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+            connection.exec_driver_sql(f'CREATE SCHEMA "{schema}"')
+            # the DDL and the migrations use unqualified names, so this is where they land
+            connection.exec_driver_sql(f'SET search_path TO "{schema}"')
+            execute_script(connection, core_ddl)
+
+        try:
+            print(f'> generating {num_users} user(s) and {args["--sessions"]} session(s) in schema {schema}', file=sys.stderr)
+            start_time = time.monotonic()
+            with connection.begin():
+                execute_script(connection, DATASET_SQL.format(users=num_users,
+                                                                 sessions=int(args['--sessions']),
+                                                                 history_days=int(args['--history-days'])))
+            print('### dataset generated in %.1f seconds' % (time.monotonic() - start_time), file=sys.stderr)
+
+            with connection.begin():
+                before = run_queries(connection, num_users, num_lookups)
+
+            applied = apply_migrations(connection, migrations)
+            with connection.begin():
+                # the stats must cover the rewritten active_sessions before the planner is asked again
+                connection.exec_driver_sql('ANALYZE')
+                after = run_queries(connection, num_users, num_lookups)
+
+        finally:
+            with connection.begin():
+                connection.exec_driver_sql(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+                connection.exec_driver_sql('RESET search_path')
+
+    result = {
+        'revision': current_revision(),
+        'run_ts': datetime.datetime.now().isoformat(),
+        'users': num_users,
+        'sessions': int(args['--sessions']),
+        'history_days': int(args['--history-days']),
+        'lookups': num_lookups,
+        'migrations': [migration.version for migration in applied],
+        'before': before,
+        'after': after
+    }
+
+    print(common.jsonpretty(result))
+    with open(args['--output'], 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
@@ -10,14 +10,17 @@ containing patterns and structures adapted from open-source code donated by @bin
 import os, sys
 import json
 import re
+import itertools
 import uuid
 import json
 import traceback
 import datetime
-from collections import namedtuple
+from types import MappingProxyType
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future
 from urllib.parse import unquote_plus
 
-from pulse_services import SMSService
+from pulse_services import SMSService, normalize_mobile_number, sms_segment_count
 
 from snap import common
 
@@ -31,6 +34,10 @@ FunctionCommand = namedtuple('FunctionCommand', 'mode tag function_name body cmd
 
 CommandInput = namedtuple('CommandInput', 'cmd_type cmd_object')  # command types: generator, syscommand, function
 
+# lexicon versions are drawn from one process-wide sequence, so that no two compiled lexicons
+# (say, one loaded to replace another) ever share a version
+LEXICON_VERSIONS = itertools.count(1)
+
 SMSDialogContext = namedtuple('SMSDialogContext', 'user source_number message')
 
 
@@ -44,10 +51,6 @@ class IncompleteFunctionCommand(Exception):
         super().__init__(self, 'Incomplete function command %s' % cmd_string)
 
 
-def normalize_mobile_number(number_string):
-    return number_string.lstrip('+').lstrip('1').replace('(', '').replace(')', '').replace('-', '').replace('.', '').replace(' ', '')
-
-
 def ok_status(message, **kwargs):
     result = {
         'status': 'ok',
@@ -89,20 +92,138 @@ class CommandLexicon(object):
         self.function_commands = {}
         self.command_macros = {}
 
+        # built by compile(); registering a new command spec discards them
+        self.sys_command_index = None
+        self.generator_matcher = None
+
+        # renewed on every compile, so that anything derived from the lexicon can tell it has changed
+        self.version = 0
+
+        # help output, also rendered by compile(): the full text, the same text cut into pages of
+        # at most help_page_segments SMS segments, and a help line for every command name and synonym
+        self.help_command = None
+        self.help_page_segments = 3
+        self.help_text = None
+        self.help_pages = ()
+        self.help_index = None
+
     def system_spec(self, cmd: SystemCommand):
         return self.system_commands[cmd]
 
 
+    def invalidate(self):
+        self.sys_command_index = None
+        self.generator_matcher = None
+        self.help_text = None
+        self.help_pages = ()
+        self.help_index = None
+
+
     def register_sys_command_spec(self, cmdspec: SMSCommandSpec):
         self.system_commands[cmdspec.command] = cmdspec
+        self.invalidate()
         
 
     def register_gen_command_spec(self, cmdspec: SMSGeneratorSpec):
         self.generator_commands[cmdspec.command] = cmdspec
+        self.invalidate()
 
 
     def register_func_command_spec(self, cmdspec: SMSFunctionSpec):
         self.function_commands[cmdspec.command] = cmdspec
+        self.invalidate()
+
+
+    def compile(self):
+        '''Freeze the registered commands into lookup structures, so that matching an inbound
+        command costs the same no matter how many commands and synonyms are configured:
+
+        - a read-only map from every system command name and synonym to its spec. Where two
+          commands claim the same word, the command registered first wins, as it did when
+          we scanned the command table in order.
+        - one regex matching any generator command name followed by its specifier char,
+          its filter char, or the end of the command string.
+        '''
+
+        sys_index = {}
+        for key, cmd_spec in self.system_commands.items():
+            sys_index.setdefault(key, cmd_spec)
+            for synonym in cmd_spec.synonyms:
+                sys_index.setdefault(synonym, cmd_spec)
+
+        self.sys_command_index = MappingProxyType(sys_index)
+
+        if self.generator_commands:
+            separators = set()
+            for cmd_spec in self.generator_commands.values():
+                separators.update((cmd_spec.specifier, cmd_spec.filterchar))
+
+            # longest names first, so that a command which is a prefix of another cannot shadow it
+            names = sorted(self.generator_commands.keys(), key=len, reverse=True)
+            self.generator_matcher = re.compile(r'^(?:%s)(?=[%s]|$)' % ('|'.join(re.escape(name) for name in names),
+                                                                        ''.join(re.escape(sep) for sep in separators)))
+        else:
+            self.generator_matcher = re.compile(r'(?!)')
+
+        self.compile_help()
+        self.version = next(LEXICON_VERSIONS)
+
+
+    def compile_help(self):
+        help_lines = self.render_help_lines()
+        self.help_text = '\n\n'.join(help_lines)
+        self.help_pages = tuple(self.paginate_help(help_lines))
+
+        help_index = {}
+        for key, cmd_spec in self.system_commands.items():
+            help_index.setdefault(key, 'command "%s": %s' % (key, cmd_spec.definition))
+            for synonym in cmd_spec.synonyms:
+                help_index.setdefault(synonym, 'command "%s" (same as "%s"): %s' % (synonym, key, cmd_spec.definition))
+
+        for key, cmd_spec in self.generator_commands.items():
+            help_index.setdefault(key, 'listing command "%s": %s' % (key, cmd_spec.definition))
+
+        for key, cmd_spec in self.function_commands.items():
+            help_index.setdefault(key, 'function command "%s": %s' % (key, cmd_spec.definition))
+
+        self.help_index = MappingProxyType(help_index)
+
+
+    def help_page_footer(self, page_number: int) -> str:
+        if not self.help_command:
+            return ''
+        return '(reply "%s %d" for more)' % (self.help_command, page_number)
+
+
+    def paginate_help(self, help_lines: list) -> list:
+        # leave room on every page but the last for a footer pointing at the next one
+        footer_allowance = '\n\n' + self.help_page_footer(99)
+
+        pages = []
+        current = None
+        for line in help_lines:
+            candidate = line if current is None else current + '\n\n' + line
+            if current is None or sms_segment_count(candidate + footer_allowance) <= self.help_page_segments:
+                current = candidate
+                continue
+            pages.append(current)
+            current = line
+
+        if current is not None:
+            pages.append(current)
+
+        footed_pages = []
+        for index, page in enumerate(pages):
+            if index < len(pages) - 1 and self.help_command:
+                page = page + '\n\n' + self.help_page_footer(index + 2)
+            footed_pages.append(page)
+
+        return footed_pages
+
+
+    def ensure_compiled(self):
+        if self.sys_command_index is None or self.generator_matcher is None or self.help_index is None:
+            self.compile()
 
 
     def register_command_macro_spec(self):
@@ -113,36 +234,45 @@ class CommandLexicon(object):
 
 
     def match_sys_command(self, cmd_string):
-        for key, cmd_spec in self.system_commands.items():
-            if cmd_string == key:
-                return cmd_spec
-            if cmd_string in cmd_spec.synonyms:
-                return cmd_spec
+        self.ensure_compiled()
+        return self.sys_command_index.get(cmd_string)
+
+
+    def lookup_sms_command(self, cmd_string):
+        return self.match_sys_command(cmd_string)
 
-        return None
 
     def match_generator_command(self, cmd_string):
-        for key, cmd_spec in self.generator_commands.items():
-            delimiter = cmd_spec.specifier
-            filter_char = cmd_spec.filterchar
+        self.ensure_compiled()
+        match = self.generator_matcher.match(cmd_string)
+        if not match:
+            return None
 
-            #print('the filter character is [%s].' % filter_char)
+        return self.generator_commands[match.group(0)]
 
-            if cmd_string.split(delimiter)[0] == key:
-                return cmd_spec
 
-            if cmd_string.split(filter_char)[0] == key:
-                return cmd_spec
+    def match_function_command(self, cmd_string):
+        # function commands are keyed on their single-character tag
+        return self.function_commands.get(cmd_string[:1])
 
-        return None
 
+    def lookup_function_command(self, cmd_string):
+        return self.match_function_command(cmd_string)
 
-    def match_function_command(self, cmd_string):
-        for key, cmd_spec in self.function_commands.items():            
-            if cmd_string[0] == key:
-                return cmd_spec
 
-        return None
+    def lookup_help(self, cmd_string) -> str:
+        self.ensure_compiled()
+        return self.help_index.get(cmd_string)
+
+
+    def help_page(self, page_number: int=1) -> str:
+        '''One pre-rendered page of the help text (numbered from 1), or None if there is no such page
+        '''
+
+        self.ensure_compiled()
+        if page_number < 1 or page_number > len(self.help_pages):
+            return None
+        return self.help_pages[page_number - 1]
             
 
     def lookup_macro(self, courier_id, macro_name, session, db_svc):
@@ -150,6 +280,11 @@ class CommandLexicon(object):
 
 
     def compile_help_string(self):
+        self.ensure_compiled()
+        return self.help_text
+
+
+    def render_help_lines(self) -> list:
         lines = []
 
         lines.append('________')
@@ -172,7 +307,7 @@ class CommandLexicon(object):
 
         lines.append('________')
 
-        return '\n\n'.join(lines)
+        return lines
 
 
 class SMSCommandDispatcher(object):
@@ -187,20 +322,73 @@ class SMSCommandDispatcher(object):
 
 
 class SMSMessageParser(object):
-    def __init__(self, lexicon:CommandLexicon, prefix_separator: str):
+    '''If parse_cache_size is set, the CommandInput parsed from each raw message body is kept
+    in an LRU cache of that size, so that the handful of bodies which make up most traffic
+    (on, off, hlp, my, my.1) are parsed once. Recompiling the lexicon empties the cache.
+    '''
+
+    def __init__(self, lexicon:CommandLexicon, prefix_separator: str, **kwargs):
         self.lexicon = lexicon
         self.prefix_separator = prefix_separator
         self.systemdata_prefix_handlers = {}
 
+        self.parse_cache_size = int(kwargs.get('parse_cache_size') or 0)
+        self.parse_cache = OrderedDict()
+        self.parse_cache_version = None
+        self.parse_cache_hits = 0
+        self.parse_cache_misses = 0
+
 
     def register_sysdata_prefix_handler(self, prefix_string, handler_function):
         self.systemdata_prefix_handlers[prefix_string] = handler_function
+        self.clear_parse_cache()
+
 
+    def clear_parse_cache(self):
+        self.parse_cache.clear()
+        self.parse_cache_version = None
 
-    def parse_sms_message_body(self, raw_body:str):
+
+    def parse_cache_stats(self) -> dict:
+        return {
+            'size': len(self.parse_cache),
+            'max_size': self.parse_cache_size,
+            'hits': self.parse_cache_hits,
+            'misses': self.parse_cache_misses
+        }
+
+
+    def parse_sms_message_body(self, raw_body:str) -> CommandInput:
+        if not self.parse_cache_size:
+            return self.parse_uncached(raw_body)
+
+        self.lexicon.ensure_compiled()
+        if self.parse_cache_version != self.lexicon.version:
+            self.parse_cache.clear()
+            self.parse_cache_version = self.lexicon.version
+
+        command_input = self.parse_cache.get(raw_body)
+        if command_input is not None:
+            self.parse_cache.move_to_end(raw_body)
+            self.parse_cache_hits += 1
+            return command_input
+
+        self.parse_cache_misses += 1
+
+        # bodies which fail to parse raise, and are not cached
+        command_input = self.parse_uncached(raw_body)
+        self.parse_cache[raw_body] = command_input
+        if len(self.parse_cache) > self.parse_cache_size:
+            self.parse_cache.popitem(last=False)
+
+        return command_input
+
+
+    def parse_uncached(self, raw_body:str) -> CommandInput:
         content_tag = None
         command_string = None
-        modifiers = []
+        # tuples, because a cached CommandInput is shared by every later parse of the same body
+        modifiers = ()
 
         # make sure there's no leading whitespace, then see what we've got
         body = unquote_plus(raw_body).lstrip().rstrip().lower()
@@ -227,7 +415,7 @@ class SMSMessageParser(object):
 
             if len(tokens) > 2:
                 command_string = tokens[1].lower()
-                modifiers = tokens[2:]
+                modifiers = tuple(tokens[2:])
 
             #print('#--------- looking up system SMS command: %s...' % command_string)
             command_spec = self.lexicon.lookup_sms_command(command_string)
@@ -274,7 +462,7 @@ class SMSMessageParser(object):
         else:
             tokens = [token.lstrip().rstrip() for token in body.split(' ') if token]
             command_string = tokens[0].lower()
-            modifiers = tokens[1:]
+            modifiers = tuple(tokens[1:])
 
             # see if we received a generator 
             # (a command which generates a list or a slice of a list)
@@ -354,17 +542,38 @@ class DialogEngine(object):
 
 
 class SMSResponder(object):
-    def __init__(self, engine: DialogEngine, lexicon: CommandLexicon, sms_service: SMSService, prefix_separator='-'):
+    def __init__(self, engine: DialogEngine, lexicon: CommandLexicon, sms_service: SMSService, prefix_separator='-', **kwargs):
         self.dialog_engine = engine
         self.lexicon = lexicon
-        self.parser = SMSMessageParser(lexicon, prefix_separator)
+        self.parser = SMSMessageParser(lexicon, prefix_separator, parse_cache_size=kwargs.get('parse_cache_size'))
         self.sms_service = sms_service
 
 
+    def lookup_user(self, source_number, service_registry):
+        # served from the atrium client's identity cache; None if no user has this number
+        atrium_client = service_registry.lookup('atrium')
+        db_svc = service_registry.lookup('postgres')
+        return atrium_client.lookup_user_identity(source_number, db_svc)
+
+
+    def send_reply(self, mobile_number, text):
+        # with queued sending, failures surface on the returned Future rather than here
+        result = self.sms_service.send_sms(mobile_number, text)
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self.report_failed_reply(mobile_number, future))
+        return result
+
+
+    def report_failed_reply(self, mobile_number, future):
+        err = future.exception()
+        if err is not None:
+            print('### reply to [%s] was not delivered: %s' % (mobile_number, err), file=sys.stderr)
+
+
     def respond(self, source_number, raw_message_body, service_registry):
         mobile_number = normalize_mobile_number(source_number)
         
-        user = self.lookup_user(source_number)
+        user = self.lookup_user(source_number, service_registry)
         dlg_context = SMSDialogContext(user=user, source_number=mobile_number, message=unquote_plus(raw_message_body))
 
         try:
@@ -372,19 +581,19 @@ class SMSResponder(object):
             print('#----- Resolved command: %s' % str(command_input))
 
             response = self.dialog_engine.reply_command(command_input, dlg_context, self.lexicon, service_registry)
-            self.sms_service.send_sms(mobile_number, response) 
+            self.send_reply(mobile_number, response)
 
         except IncompleteFunctionCommand as err:
             print('Error data: %s' % err)
             print('#----- Incomplete prefix command: in message body: %s' % raw_message_body)
-            self.sms_service.send_sms(mobile_number, self.lexicon.lookup_function_command(raw_message_body[0]).definition)
+            self.send_reply(mobile_number, self.lexicon.lookup_function_command(raw_message_body[0]).definition)
 
             raise
 
         except UnrecognizedSMSCommand as err:
             print('Error data: %s' % err)
             print('#----- Unrecognized system command: in message body: %s' % raw_message_body)
-            self.sms_service.send_sms(mobile_number, self.lexicon.compile_help_string())
+            self.send_reply(mobile_number, self.lexicon.help_page(1))
             
             raise
         
@@ -397,6 +606,10 @@ def load_lexicon(yaml_config: dict) -> CommandLexicon:
     if not sys_cmd_segment:
         raise Exception('YAML configuration does not contain a required [command_sets][system] section.')
 
+    sys_settings = sys_cmd_segment.get('settings') or {}
+    lexicon.help_command = sys_settings.get('help_command')
+    lexicon.help_page_segments = int(sys_settings.get('help_page_segments') or lexicon.help_page_segments)
+
     for cmd_name, cmd_def in sys_cmd_segment['commands'].items():
         defstring = cmd_def['definition']
         arg_required = cmd_def['arg_required']
@@ -428,6 +641,7 @@ def load_lexicon(yaml_config: dict) -> CommandLexicon:
         command_spec = SMSFunctionSpec(command=cmd_name, definition=defstring, defchar=defchar)        
         lexicon.register_func_command_spec(command_spec)
 
+    lexicon.compile()
     return lexicon
 
 
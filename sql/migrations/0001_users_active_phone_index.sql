@@ -0,0 +1,9 @@
+-- SMS lookups resolve a mobile number to its live user:
+--   ... WHERE sms_phone_number = ? AND deleted_ts IS NULL
+-- A live number belongs to exactly one user; deleted users keep their old numbers.
+--
+-- This fails if two live users already share a number; resolve those first.
+
+CREATE UNIQUE INDEX "users_active_sms_phone_number_uq"
+  ON "users" ("sms_phone_number")
+  WHERE "deleted_ts" IS NULL AND "sms_phone_number" IS NOT NULL;
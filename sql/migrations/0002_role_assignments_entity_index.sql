@@ -0,0 +1,4 @@
+-- role checks look up every assignment held by an entity (a user or group)
+
+CREATE INDEX "role_assignments_entity_id_idx"
+  ON "role_assignments" ("entity_id");
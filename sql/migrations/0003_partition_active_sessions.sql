@@ -0,0 +1,97 @@
+-- active_sessions gets a row for every SMS session ever opened. Partition it by month of
+-- created_ts, so that old months can be dropped whole (see purge_expired_active_sessions)
+-- instead of being deleted row by row.
+--
+-- The primary key of a partitioned table must include the partition key, so it becomes (id, created_ts).
+
+ALTER TABLE "active_sessions" RENAME TO "active_sessions_unpartitioned";
+ALTER TABLE "active_sessions_unpartitioned" RENAME CONSTRAINT "active_sessions_pkey" TO "active_sessions_unpartitioned_pkey";
+
+CREATE TABLE "active_sessions" (
+  "id" uuid NOT NULL,
+  "user_id" uuid NOT NULL,
+  "session_type_ref_id" int2 NOT NULL,
+  "session_profile_ref_id" int2,
+  "created_ts" timestamptz(255) NOT NULL,
+  "expired_ts" timestamptz(255),
+  PRIMARY KEY ("id", "created_ts")
+) PARTITION BY RANGE ("created_ts");
+
+-- catches anything outside the monthly partitions, so that an insert never fails for want of one
+CREATE TABLE "active_sessions_default" PARTITION OF "active_sessions" DEFAULT;
+
+
+-- creates the monthly partitions from the month of from_ts through months_ahead months from now
+CREATE OR REPLACE FUNCTION ensure_active_sessions_partitions(from_ts timestamptz, months_ahead int)
+RETURNS int AS $$
+DECLARE
+  month_start date := date_trunc('month', least(from_ts, now()))::date;
+  last_month date := (date_trunc('month', now()) + make_interval(months => months_ahead))::date;
+  partition_name text;
+  created int := 0;
+BEGIN
+  WHILE month_start <= last_month LOOP
+    partition_name := 'active_sessions_' || to_char(month_start, 'YYYY_MM');
+    IF to_regclass(quote_ident(partition_name)) IS NOT NULL THEN
+      NULL;
+    -- a month that already has rows in the default partition is left there (and purged from there)
+    ELSIF EXISTS (SELECT 1 FROM "active_sessions_default"
+                  WHERE "created_ts" >= month_start AND "created_ts" < month_start + interval '1 month') THEN
+      RAISE NOTICE 'sessions from % are in active_sessions_default; not creating %', to_char(month_start, 'YYYY-MM'), partition_name;
+    ELSE
+      EXECUTE format('CREATE TABLE %I PARTITION OF "active_sessions" FOR VALUES FROM (%L) TO (%L)',
+                     partition_name, month_start, (month_start + interval '1 month')::date);
+      created := created + 1;
+    END IF;
+    month_start := (month_start + interval '1 month')::date;
+  END LOOP;
+  RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- drops monthly partitions that ended more than retain ago and whose sessions have all expired,
+-- deletes equally old expired sessions from the default partition, and makes sure next
+-- month's partitions exist. Run it regularly (make db-purge-sessions).
+CREATE OR REPLACE FUNCTION purge_expired_active_sessions(retain interval, months_ahead int DEFAULT 3)
+RETURNS int AS $$
+DECLARE
+  part record;
+  cutoff timestamptz := now() - retain;
+  still_open boolean;
+  dropped int := 0;
+BEGIN
+  FOR part IN
+    SELECT c.relname AS partition_name,
+           to_date(substring(c.relname from 'active_sessions_(\d{4}_\d{2})$'), 'YYYY_MM') AS month_start
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = '"active_sessions"'::regclass
+      AND c.relname ~ '^active_sessions_\d{4}_\d{2}$'
+  LOOP
+    IF part.month_start + interval '1 month' <= cutoff THEN
+      EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE "expired_ts" IS NULL OR "expired_ts" > %L)',
+                     part.partition_name, cutoff) INTO still_open;
+      IF NOT still_open THEN
+        EXECUTE format('DROP TABLE %I', part.partition_name);
+        dropped := dropped + 1;
+      END IF;
+    END IF;
+  END LOOP;
+
+  DELETE FROM "active_sessions_default" WHERE "expired_ts" <= cutoff;
+
+  PERFORM ensure_active_sessions_partitions(now(), months_ahead);
+  RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+
+SELECT ensure_active_sessions_partitions(coalesce((SELECT min("created_ts") FROM "active_sessions_unpartitioned"), now()), 3);
+
+INSERT INTO "active_sessions" SELECT * FROM "active_sessions_unpartitioned";
+DROP TABLE "active_sessions_unpartitioned";
+
+ALTER TABLE "active_sessions" ADD CONSTRAINT "fk_active_sessions_users_1" FOREIGN KEY ("user_id") REFERENCES "users" ("id");
+ALTER TABLE "active_sessions" ADD CONSTRAINT "fk_active_sessions_ref_session_types_1" FOREIGN KEY ("session_type_ref_id") REFERENCES "ref_session_types" ("id");
+ALTER TABLE "active_sessions" ADD CONSTRAINT "fk_active_sessions_ref_session_profiles_1" FOREIGN KEY ("session_profile_ref_id") REFERENCES "ref_session_profiles" ("id");
@@ -0,0 +1,5 @@
+-- a user's sessions are looked up by user and expiry (open sessions have no expired_ts);
+-- an index on the partitioned table is created on every partition, present and future
+
+CREATE INDEX "active_sessions_user_id_expired_ts_idx"
+  ON "active_sessions" ("user_id", "expired_ts");
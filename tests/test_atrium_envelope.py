@@ -0,0 +1,12 @@
+import time
+from atrium_envelope import InboundMessage, compose_message, WIRE_FORMAT_JSON, WIRE_FORMAT_ENVELOPE
+
+
+def test_timestamp_header_is_epoch_seconds_in_either_wire_format():
+    before = time.time()
+    timestamps = [InboundMessage(compose_message(wire_format, 'test', 'application/json', {'n': 1})).header_field('timestamp')
+                  for wire_format in (WIRE_FORMAT_JSON, WIRE_FORMAT_ENVELOPE)]
+
+    for timestamp in timestamps:
+        assert isinstance(timestamp, float)
+        assert before - 1 <= timestamp <= time.time() + 1
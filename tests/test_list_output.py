@@ -0,0 +1,64 @@
+import time
+from pulse.common import ListOutputResponder
+from smslang import SMSGeneratorSpec, GeneratorCommand
+from pulse_services import sms_segment_count
+
+
+class EchoDialogEngine(object):
+    '''replies with the chained command's text; "fail" raises and "slow" outlasts the chain timeout
+    '''
+
+    def reply_command(self, command_input, dialog_context, lexicon, service_registry):
+        if command_input == 'fail':
+            raise Exception('handler error')
+        if command_input == 'slow':
+            time.sleep(0.5)
+        return 'reply to %s' % command_input
+
+
+def generate(responder, cmd_string, records, modifiers=()):
+    spec = SMSGeneratorSpec(command='my', definition='my list', specifier='.', filterchar='?')
+    return responder.generate(command_object=GeneratorCommand(cmd_string=cmd_string, cmdspec=spec, modifiers=modifiers),
+                              record_list=records,
+                              render_callback=lambda index, item: '%d. %s' % (index, item) if index else item,
+                              filter_callback=lambda expression, item: expression in item,
+                              dialog_context=object(),
+                              dialog_engine=EchoDialogEngine(),
+                              lexicon=object(),
+                              service_registry=object())
+
+
+def test_chained_range_replies_in_order_and_survives_a_failed_command():
+    responder = ListOutputResponder(None, lambda command_string: command_string.split('+')[0],
+                                    chain_concurrency=4, chain_timeout_seconds=0.2)
+
+    reply = generate(responder, 'my.1-3', ['a', 'fail', 'slow'], modifiers=('x',))
+
+    assert reply.split('\n\n') == ['reply to a',
+                                   '(could not run "fail+x")',
+                                   '(no reply to "slow+x" within 0.2 seconds)']
+
+
+def test_listing_pages_are_cut_by_sms_segments_and_continue_where_they_left_off():
+    responder = ListOutputResponder(None, lambda command_string: command_string, page_segments=1)
+    records = ['item %02d %s' % (n, 'x' * 40) for n in range(1, 11)]
+
+    first_page = generate(responder, 'my', records)
+    second_page = generate(responder, 'my.p2', records)
+
+    assert sms_segment_count(first_page) == 1
+    assert first_page.endswith('Reply my.p2 for more.')
+    assert '1. item 01' in first_page and '3. item 03' not in first_page
+    assert second_page.startswith('3. item 03')
+
+
+def test_long_plain_range_is_paged_with_the_rest_of_the_range_as_continuation():
+    responder = ListOutputResponder(None, lambda command_string: command_string, page_segments=1)
+    records = ['item %02d %s' % (n, 'x' * 40) for n in range(1, 11)]
+
+    reply = generate(responder, 'my.4-9', records)
+
+    assert sms_segment_count(reply) == 1
+    assert reply.startswith('4. item 04')
+    assert reply.endswith('Reply my.6-9 for more.')
+    assert generate(responder, 'my.6-9', records).startswith('6. item 06')
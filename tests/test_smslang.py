@@ -0,0 +1,38 @@
+from smslang import CommandLexicon, SMSMessageParser, SMSCommandSpec
+
+
+def build_lexicon(definition: str) -> CommandLexicon:
+    lexicon = CommandLexicon()
+    lexicon.register_sys_command_spec(SMSCommandSpec(command='on', definition=definition, synonyms=[], tag_required=False))
+    lexicon.compile()
+    return lexicon
+
+
+def test_parse_cache_hits_for_repeated_bodies():
+    parser = SMSMessageParser(build_lexicon('go online'), '-', parse_cache_size=10)
+
+    first = parser.parse_sms_message_body('on')
+    second = parser.parse_sms_message_body('on')
+
+    assert first is second
+    assert parser.parse_cache_stats()['hits'] == 1
+
+
+def test_parse_cache_is_dropped_when_the_lexicon_is_replaced():
+    parser = SMSMessageParser(build_lexicon('go online'), '-', parse_cache_size=10)
+    before = parser.parse_sms_message_body('on')
+
+    # a freshly loaded lexicon has been compiled exactly as many times as the one it replaces
+    parser.lexicon = build_lexicon('go online (reloaded)')
+    after = parser.parse_sms_message_body('on')
+
+    assert after is not before
+    assert after.cmd_object.cmdspec.definition == 'go online (reloaded)'
+
+
+def test_cached_modifiers_cannot_be_changed():
+    parser = SMSMessageParser(build_lexicon('go online'), '-', parse_cache_size=10)
+    command_input = parser.parse_sms_message_body('on now please')
+
+    assert command_input.cmd_object.modifiers == ('now', 'please')
+    assert isinstance(command_input.cmd_object.modifiers, tuple)